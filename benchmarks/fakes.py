@@ -0,0 +1,185 @@
+"""
+Fake lsusb, vboxmanage, usbguard, ip, ifconfig, sudo, groups and which executables for the benchmarks.
+
+All fakes are symlinks to one script that dispatches on the name it was started as. The script reads its
+configuration from the JSON file in $BENCH_CONFIG:
+
+    devices     number of USB mass storage devices (plugged into ports 1-1 ... 1-N)
+    vms         number of VMs listed by 'vboxmanage list vms'
+    interfaces  number of network interfaces listed by 'ip link'
+    padding     number of unrelated entries added to every listing (output size)
+    session     seconds a VM keeps running after startvm
+    delay       tool name -> seconds every invocation of that tool takes
+    calls       file every invocation is appended to
+    state       directory for the VM and usbguard state
+"""
+import json
+import os
+import stat
+import sys
+from typing import Dict, Optional
+
+TOOLS = ("lsusb", "vboxmanage", "usbguard", "ip", "ifconfig", "sudo", "groups", "which")
+
+FAKE = '''#!{python}
+import json, os, sys, time
+
+name, args = os.path.basename(sys.argv[0]), sys.argv[1:]
+with open(os.environ["BENCH_CONFIG"]) as f:
+    config = json.load(f)
+with open(config["calls"], "a") as f:
+    f.write(" ".join([name] + args) + "\\n")
+time.sleep(config["delay"].get(name, 0))
+
+devices, padding, state = config["devices"], config["padding"], config["state"]
+
+
+def vm_uuid(i):
+    return "00000000-0000-4000-8000-%012d" % i
+
+
+if name == "lsusb":
+    for i in range(1, devices + 1):
+        print("Bus 001 Device %03d: ID 0781:5567 SanDisk Corp. Cruzer Blade" % (i + 1))
+    for i in range(padding):
+        print("Bus 002 Device %03d: ID 046d:c52b Logitech, Inc. Unifying Receiver" % (i + 1))
+
+elif name == "vboxmanage":
+    if args[:2] in (["list", "vms"], ["list", "runningvms"]):
+        for i in range(config["vms"]):
+            print('"bench-vm-%d" {{%s}}' % (i, vm_uuid(i)))
+    elif args[:2] == ["list", "usbhost"]:
+        print("Host USB Devices:\\n")
+        for i in range(1, devices + 1):
+            print("UUID:               00000000-0000-4000-9000-%012d" % i)
+            print("VendorId:           0x0781 (0781)")
+            print("ProductId:          0x5567 (5567)")
+            print("SerialNumber:       BENCH%04d" % i)
+            print("Address:            sysfs:/sys/devices/pci0000:00/0000:00:14.0/usb1/1-%d//device:/dev/vboxusb/001/%03d"
+                  % (i, i + 1))
+            print("Current State:      Available\\n")
+        for i in range(padding):
+            print("UUID:               00000000-0000-4000-a000-%012d" % i)
+            print("VendorId:           0x046d (046D)")
+            print("ProductId:          0xc52b (C52B)")
+            print("Address:            sysfs:/sys/devices/pci0000:00/0000:00:14.0/usb2/2-%d//device:/dev/vboxusb/002/%03d"
+                  % (i + 1, i + 1))
+            print("Current State:      Busy\\n")
+    elif args[0] == "showvminfo":
+        try:
+            with open(os.path.join(state, "vm-" + args[1])) as f:
+                running = time.time() - float(f.read()) < config["session"]
+        except OSError:
+            running = False
+        print('name="%s"' % args[1])
+        print('UUID="%s"' % vm_uuid(0))
+        print('VMState="%s"' % ("running" if running else "poweroff"))
+        print('usb="on"')
+        print('ehci="on"')
+        print('xhci="on"')
+        print('USBFilterName1="allow_all_usbs"')
+        for i in range(padding):
+            print('"GuestProperty%d"="bench"' % i)
+    elif args[0] == "startvm":
+        with open(os.path.join(state, "vm-" + args[1]), "w") as f:
+            f.write(str(time.time()))
+
+elif name == "usbguard":
+    if args[0] == "list-devices":
+        for i in range(padding):
+            print('%d: allow id 1d6b:0002 serial "" name "Hub" via-port "usb%d" with-interface 09:00:00' % (i + 1, i + 3))
+        for i in range(1, devices + 1):
+            target = "allow" if os.path.exists(os.path.join(state, "allowed-%d" % (1000 + i))) else "block"
+            print('%d: %s id 0781:5567 serial "BENCH%04d" name "Cruzer Blade" via-port "1-%d" with-interface 08:06:50'
+                  % (1000 + i, target, i, i))
+    elif args[0] == "allow-device":
+        open(os.path.join(state, "allowed-" + args[1]), "w").close()
+    elif args[0] == "block-device":
+        try:
+            os.remove(os.path.join(state, "allowed-" + args[1]))
+        except OSError:
+            pass
+
+elif name in ("ip", "ifconfig"):
+    for i in range(config["interfaces"]):
+        print("%d: bench%d: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 state UP" % (i + 2, i))
+
+elif name == "sudo":
+    # sudo -n <python> -m privileged.core --stdio ...: emulates the helper on the socket passed as stdin
+    while args and args[0].startswith("-"):
+        args = args[2:] if args[0] == "-p" else args[1:]
+    if args[1:3] == ["-m", "privileged.core"]:
+        import socket, subprocess
+        sock = socket.socket(fileno=0)
+        sock.sendall(json.dumps({{"ready": True}}).encode() + b"\\n")
+        usbguard = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), "usbguard")
+        for line in sock.makefile("rb"):
+            request = json.loads(line)
+            op, options = request["op"], request.get("args") or {{}}
+            reply = {{"id": request["id"]}}
+            if op == "link_state":
+                reply["result"] = [{{"interface": x, "up": options["up"], "error": None}} for x in options["interfaces"]]
+            elif op == "usbguard":
+                reply["result"] = {{x: subprocess.call([usbguard, options["action"], x]) == 0 for x in options["ids"]}}
+            else:
+                reply["error"] = "Operation not allowed: " + op
+            sock.sendall(json.dumps(reply).encode() + b"\\n")
+
+elif name == "groups":
+    print("bench vboxusers")
+
+elif name == "which":
+    path = os.path.join(os.path.dirname(os.path.abspath(sys.argv[0])), args[0])
+    if not os.path.exists(path):
+        sys.exit(1)
+    print(path)
+'''
+
+
+def install(bindir: str, python: Optional[str] = None) -> Dict[str, str]:
+    """
+    Writes the fake executables into bindir.
+
+    :return: Returns tool name -> path
+    :rtype: Dict[str, str]
+    """
+    os.makedirs(bindir, exist_ok=True)
+    script = os.path.join(bindir, "fake.py")
+    with open(script, "w") as f:
+        f.write(FAKE.format(python=python or sys.executable))
+    os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    tools = dict()
+    for tool in TOOLS:
+        path = os.path.join(bindir, tool)
+        if not os.path.lexists(path):
+            os.symlink("fake.py", path)
+        tools[tool] = path
+    return tools
+
+
+def write_attributes(directory: str, **attributes):
+    os.makedirs(directory, exist_ok=True)
+    for attribute, value in attributes.items():
+        with open(os.path.join(directory, attribute), "w") as f:
+            f.write(f"{value}\n")
+
+
+def build_sysfs(root: str, devices: int, padding: int = 0):
+    """
+    Creates a /sys/bus/usb/devices tree with a root hub, devices mass storage devices and padding HID devices.
+    """
+    write_attributes(os.path.join(root, "usb1"), idVendor="1d6b", idProduct="0002", busnum=1, devnum=1)
+    write_attributes(os.path.join(root, "usb1:1.0"), bInterfaceClass="09")
+    for i in range(1, devices + 1):
+        write_attributes(os.path.join(root, f"1-{i}"), idVendor="0781", idProduct="5567", serial=f"BENCH{i:04d}",
+                         busnum=1, devnum=i + 1, speed=480)
+        write_attributes(os.path.join(root, f"1-{i}:1.0"), bInterfaceClass="08")
+    for i in range(1, padding + 1):
+        write_attributes(os.path.join(root, f"2-{i}"), idVendor="046d", idProduct="c52b", busnum=2, devnum=i + 1)
+        write_attributes(os.path.join(root, f"2-{i}:1.0"), bInterfaceClass="03")
+
+
+def write_config(path: str, **config):
+    with open(path, "w") as f:
+        json.dump(config, f)
@@ -0,0 +1,54 @@
+"""
+Runs one benchmark scenario in a fresh interpreter and writes its latency and peak RSS to a JSON file.
+
+usage: flow.py <sysfs root> <result file> <mount-usb-in-sandbox arguments>...
+
+The fake executables have to be on PATH and $BENCH_CONFIG has to point to their configuration (see fakes.py).
+"""
+import errno
+import getpass
+import grp
+import json
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run(sysfs_root: str, result_path: str, argv):
+    start = time.perf_counter()
+
+    import main
+    import network.rtnetlink
+    import usb.sysfs
+
+    # read the generated device tree instead of /sys/bus/usb/devices
+    usb.sysfs.enumerate_usb_devices.__defaults__ = (sysfs_root,)
+    # interface changes always take the unprivileged path through the fake sudo, the host's links are never touched
+    network.rtnetlink.set_links_state = lambda interfaces, up: {
+        x: network.rtnetlink.LinkResult(x, up, os.strerror(errno.EPERM)) for x in interfaces}
+    # the benchmark user is a member of vboxusers
+    real_getgrnam = grp.getgrnam
+    grp.getgrnam = lambda name: (grp.struct_group((name, "x", os.getegid(), [])) if name == "vboxusers"
+                                 else real_getgrnam(name))
+    # the fake sudo ignores the password, never block on the terminal
+    getpass.getpass = lambda prompt="": "bench"
+
+    sys.argv = ["mount-usb-in-sandbox"] + list(argv)
+    code = 0
+    try:
+        main.main()
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+
+    result = {"seconds": time.perf_counter() - start,
+              "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              "exit": code}
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+
+if __name__ == '__main__':
+    run(sys.argv[1], sys.argv[2], sys.argv[3:])
@@ -0,0 +1,246 @@
+"""
+Hermetic benchmarks for the insert-to-attach flow (main.main) and for --restore.
+
+Every scenario runs in a fresh interpreter with the fake executables from fakes.py on PATH, a generated sysfs tree
+and its own journal, and is measured for latency, the number of subprocesses started and peak RSS. Each dimension
+(USB devices, network interfaces, VMs) is scaled on its own while the others are kept at 1.
+
+    python benchmarks/run.py                        # run and compare with benchmarks/baseline.json
+    python benchmarks/run.py --update-baseline      # run and store the results as the new baseline
+    python benchmarks/run.py --devices 1,8 --delay vboxmanage=0.05 --output results.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks import fakes  # noqa: E402
+
+BASELINE = os.path.join(ROOT, "benchmarks", "baseline.json")
+METRICS = ("seconds", "subprocesses", "peak_rss_kb")
+
+
+class Scenario:
+    """
+    One point of the benchmark matrix.
+    """
+    __slots__ = ('flow', 'devices', 'interfaces', 'vms', 'padding', 'session', 'delay')
+
+    def __init__(self, flow: str, devices: int = 1, interfaces: int = 1, vms: int = 1, padding: int = 0,
+                 session: float = 0.0, delay: Optional[Dict[str, float]] = None):
+        self.flow = flow
+        self.devices = devices
+        self.interfaces = interfaces
+        self.vms = vms
+        self.padding = padding
+        self.session = session
+        self.delay = delay or dict()
+
+    @property
+    def name(self) -> str:
+        return f"{self.flow}/devices={self.devices}/interfaces={self.interfaces}/vms={self.vms}"
+
+    def arguments(self) -> List[str]:
+        if self.flow == "restore":
+            return ["--restore", "--sandbox", "bench-vm-0"]
+        return ["--sandbox", "bench-vm-0", "--interfaces"] + [f"bench{i}" for i in range(self.interfaces)]
+
+
+def _seed_journal(scenario: Scenario, state_dir: str):
+    import journal.core
+
+    log = journal.core.Journal(os.path.join(state_dir, journal.core.JOURNAL_NAME))
+    log.apply(journal.core.INTERFACE, [f"bench{i}" for i in range(scenario.interfaces)])
+    log.apply(journal.core.USBGUARD, [f"0781:5567@1-{i}" for i in range(1, scenario.devices + 1)])
+
+
+def run_once(scenario: Scenario, workdir: str) -> Dict[str, float]:
+    """
+    Runs a scenario once in a fresh interpreter.
+
+    :return: Returns seconds, subprocesses and peak_rss_kb
+    :rtype: Dict[str, float]
+    """
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    bindir = os.path.join(workdir, "bin")
+    state = os.path.join(workdir, "state")
+    os.makedirs(state)
+    fakes.install(bindir)
+    fakes.build_sysfs(os.path.join(workdir, "sys"), scenario.devices, scenario.padding)
+
+    calls = os.path.join(workdir, "calls")
+    config = os.path.join(workdir, "config.json")
+    fakes.write_config(config, devices=scenario.devices, vms=scenario.vms, interfaces=scenario.interfaces,
+                       padding=scenario.padding, session=scenario.session, delay=scenario.delay, calls=calls,
+                       state=state)
+
+    journal_dir = os.path.join(workdir, "journal")
+    env = dict(os.environ, PATH=bindir + os.pathsep + os.environ.get("PATH", ""), BENCH_CONFIG=config,
+               MOUNT_USB_IN_SANDBOX_STATE_DIR=journal_dir)
+    if scenario.flow == "restore":
+        _seed_journal(scenario, journal_dir)
+        # the devices are still allowed in usbguard
+        for i in range(1, scenario.devices + 1):
+            open(os.path.join(state, f"allowed-{1000 + i}"), "w").close()
+
+    result_path = os.path.join(workdir, "result.json")
+    p = subprocess.run([sys.executable, os.path.join(ROOT, "benchmarks", "flow.py"), os.path.join(workdir, "sys"),
+                        result_path] + scenario.arguments(),
+                       cwd=workdir, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                       stderr=subprocess.STDOUT, timeout=300)
+    try:
+        with open(result_path) as f:
+            result = json.load(f)
+    except OSError:
+        raise RuntimeError(f"{scenario.name} did not finish:\n{p.stdout.decode('UTF-8', 'replace')[-2000:]}")
+    if result["exit"] != 0:
+        raise RuntimeError(f"{scenario.name} exited with {result['exit']}:\n"
+                           f"{p.stdout.decode('UTF-8', 'replace')[-2000:]}")
+
+    with open(calls) as f:
+        result["subprocesses"] = len(f.read().splitlines())
+    return result
+
+
+def run_scenario(scenario: Scenario, repeat: int, workdir: str) -> Dict[str, object]:
+    runs = [run_once(scenario, workdir) for _ in range(repeat)]
+    return {
+        "name": scenario.name,
+        "flow": scenario.flow,
+        "devices": scenario.devices,
+        "interfaces": scenario.interfaces,
+        "vms": scenario.vms,
+        "seconds": statistics.median(x["seconds"] for x in runs),
+        "seconds_min": min(x["seconds"] for x in runs),
+        "subprocesses": max(x["subprocesses"] for x in runs),
+        "peak_rss_kb": statistics.median(x["peak_rss_kb"] for x in runs),
+    }
+
+
+def matrix(devices: List[int], interfaces: List[int], vms: List[int], padding: int = 0, session: float = 0.0,
+           delay: Optional[Dict[str, float]] = None) -> List[Scenario]:
+    """
+    Scales every dimension on its own, with the other dimensions at their smallest value.
+
+    :rtype: List[Scenario]
+    """
+    scenarios = dict()
+    base = {"devices": min(devices), "interfaces": min(interfaces), "vms": min(vms)}
+    for flow, dimensions in (("main", ("devices", "interfaces", "vms")), ("restore", ("devices", "interfaces"))):
+        for dimension in dimensions:
+            for value in {"devices": devices, "interfaces": interfaces, "vms": vms}[dimension]:
+                point = dict(base, **{dimension: value})
+                scenario = Scenario(flow, padding=padding, session=session, delay=delay, **point)
+                scenarios.setdefault(scenario.name, scenario)
+    return list(scenarios.values())
+
+
+def compare(results: List[Dict[str, object]], baseline: Dict[str, Dict[str, float]],
+            tolerance: float = 0.5, slack: float = 0.05) -> List[str]:
+    """
+    Compares results with a baseline.
+
+    The number of subprocesses is deterministic and must not grow at all. Latency may exceed the baseline by
+    tolerance (relative) plus slack seconds, peak RSS by tolerance.
+
+    :return: Returns one message per regression
+    :rtype: List[str]
+    """
+    regressions = list()
+    for result in results:
+        expected = baseline.get(result["name"])
+        if expected is None:
+            continue
+        if result["subprocesses"] > expected["subprocesses"]:
+            regressions.append(f"{result['name']}: {result['subprocesses']} subprocesses "
+                               f"(baseline {expected['subprocesses']})")
+        if result["seconds"] > expected["seconds"] * (1 + tolerance) + slack:
+            regressions.append(f"{result['name']}: {result['seconds']:.3f}s (baseline {expected['seconds']:.3f}s)")
+        if result["peak_rss_kb"] > expected["peak_rss_kb"] * (1 + tolerance):
+            regressions.append(f"{result['name']}: peak RSS {result['peak_rss_kb']} kB "
+                               f"(baseline {expected['peak_rss_kb']} kB)")
+    return regressions
+
+
+def _int_list(value: str) -> List[int]:
+    return [int(x) for x in value.split(",") if x]
+
+
+def _delays(values: List[str]) -> Dict[str, float]:
+    delays = dict()
+    for value in values:
+        tool, _, seconds = value.partition("=")
+        if tool not in fakes.TOOLS:
+            raise argparse.ArgumentTypeError(f"Unknown tool {tool}, expected one of {', '.join(fakes.TOOLS)}")
+        delays[tool] = float(seconds)
+    return delays
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(usage="%(prog)s [options]")
+    parser.add_argument("--devices", type=_int_list, default=[1, 4, 16, 64],
+                        help="Numbers of USB mass storage devices (default 1,4,16,64)")
+    parser.add_argument("--interfaces", type=_int_list, default=[1, 8, 32],
+                        help="Numbers of network interfaces (default 1,8,32)")
+    parser.add_argument("--vms", type=_int_list, default=[1, 16, 64], help="Numbers of VMs (default 1,16,64)")
+    parser.add_argument("--padding", type=int, default=0,
+                        help="Unrelated entries added to every listing of the fake tools")
+    parser.add_argument("--session", type=float, default=0.0, help="Seconds the VM keeps running after startvm")
+    parser.add_argument("--delay", action="append", default=[], metavar="TOOL=SECONDS",
+                        help="Delay of every invocation of a fake tool, e.g. vboxmanage=0.05")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario, the median is reported")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", default=BASELINE, help="Baseline to compare with")
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="Relative latency and RSS increase over the baseline that is still accepted")
+    args = parser.parse_args(argv)
+
+    scenarios = matrix(args.devices, args.interfaces, args.vms, padding=args.padding, session=args.session,
+                       delay=_delays(args.delay))
+    results = list()
+    with tempfile.TemporaryDirectory(prefix="mount-usb-bench-") as tmp:
+        for scenario in scenarios:
+            result = run_scenario(scenario, args.repeat, os.path.join(tmp, "run"))
+            results.append(result)
+            print(f"{result['name']:<48} {result['seconds'] * 1000:9.1f} ms {result['subprocesses']:5d} procs "
+                  f"{result['peak_rss_kb'] / 1024:7.1f} MB")
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "time": time.time(),
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({x["name"]: {k: x[k] for k in METRICS} for x in results}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        return 0
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create one")
+        return 0
+
+    regressions = compare(results, baseline, tolerance=args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Startup benchmark of the CLI: how long --help and --restore take and how many modules they import, compared with
+importing every module up front, and how long the preflight checks take as subprocesses (which, groups), in-process
+and memoized.
+
+    python benchmarks/startup.py [--repeat 10] [--output startup.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+EAGER_IMPORTS = "import main, helpers, kiosk, restore, sandbox.whonix, sandbox.pool, usb.hotplug"
+
+
+def measure_command(args: List[str], repeat: int, env: Dict[str, str]) -> Dict[str, float]:
+    """
+    Runs a Python command repeat times and reports the median wall time and the number of imported modules.
+
+    :rtype: Dict[str, float]
+    """
+    seconds = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + args, cwd=ROOT, env=env, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        seconds.append(time.perf_counter() - start)
+
+    p = subprocess.run([sys.executable, "-X", "importtime"] + args, cwd=ROOT, env=env, stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    modules = len([x for x in p.stderr.decode('UTF-8', 'replace').splitlines() if x.startswith("import time:")]) - 1
+    return {"seconds": statistics.median(seconds), "modules": modules}
+
+
+def measure_preflight(repeat: int) -> Dict[str, float]:
+    from execution.preflight import Preflight
+
+    def timed(func) -> float:
+        samples = list()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            samples.append(time.perf_counter() - start)
+        return statistics.median(samples)
+
+    def subprocesses():
+        for args in (["which", "usbguard"], ["groups"]):
+            try:
+                subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError:
+                pass
+
+    def cold():
+        preflight = Preflight()
+        preflight.tool_installed("usbguard")
+        preflight.user_in_group("vboxusers")
+
+    memoized = Preflight()
+    memoized.user_in_group("vboxusers")
+
+    def warm():
+        memoized.tool_installed("usbguard")
+        memoized.user_in_group("vboxusers")
+
+    return {"subprocess_seconds": timed(subprocesses), "in_process_seconds": timed(cold),
+            "cached_seconds": timed(warm)}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(usage="%(prog)s [options]")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per measurement, the median is reported")
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="mount-usb-startup-") as tmp:
+        env = dict(os.environ, MOUNT_USB_IN_SANDBOX_STATE_DIR=tmp)
+        results = {
+            "help": measure_command(["main.py", "--help"], args.repeat, env),
+            "restore": measure_command(["main.py", "--restore", "--sandbox", "none"], args.repeat, env),
+            "eager_imports": measure_command(["-c", EAGER_IMPORTS], args.repeat, env),
+            "preflight": measure_preflight(args.repeat),
+        }
+
+    for name in ("help", "restore", "eager_imports"):
+        print(f"{name:<16} {results[name]['seconds'] * 1000:8.1f} ms {results[name]['modules']:5d} modules")
+    preflight = results["preflight"]
+    print(f"{'preflight':<16} which+groups {preflight['subprocess_seconds'] * 1000:.2f} ms, "
+          f"in-process {preflight['in_process_seconds'] * 1000:.2f} ms, "
+          f"memoized {preflight['cached_seconds'] * 1000:.2f} ms")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,326 @@
+import asyncio
+import atexit
+import heapq
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+from typing import Dict, List, Optional, Sequence
+
+import metrics.core
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+PROFILE_ENV = "MOUNT_USB_IN_SANDBOX_PROFILE"
+
+# seconds a single invocation of a tool may take before it is killed
+DEFAULT_TIMEOUTS = {
+    "vboxmanage": 120,
+    "usbguard": 15,
+    "sudo": 60,
+    "groups": 5,
+    "which": 5,
+}
+DEFAULT_TIMEOUT = 30
+
+SLOWEST = 20
+
+
+class CommandResult:
+    """
+    Outcome of one external command.
+    """
+    __slots__ = ('args', 'tool', 'returncode', 'stdout', 'stderr', 'started', 'seconds', 'timed_out')
+
+    def __init__(self, args: List[str], tool: str, returncode: Optional[int], stdout: bytes, stderr: bytes,
+                 started: float, seconds: float, timed_out: bool = False):
+        self.args = args
+        self.tool = tool
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.started = started
+        self.seconds = seconds
+        self.timed_out = timed_out
+
+    def __repr__(self):
+        return f"CommandResult({self.tool!r}, rc={self.returncode}, {self.seconds:.3f}s, timed_out={self.timed_out})"
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+    @property
+    def output_size(self) -> int:
+        return len(self.stdout) + len(self.stderr)
+
+    @property
+    def stdout_text(self) -> str:
+        return self.stdout.decode('UTF-8', 'replace')
+
+    @property
+    def stderr_text(self) -> str:
+        return self.stderr.decode('UTF-8', 'replace')
+
+
+class _ToolStats:
+    __slots__ = ('calls', 'seconds', 'max_seconds', 'failures', 'timeouts', 'output_bytes')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.failures = 0
+        self.timeouts = 0
+        self.output_bytes = 0
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"calls": self.calls, "seconds": self.seconds, "max_seconds": self.max_seconds,
+                "failures": self.failures, "timeouts": self.timeouts, "output_bytes": self.output_bytes}
+
+
+class Executor:
+    """
+    Runs every external command of the tool.
+
+    Each command is killed once its per-tool timeout has passed and is recorded with its wall time, exit status and
+    output size. Only per-tool aggregates and the slowest commands are kept, so the memory use does not grow with the
+    number of commands a kiosk runs.
+    """
+
+    def __init__(self, timeouts: Optional[Dict[str, float]] = None, profile_path: Optional[str] = None):
+        self.timeouts = dict(DEFAULT_TIMEOUTS, **(timeouts or {}))
+        self.profile_path = profile_path
+        self.created = time.monotonic()
+        self.tools = dict()
+        self.slowest = list()
+        self.forks = 0
+        self.blocked = 0.0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def timeout_for(self, tool: str) -> float:
+        return self.timeouts.get(tool, DEFAULT_TIMEOUT)
+
+    def _start(self, args: Sequence[str], stdin: bool, cwd: Optional[str]) -> subprocess.Popen:
+        with self._lock:
+            self.forks += 1
+        return subprocess.Popen(list(args), cwd=cwd, stdin=subprocess.PIPE if stdin else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _finish(self, p: subprocess.Popen, args: Sequence[str], tool: str, started: float, timeout: float,
+                input: Optional[bytes] = None) -> CommandResult:
+        timed_out = False
+        try:
+            stdout, stderr = p.communicate(input=input, timeout=max(0.0, started + timeout - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            p.kill()
+            stdout, stderr = p.communicate()
+            timed_out = True
+            logger.error(f"{tool} did not finish within {timeout}s and was killed: {' '.join(args)}")
+
+        result = CommandResult(list(args), tool, p.returncode, stdout, stderr, started,
+                               time.monotonic() - started, timed_out)
+        self.record(result)
+        return result
+
+    def run(self, args: Sequence[str], tool: Optional[str] = None, timeout: Optional[float] = None,
+            input: Optional[bytes] = None, cwd: Optional[str] = None) -> CommandResult:
+        """
+        Runs a command and waits for it.
+
+        :param args: Command and arguments
+        :type args: Sequence[str]
+        :param tool: Name the command is recorded and timed out under, defaults to the executable's name
+        :type tool: Optional[str]
+        :param timeout: Seconds until the command is killed, defaults to the tool's timeout
+        :type timeout: Optional[float]
+        :param input: Bytes written to the command's stdin
+        :type input: Optional[bytes]
+        :rtype: CommandResult
+        """
+        tool = tool or os.path.basename(args[0])
+        timeout = self.timeout_for(tool) if timeout is None else timeout
+        started = time.monotonic()
+        try:
+            p = self._start(args, input is not None, cwd)
+        except OSError as e:
+            result = CommandResult(list(args), tool, None, b"", str(e).encode(), started, time.monotonic() - started)
+            self.record(result)
+            return result
+        return self._finish(p, args, tool, started, timeout, input)
+
+    async def run_async(self, args: Sequence[str], tool: Optional[str] = None, timeout: Optional[float] = None,
+                        input: Optional[bytes] = None, cwd: Optional[str] = None) -> CommandResult:
+        """
+        Runs a command without blocking the event loop, with the same timeout and recording as run.
+
+        :rtype: CommandResult
+        """
+        tool = tool or os.path.basename(args[0])
+        timeout = self.timeout_for(tool) if timeout is None else timeout
+        started = time.monotonic()
+        with self._lock:
+            self.forks += 1
+        try:
+            p = await asyncio.create_subprocess_exec(
+                *args, cwd=cwd, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            result = CommandResult(list(args), tool, None, b"", str(e).encode(), started, time.monotonic() - started)
+            self.record(result)
+            return result
+
+        timed_out = False
+        try:
+            stdout, stderr = await asyncio.wait_for(p.communicate(input), timeout)
+        except asyncio.TimeoutError:
+            p.kill()
+            stdout, stderr = await p.communicate()
+            timed_out = True
+            logger.error(f"{tool} did not finish within {timeout}s and was killed: {' '.join(args)}")
+        except asyncio.CancelledError:
+            p.kill()
+            await p.wait()
+            raise
+
+        result = CommandResult(list(args), tool, p.returncode, stdout, stderr, started,
+                               time.monotonic() - started, timed_out)
+        self.record(result)
+        return result
+
+    def spawn(self, args: Sequence[str], tool: Optional[str] = None, stdin=subprocess.DEVNULL,
+              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd: Optional[str] = None) -> subprocess.Popen:
+        """
+        Starts a long-lived process (e.g. the privileged helper) without waiting for it. It is counted as a fork, but
+        neither timed out nor recorded as a command.
+
+        :rtype: subprocess.Popen
+        """
+        tool = tool or os.path.basename(args[0])
+        with self._lock:
+            self.forks += 1
+        metrics.core.count("commands", tool=tool, outcome="spawned")
+        return subprocess.Popen(list(args), cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr)
+
+    def run_all(self, commands: Sequence[Sequence[str]], tool: Optional[str] = None,
+                timeout: Optional[float] = None) -> List[CommandResult]:
+        """
+        Starts all commands at once and waits for all of them.
+
+        :rtype: List[CommandResult]
+        """
+        started = time.monotonic()
+        running = list()
+        for args in commands:
+            name = tool or os.path.basename(args[0])
+            try:
+                running.append((args, name, self._start(args, False, None)))
+            except OSError as e:
+                running.append((args, name, e))
+
+        results = list()
+        for args, name, p in running:
+            if isinstance(p, OSError):
+                result = CommandResult(list(args), name, None, b"", str(p).encode(), started, 0.0)
+                self.record(result)
+                results.append(result)
+                continue
+            results.append(self._finish(p, args, name, started,
+                                        self.timeout_for(name) if timeout is None else timeout))
+        return results
+
+    def record(self, result: CommandResult):
+        with self._lock:
+            stats = self.tools.setdefault(result.tool, _ToolStats())
+            stats.calls += 1
+            stats.seconds += result.seconds
+            stats.max_seconds = max(stats.max_seconds, result.seconds)
+            stats.failures += 0 if result.ok else 1
+            stats.timeouts += 1 if result.timed_out else 0
+            stats.output_bytes += result.output_size
+            self.blocked += result.seconds
+
+            self._sequence += 1
+            entry = (result.seconds, self._sequence, result)
+            if len(self.slowest) < SLOWEST:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+
+        metrics.core.count("commands", tool=result.tool, outcome="ok" if result.ok else
+                           ("timeout" if result.timed_out else "error"))
+
+    def profile(self) -> Dict[str, object]:
+        """
+        Returns the run's profile: forks, seconds blocked on child processes, per-tool aggregates and the slowest
+        commands.
+
+        :rtype: Dict[str, object]
+        """
+        with self._lock:
+            return {
+                "pid": os.getpid(),
+                "wall_seconds": time.monotonic() - self.created,
+                "forks": self.forks,
+                "blocked_seconds": self.blocked,
+                "tools": {tool: stats.to_dict() for tool, stats in sorted(self.tools.items(),
+                                                                          key=lambda x: -x[1].seconds)},
+                "slowest": [{"command": " ".join(r.args), "tool": r.tool, "seconds": r.seconds,
+                             "returncode": r.returncode, "timed_out": r.timed_out, "output_bytes": r.output_size}
+                            for _, _, r in sorted(self.slowest, reverse=True)],
+            }
+
+    def write_profile(self, path: Optional[str] = None):
+        """
+        Writes the profile as JSON to path (defaults to profile_path).
+        """
+        path = path or self.profile_path
+        if not path:
+            return
+        try:
+            with open(path, "w") as f:
+                json.dump(self.profile(), f, indent=2)
+        except OSError as e:
+            logger.error(f"Could not write the command profile to {path}: {e}")
+
+
+_executor = Executor(profile_path=os.environ.get(PROFILE_ENV))
+
+
+def default_executor() -> Executor:
+    """
+    Returns the process-wide executor.
+
+    :rtype: Executor
+    """
+    return _executor
+
+
+def configure(profile_path: Optional[str] = None, timeouts: Optional[Dict[str, float]] = None) -> Executor:
+    """
+    Sets the profile file (falls back to $MOUNT_USB_IN_SANDBOX_PROFILE) and per-tool timeouts of the process-wide
+    executor.
+
+    :rtype: Executor
+    """
+    _executor.profile_path = profile_path or os.environ.get(PROFILE_ENV)
+    _executor.timeouts.update(timeouts or {})
+    return _executor
+
+
+def run(args: Sequence[str], tool: Optional[str] = None, timeout: Optional[float] = None,
+        input: Optional[bytes] = None, cwd: Optional[str] = None) -> CommandResult:
+    """
+    Runs a command with the process-wide executor.
+
+    :rtype: CommandResult
+    """
+    return _executor.run(args, tool=tool, timeout=timeout, input=input, cwd=cwd)
+
+
+atexit.register(lambda: _executor.write_profile())
@@ -0,0 +1,80 @@
+import grp
+import logging
+import os
+import shutil
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+class Preflight:
+    """
+    Checks the host before a run (is a tool installed, is the user in a group) in-process, without starting which or
+    groups.
+
+    Each check runs once per process and its result is reused by later callers (usb.core, helpers, main). The checks
+    are a stat of the PATH entries and a group lookup, so there is nothing to gain from keeping them across runs.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._results = dict()
+        self._lock = threading.Lock()
+
+    def _cached(self, name: str, check: Callable[[], bool]) -> bool:
+        with self._lock:
+            if name in self._results:
+                self.hits += 1
+                return self._results[name]
+
+            self.misses += 1
+            result = self._results[name] = check()
+            return result
+
+    def tool_installed(self, tool: str) -> bool:
+        """
+        Checks if an executable is on PATH.
+
+        :param tool: Name of the executable, e.g. usbguard
+        :type tool: str
+        :rtype: bool
+        """
+        return self._cached(f"tool:{tool}", lambda: shutil.which(tool) is not None)
+
+    def user_in_group(self, group: str) -> bool:
+        """
+        Checks if the current process is a member of a group (like 'groups' without arguments: a user added to the
+        group has to log in again).
+
+        :param group: Group name, e.g. vboxusers
+        :type group: str
+        :rtype: bool
+        """
+        def check() -> bool:
+            try:
+                return grp.getgrnam(group).gr_gid in set(os.getgroups()) | {os.getegid()}
+            except KeyError:
+                return False
+
+        return self._cached(f"group:{group}", check)
+
+
+_preflight = None
+_preflight_lock = threading.Lock()
+
+
+def default_preflight() -> Preflight:
+    """
+    Returns the process-wide preflight checker.
+
+    :rtype: Preflight
+    """
+    global _preflight
+    with _preflight_lock:
+        if _preflight is None:
+            _preflight = Preflight()
+        return _preflight
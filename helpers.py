@@ -1,9 +1,20 @@
+import logging
 import re
-import subprocess
-from collections import defaultdict
-from typing import DefaultDict, List
-
+from typing import Dict, List, Optional
+
+import execution.preflight
+import metrics.core
+import network.core
+import usb.sysfs
+from network.core import InterfacePolicy
+from sandbox.backend import VirtualBoxBackend
+from sandbox.vboxmanage import default_client
 from usb.core import USB
+from usb.sysfs import UsbDeviceRecord
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
 
 
 def check_if_sandbox_uuid(sandbox_id: str) -> bool:
@@ -19,6 +30,19 @@ def check_if_sandbox_uuid(sandbox_id: str) -> bool:
         return False
 
 
+def sandbox_kwargs(sandbox_id: str) -> Dict[str, str]:
+    """
+    Returns the keyword argument (uuid or name) to initialise a Sandbox object with.
+
+    :param sandbox_id: Name or UUID of the sandbox
+    :type sandbox_id: str
+    :rtype: Dict[str, str]
+    """
+    if check_if_sandbox_uuid(sandbox_id):
+        return {'uuid': sandbox_id}
+    return {'name': sandbox_id}
+
+
 def check_user_is_in_vboxgroup() -> bool:
     """
     Check if current user is in vboxgroup.
@@ -26,34 +50,26 @@ def check_user_is_in_vboxgroup() -> bool:
     :return: True if user is in vboxgroup, else False
     :rtype: bool
     """
-    groups = subprocess.Popen(["groups"],
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = groups.communicate()
-    groups = stdout.decode('UTF-8').splitlines()
-
-    for group in groups:
-        if group.find("vboxusers") != -1:
-            return True
+    return execution.preflight.default_preflight().user_in_group("vboxusers")
 
-    return False
 
-
-def get_network_interfaces() -> List[str]:
+def get_network_interfaces(policy: Optional[InterfacePolicy] = None) -> List[str]:
     """
     Returns a list of network interfaces.
 
     The list of network interfaces is later used to shut down the interfaces
 
+    :param policy: Optional policy selecting the interfaces (e.g. only physical interfaces that are up), all
+                    interfaces are returned if None
+    :type policy: Optional[InterfacePolicy]
     :return: list of network interfaces
     :rtype: list[str]
     """
-    ints = subprocess.Popen(["ip", "link", "show"], stdout=subprocess.PIPE)
-    ints = subprocess.check_output(["grep",
-                                    "-oE", "[0-9]{1,2}:.*: <"], stdin=ints.stdout)
-    ints = ints.decode('UTF-8').splitlines()
-    ints = [re.search(": (.*):", x).group(1) for x in ints]
+    interfaces = network.core.discover_interfaces()
+    if policy is not None:
+        interfaces = policy.select(interfaces)
 
-    return ints
+    return [x.name for x in interfaces]
 
 
 def is_vm_running(sandbox_id: str) -> bool:
@@ -65,94 +81,38 @@ def is_vm_running(sandbox_id: str) -> bool:
     :return: Returns True if VM is running, else False
     :rtype: bool
     """
-    running_vms = subprocess.Popen(["vboxmanage", "list", "runningvms"],
-                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = running_vms.communicate()
-    running_vms = stdout.decode('UTF-8').splitlines()
-
-    running_vms = [re.search("[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", x).group(0)
-                   for x in running_vms]
-
-    for uuid in running_vms:
-        if uuid == sandbox_id:
-            return True
-
-    return False
+    return default_client().is_running(sandbox_id)
 
 
 def get_usb_uuid(usb_objects: List[USB]) -> List[str]:
     """
-    Finds UUID of USB mass storage based on the device_id stored in the USB objects.
+    Finds UUID of USB mass storage based on the port path, bus address, serial and device_id stored in the USB objects.
 
     :param usb_objects: List of USB objects
     :type usb_objects: list[USB]
     :return: List of UUIDS of all attached USB mass storages
     :rtype: list[str]
     """
-    usb_uuids = list()
-
-    usbhosts = subprocess.Popen(["vboxmanage", "list", "usbhost"], stdout=subprocess.PIPE)
-    usbhosts = subprocess.check_output(["grep",
-                                        "-e", "UUID: ",
-                                        "-e", "VendorId: ",
-                                        "-e", "ProductId: "], stdin=usbhosts.stdout)
-    usbhosts = usbhosts.decode('UTF-8').splitlines()
-    usbhosts = [x.replace(" ", "") for x in usbhosts]
-
-    temp = list()
-    [temp.append(usbhosts[i] + usbhosts[i + 1] + usbhosts[i + 2]) \
-     for i in range(0, len(usbhosts)) if usbhosts[i].find('UUID:') != -1]
-
-    temp_dict = defaultdict(str)
-    for x in temp:
-        uuid = re.search("[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", x).group(0)
-        vendor_id = re.search("(?<=VendorId:0x)[0-9a-f]{4}", x).group(0)
-        product_id = re.search("(?<=ProductId:0x)[0-9a-f]{4}", x).group(0)
-
-        device_id = vendor_id + ":" + product_id
-        temp_dict[uuid] = device_id
-
-    # lookup uuids from device_id  (e.g. 8087:0026 -> e0c6ec26-4ad1-4d55-97c8-f0f35c538e95)
-    [usb_uuids.append(k) for k, v in temp_dict.items() for obj in usb_objects if obj.device_id == v]
+    with metrics.core.span("uuid_resolution", devices=len(usb_objects)):
+        return VirtualBoxBackend(default_client()).resolve_usb(usb_objects)
 
-    return usb_uuids
 
-
-def lookup_usb_devices() -> DefaultDict[int, list]:
+def lookup_usb_devices() -> List[UsbDeviceRecord]:
     """
-    Query available USB devices that are listed in the "lsusb" command
+    Query available USB devices from sysfs (/sys/bus/usb/devices).
 
-    :return: Returns a dict with an index (key) and USB device information (value) such as device_id, vendor_id,
-                product_id, serial_number, interface_class
-    :rtype: DefaultDict[int, list]
+    :return: Returns a list of USB device records holding device_id, vendor_id, product_id, serial number, port path,
+                bus/device number and the interface classes of each device
+    :rtype: List[UsbDeviceRecord]
     """
-    grep_keywords = ['idVendor', 'idProduct', 'iSerial', 'bInterfaceClass']
-    device_id = subprocess.Popen("lsusb", stdout=subprocess.PIPE)
-    device_id = subprocess.check_output(["grep",
-                                         "-oE", "ID [a-f0-9]{4}:[a-f0-9]{4}"], stdin=device_id.stdout)
-    lsusb_verbose = subprocess.Popen(["lsusb", "-v", ], stdout=subprocess.PIPE)
-    lsusb_verbose = subprocess.check_output(["grep",
-                                             "-e", grep_keywords[0],
-                                             "-e", grep_keywords[1],
-                                             "-e", grep_keywords[2],
-                                             "-e", grep_keywords[3]], stdin=lsusb_verbose.stdout)
-
-    device_id = device_id.decode('UTF-8').splitlines()
-    device_id = [str(x).replace("ID ", "") for x in device_id]
-
-    lsusb_verbose = lsusb_verbose.decode('UTF-8').splitlines()
-    lsusb_verbose = [str(x).replace(" ", "") for x in lsusb_verbose]
+    return usb.sysfs.enumerate_usb_devices()
 
-    usb_devices = defaultdict(list)
-    idx = -1
-    for x in lsusb_verbose:
-        if x.find('idVendor') != -1:
-            idx = idx + 1
-            usb_devices[idx].append(device_id[idx])
-        usb_devices[idx].append(x)
 
-    # remove duplicates
-    for k, v in usb_devices.items():
-        usb_devices[k] = list(dict.fromkeys(v))
+def lookup_mass_storage_devices() -> List[USB]:
+    """
+    Returns USB objects for all attached USB mass storage devices.
 
-    return usb_devices
+    :return: List of USB objects
+    :rtype: List[USB]
+    """
+    return [record.to_usb() for record in lookup_usb_devices() if record.is_mass_storage()]
@@ -0,0 +1,278 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+STATE_DIR_ENV = "MOUNT_USB_IN_SANDBOX_STATE_DIR"
+SYSTEM_STATE_DIR = "/var/lib/mount-usb-in-sandbox"
+JOURNAL_NAME = "journal"
+
+APPLY = "apply"
+REVERT = "revert"
+
+INTERFACE = "interface"
+USBGUARD = "usbguard"
+
+# magic, payload length, crc32 of the payload
+FRAME_HEADER = struct.Struct("<4sII")
+FRAME_MAGIC = b"MUSJ"
+MAX_PAYLOAD = 1 << 20
+
+
+def default_state_dir() -> str:
+    """
+    Returns the directory of the journal: $MOUNT_USB_IN_SANDBOX_STATE_DIR if set, /var/lib/mount-usb-in-sandbox for
+    root and $XDG_STATE_HOME/mount-usb-in-sandbox (~/.local/state) for everyone else - independent of the working
+    directory the tool was started from.
+
+    :rtype: str
+    """
+    if os.environ.get(STATE_DIR_ENV):
+        return os.environ[STATE_DIR_ENV]
+    if os.geteuid() == 0:
+        return SYSTEM_STATE_DIR
+    xdg = os.environ.get("XDG_STATE_HOME") or os.path.join(os.path.expanduser("~"), ".local", "state")
+    return os.path.join(xdg, "mount-usb-in-sandbox")
+
+
+def encode_record(record: Dict[str, object]) -> bytes:
+    payload = json.dumps(record, separators=(",", ":")).encode()
+    return FRAME_HEADER.pack(FRAME_MAGIC, len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(data: bytes) -> Tuple[List[Dict[str, object]], int]:
+    """
+    Decodes the frames of a journal.
+
+    Decoding stops at the first frame that is truncated or fails its checksum, e.g. after a crash in the middle of a
+    write.
+
+    :return: Returns the records and the length of the valid prefix of data
+    :rtype: Tuple[List[Dict[str, object]], int]
+    """
+    records = list()
+    offset = 0
+    while offset + FRAME_HEADER.size <= len(data):
+        magic, length, crc = FRAME_HEADER.unpack_from(data, offset)
+        start = offset + FRAME_HEADER.size
+        if magic != FRAME_MAGIC or length > MAX_PAYLOAD or start + length > len(data):
+            break
+        payload = data[start:start + length]
+        if zlib.crc32(payload) != crc:
+            break
+        try:
+            records.append(json.loads(payload.decode()))
+        except ValueError:
+            break
+        offset = start + length
+    return records, offset
+
+
+def _fsync_dir(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """
+    Append-only log of the host changes that have to be undone by --restore.
+
+    Every record names an operation (apply or revert), a kind (interface, usbguard) and the affected keys. A change is
+    outstanding if the last record for its key applied it. Records are framed with a length and a crc32, written with
+    one write() per batch and fsync'd before the call returns. The journal is compacted to the outstanding changes
+    once compact_after records have been appended, so it stays small no matter how many sessions a kiosk has run.
+    """
+
+    def __init__(self, path: Optional[str] = None, compact_after: int = 256):
+        self.path = path or os.path.join(default_state_dir(), JOURNAL_NAME)
+        self.compact_after = compact_after
+        self._lock = threading.Lock()
+        # (inode, size) of the file the cached state was read from
+        self._stat = None
+        self._state = dict()
+        self._records = 0
+        self._valid = 0
+
+    def _open(self) -> int:
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+        created = not os.path.exists(self.path)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if created:
+            _fsync_dir(directory)
+        return fd
+
+    def _load(self, fd: int):
+        st = os.fstat(fd)
+        if self._stat == (st.st_ino, st.st_size):
+            return
+
+        chunks = list()
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        records, valid = decode_records(b"".join(chunks))
+        if valid < st.st_size:
+            logger.error(f"Ignoring {st.st_size - valid} bytes of a torn or corrupt record at the end of {self.path}")
+
+        state = dict()
+        for record in records:
+            self._fold(state, record)
+        self._state = state
+        self._records = len(records)
+        self._valid = valid
+        self._stat = (st.st_ino, st.st_size)
+
+    @staticmethod
+    def _fold(state: Dict[Tuple[str, str], bool], record: Dict[str, object]):
+        for key in record["keys"]:
+            if record["op"] == APPLY:
+                # re-insert, so outstanding changes are kept in the order they were made
+                state.pop((record["kind"], key), None)
+                state[(record["kind"], key)] = True
+            else:
+                state.pop((record["kind"], key), None)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock:
+            while True:
+                fd = self._open()
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # another process may have compacted (replaced) the file while we waited for the lock
+                try:
+                    current = os.stat(self.path).st_ino
+                except FileNotFoundError:
+                    current = None
+                if current == os.fstat(fd).st_ino:
+                    break
+                os.close(fd)
+            try:
+                self._load(fd)
+                yield fd
+            finally:
+                os.close(fd)
+
+    def _append(self, op: str, kind: str, keys: Iterable[str]):
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return
+        record = {"op": op, "kind": kind, "keys": keys, "time": time.time()}
+        frame = encode_record(record)
+
+        with self._locked() as fd:
+            if self._valid < os.fstat(fd).st_size:
+                # drop a torn tail before appending behind it
+                os.ftruncate(fd, self._valid)
+            os.lseek(fd, self._valid, os.SEEK_SET)
+            os.write(fd, frame)
+            os.fsync(fd)
+
+            self._fold(self._state, record)
+            self._records += 1
+            self._valid += len(frame)
+            st = os.fstat(fd)
+            self._stat = (st.st_ino, st.st_size)
+
+            if self._records >= self.compact_after:
+                self._compact()
+
+    def apply(self, kind: str, keys: Iterable[str]):
+        """
+        Notes changes before they are made, so a crash half-way through still leaves them restorable.
+
+        :param kind: Kind of change, e.g. interface or usbguard
+        :type kind: str
+        :param keys: Interface names or usbguard keys
+        :type keys: Iterable[str]
+        """
+        self._append(APPLY, kind, keys)
+
+    def revert(self, kind: str, keys: Iterable[str]):
+        """
+        Notes that changes have been undone.
+        """
+        self._append(REVERT, kind, keys)
+
+    def outstanding(self) -> Dict[str, List[str]]:
+        """
+        Returns every change that has been applied and not reverted yet.
+
+        :return: Returns kind -> keys, in the order the changes were made
+        :rtype: Dict[str, List[str]]
+        """
+        with self._locked():
+            outstanding = dict()
+            for kind, key in self._state:
+                outstanding.setdefault(kind, list()).append(key)
+            return outstanding
+
+    def records(self) -> Iterator[Dict[str, object]]:
+        with self._locked() as fd:
+            os.lseek(fd, 0, os.SEEK_SET)
+            data = os.read(fd, self._valid)
+        return iter(decode_records(data)[0])
+
+    def _compact(self):
+        by_kind = dict()
+        for kind, key in self._state:
+            by_kind.setdefault(kind, list()).append(key)
+        data = b"".join(encode_record({"op": APPLY, "kind": kind, "keys": keys, "time": time.time()})
+                        for kind, keys in by_kind.items())
+
+        tmp = self.path + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, self.path)
+        _fsync_dir(os.path.dirname(self.path))
+
+        logger.debug(f"Compacted {self._records} journal records into {len(by_kind)}")
+        self._records = len(by_kind)
+        self._valid = len(data)
+        st = os.stat(self.path)
+        self._stat = (st.st_ino, st.st_size)
+
+    def compact(self):
+        """
+        Rewrites the journal so it only holds the outstanding changes. The new file replaces the old one atomically.
+        """
+        with self._locked():
+            self._compact()
+
+
+_journals = dict()
+_journals_lock = threading.Lock()
+
+
+def default_journal() -> Journal:
+    """
+    Returns the process-wide journal in default_state_dir().
+
+    :rtype: Journal
+    """
+    path = os.path.join(default_state_dir(), JOURNAL_NAME)
+    with _journals_lock:
+        if path not in _journals:
+            _journals[path] = Journal(path)
+        return _journals[path]
@@ -0,0 +1,266 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+import execution.core
+import metrics.core
+import usb.core
+import usb.hotplug
+from sandbox.pool import VMPool, WarmPool
+from sandbox.vboxmanage import VBoxManage, default_client
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+class Session:
+    """
+    One USB stick analysed in one pooled VM.
+    """
+
+    def __init__(self, device: usb.core.USB):
+        self.device = device
+        self.sandbox = None
+        self.detected = time.monotonic()
+        self.dispatched = None
+        self.attached = None
+        self.finished = None
+        self.state = None
+        self.error = None
+
+    @property
+    def queue_wait(self) -> Optional[float]:
+        return None if self.dispatched is None else self.dispatched - self.detected
+
+    @property
+    def attach_latency(self) -> Optional[float]:
+        """
+        Seconds from detecting the stick until it was attached to the VM.
+        """
+        return None if self.attached is None else self.attached - self.detected
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.finished is None else self.finished - self.detected
+
+
+class KioskDaemon:
+    """
+    Dispatches every inserted USB stick to an idle VM of the pool and runs the sessions concurrently.
+
+    Each session starts the VM, attaches the stick, waits for the VM to shut down, blocks the stick on the host again
+    and returns the VM to the pool. At most max_sessions sessions run at the same time.
+    """
+
+    def __init__(self, pool: VMPool, max_sessions: Optional[int] = None, source=None,
+                 client: Optional[VBoxManage] = None, usbguard_command: str = "usbguard", sysfs_root: str = "/sys"):
+        self.pool = pool
+        self.max_sessions = max_sessions or len(pool)
+        self.client = client if client is not None else default_client()
+        self.usbguard_command = usbguard_command
+        self.watcher = usb.hotplug.HotplugWatcher(source=source, sysfs_root=sysfs_root,
+                                                  on_event=self.client.on_usb_event)
+        self.queue = queue.Queue()
+        self.sessions = list()
+        self.executor = ThreadPoolExecutor(max_workers=self.max_sessions)
+        self._slots = threading.BoundedSemaphore(self.max_sessions)
+        self._active = dict()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="kiosk-dispatcher", daemon=True)
+
+    def submit(self, device: usb.core.USB) -> Session:
+        """
+        Queues a stick for analysis.
+
+        :rtype: Session
+        """
+        session = Session(device)
+        with self._lock:
+            if device.port_path is not None and device.port_path in self._active:
+                logger.debug(f"Stick on port {device.port_path} already has a session")
+                return self._active[device.port_path]
+            if device.port_path is not None:
+                self._active[device.port_path] = session
+            self.sessions.append(session)
+        self.queue.put(session)
+        return session
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            try:
+                session = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            self._slots.acquire()
+            sandbox = self.pool.acquire()
+            session.sandbox = sandbox
+            session.dispatched = time.monotonic()
+            self.executor.submit(self._run_session, session)
+
+    def _run_session(self, session: Session):
+        sandbox = session.sandbox
+        usbguard = usb.core.USBGuard(devices=[session.device], command=self.usbguard_command)
+        try:
+            sandbox.device_ids = [session.device.device_id]
+            if not self.pool.prepare(sandbox):
+                raise RuntimeError(f"Could not start {sandbox.sandbox_id}")
+
+            with metrics.core.span("uuid_resolution", devices=1):
+                host = self.client.usbhost_index().resolve(session.device)
+            if host is None:
+                raise LookupError(f"VirtualBox does not list USB device {session.device.device_id} "
+                                  f"on port {session.device.port_path}")
+
+            result = sandbox.mount_usb_to_sandbox([host.uuid], usbguard=usbguard)[host.uuid]
+            if not result.ok:
+                raise RuntimeError(f"usbattach failed after {result.attempts} attempts: {result.error}")
+            session.attached = time.monotonic()
+            logger.debug(f"Attached {session.device.device_id} ({session.device.port_path}) to {sandbox.sandbox_id} "
+                         f"after {session.attach_latency:.3f}s")
+
+            session.state = sandbox.wait_for_shutdown()
+        except Exception as e:
+            logger.error(f"Session for {session.device.device_id} on {sandbox.sandbox_id} failed: {e}")
+            session.error = e
+        finally:
+            try:
+                usbguard.block_device()
+            finally:
+                if session.attached is None:
+                    self._power_off(sandbox)
+                session.finished = time.monotonic()
+                metrics.core.count("sessions", outcome="error" if session.error is not None else "ok")
+                with self._lock:
+                    if self._active.get(session.device.port_path) is session:
+                        del self._active[session.device.port_path]
+                self.pool.release(sandbox)
+                self._slots.release()
+
+    def _power_off(self, sandbox):
+        # a session that failed before attaching the stick may leave its VM booting, the next session gets it clean
+        try:
+            if self.client.is_running(sandbox.sandbox_id, refresh=True):
+                sandbox.power_off()
+        except Exception as e:
+            logger.error(f"Could not power off {sandbox.sandbox_id}: {e}")
+
+    def start(self, stats_interval: Optional[float] = None):
+        """
+        Starts dispatching queued sticks.
+
+        :param stats_interval: Log the stats every stats_interval seconds, None disables the stats log
+        :type stats_interval: Optional[float]
+        """
+        self._dispatcher.start()
+        if stats_interval:
+            threading.Thread(target=self._report, args=(stats_interval,), name="kiosk-stats", daemon=True).start()
+
+    def _report(self, interval: float):
+        while not self._stop.wait(interval):
+            stats = self.stats()
+            logger.info(f"queue depth {stats['queue_depth']}, pool {stats['pool']}, sessions {stats['sessions']} "
+                        f"(active {stats['active']}, failed {stats['failed']}), "
+                        f"attach latency {stats['attach_latency']}")
+            metrics.core.recorder().flush()
+            execution.core.default_executor().write_profile()
+
+    def serve_forever(self, poll: float = 0.5):
+        """
+        Waits for hotplug events and dispatches every added stick until stop() is called.
+
+        :param poll: Seconds between two checks whether the daemon was stopped
+        :type poll: float
+        """
+        if not self._dispatcher.is_alive():
+            self.start()
+        while not self._stop.is_set():
+            for action, device in self.watcher.events(timeout=poll):
+                if action == "add":
+                    self.submit(device)
+                if self._stop.is_set():
+                    break
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Waits until every queued session has finished.
+
+        :return: Returns True if all sessions finished within timeout
+        :rtype: bool
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if all(x.finished is not None for x in self.sessions):
+                    return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    def stop(self):
+        self._stop.set()
+        self.executor.shutdown(wait=True)
+        self.watcher.close()
+
+    def stats(self) -> Dict[str, object]:
+        """
+        Returns queue depth, pool usage and per-session latencies.
+
+        :rtype: Dict[str, object]
+        """
+        with self._lock:
+            sessions = list(self.sessions)
+        latencies = [x.attach_latency for x in sessions if x.attach_latency is not None]
+        return {
+            "queue_depth": self.queue.qsize() + self.pool.stats()["waiting"],
+            "pool": self.pool.stats(),
+            "sessions": len(sessions),
+            "active": len([x for x in sessions if x.finished is None]),
+            "failed": len([x for x in sessions if x.error is not None]),
+            "attach_latency": {
+                "min": min(latencies) if latencies else None,
+                "max": max(latencies) if latencies else None,
+                "mean": sum(latencies) / len(latencies) if latencies else None,
+            },
+            "per_session": [{"device": x.device.device_id,
+                             "port": x.device.port_path,
+                             "sandbox": x.sandbox.sandbox_id if x.sandbox else None,
+                             "queue_wait": x.queue_wait,
+                             "attach_latency": x.attach_latency,
+                             "duration": x.duration,
+                             "state": x.state,
+                             "error": str(x.error) if x.error else None} for x in sessions],
+        }
+
+
+def run_daemon(pool: VMPool, max_sessions: Optional[int] = None, stats_interval: float = 60):
+    """
+    Runs the kiosk daemon until interrupted, logging the stats every stats_interval seconds.
+
+    :param pool: Pool of VMs (a WarmPool is warmed up first)
+    :type pool: VMPool
+    :param max_sessions: Maximum number of concurrent sessions, defaults to the pool size
+    :type max_sessions: Optional[int]
+    :param stats_interval: Seconds between two stats log lines
+    :type stats_interval: float
+    """
+    if isinstance(pool, WarmPool):
+        pool.warm_up()
+    daemon = KioskDaemon(pool, max_sessions=max_sessions)
+    daemon.start(stats_interval=stats_interval)
+
+    print(f"\n\nKiosk mode: dispatching USB sticks to {len(pool)} VMs "
+          f"({daemon.max_sessions} concurrent sessions)...\n\n")
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Waiting for the running sessions to finish...")
+    finally:
+        daemon.stop()
+        if isinstance(pool, WarmPool):
+            pool.shutdown()
@@ -3,21 +3,87 @@
 import argparse
 import logging
 import os
-import pickle
 import sys
-import time
-
-import helpers
-import restore as rest
-import sandbox.core as sand
-import sandbox.whonix as who
-import usb.core
+from typing import List, Optional
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
 
+def disconnect_network_interfaces(interfaces: Optional[List[str]], exclude_interfaces: Optional[List[str]]) -> List[str]:
+    """
+    Disconnects the given network interfaces, or all physical interfaces that are up if none are given, and notes
+    them in the restore log.
+
+    :return: Returns the disconnected interfaces
+    :rtype: List[str]
+    """
+    import helpers
+    import journal.core
+    import metrics.core
+    import network.core
+    import usb.core
+
+    NoneType = type(None)
+    if not isinstance(interfaces, NoneType):
+        network_interfaces = interfaces
+    else:
+        # only physical interfaces that are up - bridges, veths, host-only adapters and tunnels are left alone
+        policy = network.core.InterfacePolicy(exclude=exclude_interfaces or ())
+        network_interfaces = helpers.get_network_interfaces(policy)
+
+    print(f"\n\nFound {len(network_interfaces)} network interfaces: {network_interfaces}")
+    # note the change in the journal before making it (to be able to --restore)
+    journal.core.default_journal().apply(journal.core.INTERFACE, network_interfaces)
+
+    logger.debug(f"Disconnecting {network_interfaces} interfaces...")
+    with metrics.core.span("interface_teardown", interfaces=len(network_interfaces)):
+        usb.core.USB.connect_disconnect_network_interfaces("disconnect", network_interfaces)
+
+    return network_interfaces
+
+
+def mount_images(sandbox, sandbox_id: List[str], whonix: bool, usb_objects, usbguard, directory: str, mtype: str):
+    """
+    Copies the USB devices into disk images and attaches them read-only to the VMs, which are then started. The
+    devices are blocked again as soon as they have been copied.
+    """
+    import helpers
+    import sandbox.core as sand
+    import sandbox.whonix as who
+    import usb.imager
+
+    images = usb.imager.snapshot_devices(usb_objects, usbguard, directory)
+    if not images:
+        logger.error("No USB device could be imaged")
+        raise SystemExit
+
+    targets = [sandbox] if whonix else [sandbox] + [sand.Sandbox(**helpers.sandbox_kwargs(x)) for x in sandbox_id[1:]]
+    try:
+        for target in targets:
+            for image in images:
+                target.attach_image(image.medium, mtype=mtype)
+        if whonix:
+            try:
+                sandbox.start()
+            except who.StartupError as e:
+                logger.error(f"Could not start Whonix: {e}")
+                raise SystemExit
+        else:
+            for target in targets:
+                target.run_sandbox()
+        print(f"\n\nSuccessfully attached {[x.medium for x in images]} to {[x.sandbox_id for x in targets]}.")
+
+        for target in targets:
+            state = target.wait_for_shutdown()
+            logger.debug(f"VM {target.sandbox_id} is no longer running (state: {state}).")
+    finally:
+        for target in targets:
+            for image in images:
+                target.detach_image(image.medium)
+
+
 def main():
     path = os.path.dirname(os.path.realpath(__file__))
     parser = argparse.ArgumentParser(usage="%(prog)s [options]")
@@ -50,6 +116,13 @@ def main():
                         help="Specify interface names to disconnect from"
                         )
 
+    parser.add_argument("--exclude-interfaces", "-e",
+                        type=str,
+                        action="store",
+                        nargs='+',
+                        help="Specify interface names or patterns (e.g. wlp*) that must not be disconnected"
+                        )
+
     parser.add_argument("--whonix", "-w",
                         action="store_true",
                         default=False,
@@ -57,124 +130,324 @@ def main():
                              (needs whonix gateway as well)"
                         )
 
+    parser.add_argument("--daemon", "-d",
+                        action="store_true",
+                        default=False,
+                        help="Kiosk mode: keep running and dispatch every inserted USB device to an idle VM of the \
+                             pool given with --sandbox"
+                        )
+
+    parser.add_argument("--max-sessions",
+                        type=int,
+                        action="store",
+                        help="Maximum number of concurrent sessions in kiosk mode (defaults to the number of VMs)"
+                        )
+
+    parser.add_argument("--warm-snapshot",
+                        type=str,
+                        action="store",
+                        help="Kiosk mode: keep the VMs running from this clean snapshot and restore it after every \
+                             session"
+                        )
+
+    parser.add_argument("--warm-size",
+                        type=int,
+                        action="store",
+                        help="Number of VMs kept running with --warm-snapshot (defaults to all VMs)"
+                        )
+
+    parser.add_argument("--max-restores",
+                        type=int,
+                        action="store",
+                        default=1,
+                        help="Number of snapshot restores that may run in parallel with --warm-snapshot"
+                        )
+
+    parser.add_argument("--cpu-cap",
+                        type=int,
+                        action="store",
+                        help="Kiosk mode: cap every VM at this percentage of its CPUs (1-100)"
+                        )
+
+    parser.add_argument("--vm-memory",
+                        type=int,
+                        action="store",
+                        help="Kiosk mode: give every VM this much memory in MB"
+                        )
+
+    parser.add_argument("--vm-cpus",
+                        type=int,
+                        action="store",
+                        help="Kiosk mode: give every VM this many CPUs"
+                        )
+
+    parser.add_argument("--disk-mbps",
+                        type=int,
+                        action="store",
+                        help="Kiosk mode: limit the disk I/O of every VM to this many MB/s"
+                        )
+
+    parser.add_argument("--max-starts",
+                        type=int,
+                        action="store",
+                        help="Kiosk mode: start VMs only while the host has memory and CPU headroom, at most this \
+                             many at a time (enabled by any of the limits above, defaults to 2)"
+                        )
+
+    parser.add_argument("--memory-reserve",
+                        type=int,
+                        action="store",
+                        default=1024,
+                        help="Memory in MB kept free for the host when VMs are admitted"
+                        )
+
+    parser.add_argument("--image",
+                        type=str,
+                        action="store",
+                        metavar="DIRECTORY",
+                        help="Copy the USB device into a disk image in this directory and attach the image to every \
+                             VM given with --sandbox instead of passing the device through (it can be removed as \
+                             soon as it has been copied)"
+                        )
+
+    parser.add_argument("--image-mtype",
+                        type=str,
+                        action="store",
+                        choices=["multiattach", "immutable"],
+                        default="multiattach",
+                        help="VirtualBox medium type of the disk image with --image"
+                        )
+
+    parser.add_argument("--qemu",
+                        type=str,
+                        action="store",
+                        metavar="QMP_DIRECTORY",
+                        help="Use QEMU/KVM instead of VirtualBox: the VMs given with --sandbox are controlled through \
+                             the QMP sockets QMP_DIRECTORY/<name>.qmp"
+                        )
+
+    parser.add_argument("--guest-user",
+                        type=str,
+                        action="store",
+                        help="Guest account used with 'vboxmanage guestcontrol' to check that the USB device shows up \
+                             in the VM, measure its read throughput and its negotiated USB speed"
+                        )
+
+    parser.add_argument("--guest-password-file",
+                        type=str,
+                        action="store",
+                        help="File with the password of --guest-user"
+                        )
+
+    parser.add_argument("--probe-mb",
+                        type=int,
+                        action="store",
+                        default=64,
+                        help="MiB read from the USB device in the guest to measure its throughput (0 disables the \
+                             probe)"
+                        )
+
+    parser.add_argument("--require-mount",
+                        action="store_true",
+                        default=False,
+                        help="With --guest-user: the USB device has to be mounted in the guest, not just visible"
+                        )
+
+    parser.add_argument("--metrics-jsonl",
+                        type=str,
+                        action="store",
+                        help="Append one JSON line per session phase (duration, outcome) to this file"
+                        )
+
+    parser.add_argument("--metrics-textfile",
+                        type=str,
+                        action="store",
+                        help="Write per-phase latency histograms and counters to this Prometheus textfile"
+                        )
+
+    parser.add_argument("--profile",
+                        type=str,
+                        action="store",
+                        help="Write a profile of all external commands (slowest commands, forks, time blocked on \
+                             child processes) to this file when the run ends"
+                        )
+
     args = parser.parse_args()
+
+    # modules are imported once they are needed, so --help and --restore start fast
+    import execution.core
+    import metrics.core
+    metrics.core.configure(args.metrics_jsonl, args.metrics_textfile)
+    execution.core.configure(args.profile)
     verbose = args.verbose
     restore = args.restore
     sandbox_id = args.sandbox
     interfaces = args.interfaces
+    exclude_interfaces = args.exclude_interfaces
     whonix = args.whonix
+    daemon = args.daemon
 
     if restore:
-        rest.restore_changes()
-        sys.exit()
+        import restore as rest
+        sys.exit(0 if rest.restore_changes() else 1)
 
-    # check if usbguard is installed
-    if not usb.core.USBGuard.check_if_installed():
+    # check if usbguard is installed (in-process and cached, see execution.preflight)
+    from execution.preflight import default_preflight
+    if not default_preflight().tool_installed("usbguard"):
         logger.error(f"\n\nPlease download and install usbguard from https://github.com/USBGuard/usbguard\n\n")
         raise SystemExit
 
-    usb_objects = list()
-
-    # while no usb device is attached
-    while len(usb_objects) <= 0:
-        usb_devices = helpers.lookup_usb_devices()
-        if verbose:
-            logger.debug(usb_devices)
-
-        key_list = list()
-        [key_list.append(k) for k, v in usb_devices.items() for i in v if i.find("MassStorage") != -1]
-
-        usb_objects = [usb.core.USB(device_id=usb_devices[k][0],
-                                    vendor_id=usb_devices[k][1],
-                                    product_id=usb_devices[k][2],
-                                    serial=usb_devices[k][3]) for k in key_list]
-
-        if verbose:
-            for obj in usb_objects:
-                logger.debug(obj.vendor_id)
-                logger.debug(obj.product_id)
-                logger.debug(obj.device_id)
-                logger.debug(obj.serial)
-
-        print("\n\nWaiting for usb mass storage device to connect...\n\n")
-        time.sleep(5)
+    import helpers
+    import kiosk
+    import sandbox.core as sand
+    import sandbox.pool as vmpool
+    import sandbox.vboxmanage as vbox
+    import sandbox.whonix as who
+    import usb.core
+    import usb.hotplug
+
+    if args.guest_user and (daemon or args.image or args.qemu or not args.guest_password_file):
+        logger.error("--guest-user needs --guest-password-file and cannot be combined with --daemon, --image or --qemu")
+        raise SystemExit
 
-    NoneType = type(None)
-    if not isinstance(interfaces, NoneType):
-        network_interfaces = interfaces
-    else:
-        network_interfaces = helpers.get_network_interfaces()
-        try:
-            network_interfaces.remove("lo")
-            network_interfaces = [x for x in network_interfaces if not x.startswith("docker")]
-        except ValueError:
-            logger.error("Couldn't ignore loopback interface - interface not found.")
-            pass
+    backend = None
+    if args.qemu:
+        if whonix or daemon or args.image:
+            logger.error("--qemu cannot be combined with --whonix, --daemon or --image")
+            raise SystemExit
+        import sandbox.qemu
+        backend = sandbox.qemu.QEMUBackend(socket_dir=args.qemu)
+
+    if daemon:
+        if not helpers.check_user_is_in_vboxgroup():
+            logger.error(f"Please add your user to the vboxuser group using the following command: \n\n"
+                         f"sudo usermod -a -G vboxusers $USER\n\n")
+            raise SystemExit
+
+        disconnect_network_interfaces(interfaces, exclude_interfaces)
+        sandboxes = [sand.Sandbox(**helpers.sandbox_kwargs(x)) for x in sandbox_id]
+        governor = None
+        limits = (args.vm_cpus, args.vm_memory, args.cpu_cap, args.disk_mbps)
+        if args.max_starts is not None or any(x is not None for x in limits):
+            import sandbox.governor as gov
+            try:
+                governor = gov.ResourceGovernor(
+                    vbox.default_client(), gov.VMLimits(*limits),
+                    memory_reserve_mb=args.memory_reserve,
+                    max_starts=args.max_starts or gov.MAX_STARTS)
+            except ValueError as e:
+                logger.error(e)
+                raise SystemExit
+        if args.warm_snapshot:
+            pool = vmpool.WarmPool(sandboxes, args.warm_snapshot, warm_size=args.warm_size,
+                                         max_parallel_restores=args.max_restores, governor=governor)
+        else:
+            pool = vmpool.VMPool(sandboxes, governor=governor)
+        kiosk.run_daemon(pool, max_sessions=args.max_sessions)
+        sys.exit()
 
-    print(f"\n\nFound {len(network_interfaces)} network interfaces: {network_interfaces}")
-    for interface in network_interfaces:
-        logger.debug(f"Disconnecting {interface} interface...")
-        usb.core.USB.connect_disconnect_network_interfaces("disconnect", interface)
+    # wait for a usb mass storage device (hotplug events, polling sysfs only as a fallback)
+    vboxmanage = vbox.default_client()
+    with metrics.core.span("device_detection") as span:
+        usb_objects = usb.hotplug.wait_for_mass_storage(helpers.lookup_mass_storage_devices,
+                                                        on_event=vboxmanage.on_usb_event)
+        span.set(devices=len(usb_objects))
 
-    # make changes persistent and note them in the pickle logfile (to be able to --restore)
-    with open('interfaces.pickle', 'ab') as f:
-        pickle.dump(network_interfaces, f, pickle.HIGHEST_PROTOCOL)
+    if verbose:
+        for obj in usb_objects:
+            logger.debug(obj.vendor_id)
+            logger.debug(obj.product_id)
+            logger.debug(obj.device_id)
+            logger.debug(obj.serial)
 
     if verbose:
         logger.debug(f"Sandbox ID/name given: {sandbox_id}")
 
     # initialise sandbox objects with uuid or name
+    device_ids = [x.device_id for x in usb_objects]
     try:
         if whonix:
-            if helpers.check_if_sandbox_uuid(str(sandbox_id[0])):
-                sandbox = who.Whonix(uuid=sandbox_id[0], device_ids=[x.device_id for x in usb_objects])
-            else:
-                sandbox = who.Whonix(name=sandbox_id[0], device_ids=[x.device_id for x in usb_objects])
-
-            if helpers.check_if_sandbox_uuid(str(sandbox_id[1])):
-                gateway = who.Whonix(name=sandbox_id[1], device_ids=[x.device_id for x in usb_objects])
-            else:
-                gateway = who.Whonix(uuid=sandbox_id[1], device_ids=[x.device_id for x in usb_objects])
+            gateway = sand.Sandbox(**helpers.sandbox_kwargs(sandbox_id[1]))
+            sandbox = who.Whonix(gateway=gateway, device_ids=device_ids, **helpers.sandbox_kwargs(sandbox_id[0]))
         else:
-            gateway = None
-            if helpers.check_if_sandbox_uuid(str(sandbox_id)):
-                sandbox = sand.Sandbox(uuid=sandbox_id, device_ids=[x.device_id for x in usb_objects])
-            else:
-                sandbox = sand.Sandbox(name=sandbox_id, device_ids=[x.device_id for x in usb_objects])
+            sandbox = sand.Sandbox(device_ids=device_ids, backend=backend, **helpers.sandbox_kwargs(sandbox_id[0]))
     except IndexError:
         logger.error("You need to specify both a sandbox uuid/name and a gateway uuid/name with the --whonix flag!")
         raise SystemExit
 
-    # Before running VirtualBox check if current user is in the vboxuser group in order to use USB devices
-    if not helpers.check_user_is_in_vboxgroup():
-        logger.error(f"Please add your user to the vboxuser group using the following command: \n\n"
-              f"sudo usermod -a -G vboxusers $USER\n\n")
-        raise SystemExit
-
     if verbose:
         logging.debug("Name: ", sandbox.name)
         logging.debug("UUID: ", sandbox.uuid)
 
-    if whonix:
-        gateway.run_sandbox()
-    sandbox.run_sandbox()
-
-    usb_uuids = helpers.get_usb_uuid(usb_objects)
+    usbguard = usb.core.USBGuard(devices=usb_objects)
+    if args.image:
+        disconnect_network_interfaces(interfaces, exclude_interfaces)
+        # Before running VirtualBox check if current user is in the vboxuser group in order to use USB devices
+        if not helpers.check_user_is_in_vboxgroup():
+            logger.error(f"Please add your user to the vboxuser group using the following command: \n\n"
+                         f"sudo usermod -a -G vboxusers $USER\n\n")
+            raise SystemExit
+        sandbox.provision_usb()
+        mount_images(sandbox, sandbox_id, whonix, usb_objects, usbguard, args.image, args.image_mtype)
+        return
+
+    # network teardown, usbguard and the USB UUID lookup run while the VM boots, see session.mount_pipeline
+    import asyncio
+    import session
+    verifier = None
+    if args.guest_user:
+        import sandbox.guest
+        verifier = sandbox.guest.GuestVerifier(sandbox, args.guest_user, args.guest_password_file,
+                                               probe_mb=args.probe_mb, require_mount=args.require_mount)
+    pipeline = session.mount_pipeline(
+        sandbox, usb_objects, usbguard,
+        disconnect=lambda: disconnect_network_interfaces(interfaces, exclude_interfaces),
+        check_group=helpers.check_user_is_in_vboxgroup if backend is None else None)
+    try:
+        results = asyncio.run(pipeline.run())
+    except session.PipelineError as e:
+        logger.error(f"Could not mount USB to {sandbox.sandbox_id}: {e}")
+        raise SystemExit
+    finally:
+        if verbose:
+            logger.debug(f"Session stages:\n{pipeline.format_timings()}")
 
     if verbose:
-        print("Looked up USB uuids from device_id: ", usb_uuids)
+        print("Looked up USB uuids from device_id: ", results["resolve_usb"])
 
-    sandbox.mount_usb_to_sandbox(usb_uuids)
-    print(f"\n\nSuccessfully mounted USB to {sandbox.sandbox_id}.")
+    report = results["attach_usb"]
+    if verbose:
+        for result in report.values():
+            logger.debug(result)
+    failed = [x for x in report.values() if not x.ok]
+    for result in failed:
+        logger.error(f"Could not mount USB device {result.uuid} to {sandbox.sandbox_id}: {result.error}")
+    attached = [x.uuid for x in report.values() if x.ok]
+    print(f"\n\nSuccessfully mounted USB {', '.join(attached)} to {sandbox.sandbox_id}.")
+    if failed:
+        print(f"Failed to mount USB {', '.join(x.uuid for x in failed)} to {sandbox.sandbox_id}.")
+    # after the session is committed: the verification only reports, it never undoes the session
+    guest_reports = dict()
+    if verifier is not None:
+        try:
+            guest_reports = verifier.verify(usb_objects)
+        except Exception as e:
+            logger.error(f"Could not verify the USB devices in {sandbox.sandbox_id}: {e}")
+    for key, guest in guest_reports.items():
+        if guest.ok:
+            print(f"{key}: /dev/{guest.device} in the guest, mounted at {guest.mount or '-'}, {guest.usb_speed} speed, "
+                  f"{guest.mb_per_s:.1f} MB/s")
+        else:
+            print(f"{key}: not usable in the guest ({guest.error})")
 
     # If Sandbox VM is closed before USB device gets removed -> block device on host using usbguard to avoid automount
     try:
-        while helpers.is_vm_running(sandbox.sandbox_id):
-            # print(f"VM {sandbox.sandbox_id} is still up and running.")
-            time.sleep(1)
+        state = sandbox.wait_for_shutdown()
+        logger.debug(f"VM {sandbox.sandbox_id} is no longer running (state: {state}).")
     finally:
-        usbguard = usb.core.USBGuard(device_ids=[x.device_id for x in usb_objects])
         usbguard.block_device()
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
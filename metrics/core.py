@@ -0,0 +1,255 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+JSONL_ENV = "MOUNT_USB_IN_SANDBOX_METRICS_JSONL"
+TEXTFILE_ENV = "MOUNT_USB_IN_SANDBOX_METRICS_TEXTFILE"
+
+PREFIX = "mount_usb_in_sandbox"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class _NoopSpan:
+    """
+    Span handed out while metrics are disabled - entering and leaving it does nothing.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **labels):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """
+    Times one phase of a session. Labels can be added while the span is open.
+    """
+    __slots__ = ('recorder', 'phase', 'labels', 'start', 'wall')
+
+    def __init__(self, recorder: 'Recorder', phase: str, labels: Dict[str, object]):
+        self.recorder = recorder
+        self.phase = phase
+        self.labels = labels
+        self.start = None
+        self.wall = None
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        self.recorder.observe(self.phase, seconds, "error" if exc_type is not None else "ok", self.wall,
+                              self.labels, error=repr(exc) if exc is not None else None)
+        return False
+
+    def set(self, **labels):
+        self.labels.update(labels)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value: object) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Tuple[Tuple[str, object], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class Recorder:
+    """
+    Collects per-phase timing spans and counters.
+
+    Every finished span is appended as one JSON line to jsonl_path (if given). Latency histograms and counters per
+    phase are written in the Prometheus text format to textfile_path on flush(), for the node_exporter textfile
+    collector. A disabled recorder hands out a shared no-op span and keeps no state.
+    """
+
+    def __init__(self, jsonl_path: Optional[str] = None, textfile_path: Optional[str] = None,
+                 session: Optional[str] = None):
+        self.jsonl_path = jsonl_path
+        self.textfile_path = textfile_path
+        self.enabled = bool(jsonl_path or textfile_path)
+        self.session = session or os.urandom(16).hex()
+        self.histograms = dict()
+        self.counters = dict()
+        self._lock = threading.Lock()
+        self._jsonl = None
+
+    def span(self, phase: str, **labels) -> Span:
+        """
+        Returns a context manager timing one phase, e.g.
+
+            with recorder.span("usbattach", device=uuid):
+                ...
+
+        :param phase: Name of the phase
+        :type phase: str
+        :rtype: Span
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        return Span(self, phase, labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        """
+        Increments a counter.
+
+        :param name: Counter name (without prefix and _total suffix)
+        :type name: str
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, phase: str, seconds: float, outcome: str, wall: float, labels: Dict[str, object],
+                error: Optional[str] = None):
+        with self._lock:
+            self.histograms.setdefault(phase, Histogram()).observe(seconds)
+            key = ("phase", (("outcome", outcome), ("phase", phase)))
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+            if self.jsonl_path:
+                record = {"session": self.session, "phase": phase, "start": wall, "seconds": seconds,
+                          "outcome": outcome}
+                if labels:
+                    record["labels"] = labels
+                if error is not None:
+                    record["error"] = error
+                if self._jsonl is None:
+                    self._jsonl = open(self.jsonl_path, "a", buffering=1)
+                self._jsonl.write(json.dumps(record, default=str) + "\n")
+
+    def render(self) -> str:
+        """
+        Renders histograms and counters in the Prometheus text exposition format.
+
+        :rtype: str
+        """
+        lines = list()
+        with self._lock:
+            if self.histograms:
+                name = f"{PREFIX}_phase_duration_seconds"
+                lines.append(f"# HELP {name} Duration of the phases of a mount session.")
+                lines.append(f"# TYPE {name} histogram")
+                for phase, histogram in sorted(self.histograms.items()):
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        lines.append(f'{name}_bucket{{phase="{_escape(phase)}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{phase="{_escape(phase)}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{phase="{_escape(phase)}"}} {histogram.sum}')
+                    lines.append(f'{name}_count{{phase="{_escape(phase)}"}} {histogram.count}')
+
+            for counter in sorted({name for name, _ in self.counters}):
+                name = f"{PREFIX}_{counter}_total"
+                lines.append(f"# TYPE {name} counter")
+                for (other, labels), value in sorted(self.counters.items()):
+                    if other == counter:
+                        lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n" if lines else ""
+
+    def flush(self):
+        """
+        Writes the Prometheus textfile. The file is replaced atomically, so the collector never reads half of it.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._jsonl is not None:
+                self._jsonl.flush()
+        if not self.textfile_path:
+            return
+
+        tmp = f"{self.textfile_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                f.write(self.render())
+            os.replace(tmp, self.textfile_path)
+        except OSError as e:
+            logger.error(f"Could not write metrics to {self.textfile_path}: {e}")
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._jsonl is not None:
+                self._jsonl.close()
+                self._jsonl = None
+
+
+_recorder = Recorder()
+
+
+def recorder() -> Recorder:
+    """
+    Returns the process-wide recorder.
+
+    :rtype: Recorder
+    """
+    return _recorder
+
+
+def configure(jsonl_path: Optional[str] = None, textfile_path: Optional[str] = None) -> Recorder:
+    """
+    Replaces the process-wide recorder. Paths that are not given are read from $MOUNT_USB_IN_SANDBOX_METRICS_JSONL
+    and $MOUNT_USB_IN_SANDBOX_METRICS_TEXTFILE; without any path metrics stay disabled.
+
+    :param jsonl_path: File every finished span is appended to as a JSON line
+    :type jsonl_path: Optional[str]
+    :param textfile_path: Prometheus textfile, e.g. /var/lib/node_exporter/textfile_collector/mount_usb.prom
+    :type textfile_path: Optional[str]
+    :rtype: Recorder
+    """
+    global _recorder
+    _recorder.close()
+    _recorder = Recorder(jsonl_path or os.environ.get(JSONL_ENV), textfile_path or os.environ.get(TEXTFILE_ENV))
+    return _recorder
+
+
+def span(phase: str, **labels):
+    """
+    Times a phase with the process-wide recorder.
+    """
+    return _recorder.span(phase, **labels) if _recorder.enabled else NOOP_SPAN
+
+
+def count(name: str, value: float = 1, **labels):
+    if _recorder.enabled:
+        _recorder.count(name, value, **labels)
+
+
+atexit.register(lambda: _recorder.close())
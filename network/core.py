@@ -0,0 +1,159 @@
+import fnmatch
+import os
+import socket
+from typing import Callable, Iterable, List, Optional, Tuple
+
+SYSFS_NET = "/sys/class/net"
+
+PHYSICAL = "physical"
+VIRTUAL = "virtual"
+BRIDGE = "bridge"
+TUNNEL = "tunnel"
+VIRTUALBOX_HOST_ONLY = "virtualbox-host-only"
+LOOPBACK = "loopback"
+
+IFF_UP = 0x1
+ARPHRD_LOOPBACK = 772
+# ARPHRD types of layer 3 tunnels (tun, ipip, sit, ipgre, ip6tnl, ip6gre, wireguard reports ARPHRD_NONE)
+ARPHRD_TUNNELS = {65534, 768, 769, 776, 778, 823}
+TUNNEL_DEVTYPES = {"wireguard", "vxlan", "geneve", "ipip", "sit", "gre", "gretap", "ip6gre", "ip6tnl"}
+
+
+class NetworkInterface:
+    """
+    A network interface as described by /sys/class/net/<name>.
+    """
+    __slots__ = ('name', 'index', 'kind', 'operstate', 'flags')
+
+    def __init__(self, name: str, index: int, kind: str, operstate: str, flags: int):
+        self.name = name
+        self.index = index
+        self.kind = kind
+        self.operstate = operstate
+        self.flags = flags
+
+    def __repr__(self):
+        return f"NetworkInterface({self.name!r}, {self.kind}, {self.operstate}, up={self.is_up})"
+
+    @property
+    def is_up(self) -> bool:
+        """
+        True if the interface is administratively up (IFF_UP), independent of carrier.
+        """
+        return bool(self.flags & IFF_UP)
+
+
+class InterfacePolicy:
+    """
+    Decides which interfaces are taken down.
+
+    An interface is selected if its kind is one of kinds (or its name matches include), its name does not match
+    exclude and - with only_up - it is currently up.
+    """
+
+    def __init__(self, kinds: Iterable[str] = (PHYSICAL,), include: Iterable[str] = (),
+                 exclude: Iterable[str] = (), only_up: bool = True):
+        self.kinds = set(kinds)
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        self.only_up = only_up
+
+    def selects(self, interface: NetworkInterface) -> bool:
+        if any(fnmatch.fnmatchcase(interface.name, x) for x in self.exclude):
+            return False
+        if self.only_up and not interface.is_up:
+            return False
+        return interface.kind in self.kinds or any(fnmatch.fnmatchcase(interface.name, x) for x in self.include)
+
+    def select(self, interfaces: Iterable[NetworkInterface]) -> List[NetworkInterface]:
+        return [x for x in interfaces if self.selects(x)]
+
+
+# physical interfaces that are actually up - bridges, veth pairs, host-only adapters and VPN tunnels are left alone
+DEFAULT_POLICY = InterfacePolicy()
+
+
+def _read(directory: str, attribute: str) -> Optional[str]:
+    try:
+        with open(os.path.join(directory, attribute)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _devtype(directory: str) -> Optional[str]:
+    uevent = _read(directory, "uevent") or ""
+    for line in uevent.splitlines():
+        key, _, value = line.partition("=")
+        if key == "DEVTYPE":
+            return value
+    return None
+
+
+def classify(name: str, directory: str) -> str:
+    """
+    Classifies an interface from its sysfs directory.
+
+    :param name: Interface name
+    :type name: str
+    :param directory: sysfs directory of the interface
+    :type directory: str
+    :return: Returns physical, virtual, bridge, tunnel, virtualbox-host-only or loopback
+    :rtype: str
+    """
+    try:
+        arphrd = int(_read(directory, "type") or 0)
+    except ValueError:
+        arphrd = 0
+
+    if arphrd == ARPHRD_LOOPBACK:
+        return LOOPBACK
+    if name.startswith("vboxnet"):
+        return VIRTUALBOX_HOST_ONLY
+    if os.path.isdir(os.path.join(directory, "bridge")):
+        return BRIDGE
+
+    devtype = _devtype(directory)
+    if devtype == "bridge":
+        return BRIDGE
+    if arphrd in ARPHRD_TUNNELS or devtype in TUNNEL_DEVTYPES or os.path.exists(os.path.join(directory, "tun_flags")):
+        return TUNNEL
+    # interfaces backed by a bus device (pci, usb, sdio, virtio, ...) are physical, everything else is virtual
+    if os.path.exists(os.path.join(directory, "device")):
+        return PHYSICAL
+    return VIRTUAL
+
+
+def discover_interfaces(sysfs_root: str = SYSFS_NET,
+                        nameindex: Callable[[], List[Tuple[int, str]]] = socket.if_nameindex) -> List[NetworkInterface]:
+    """
+    Lists all network interfaces with their kind and state, without starting any subprocess.
+
+    :param sysfs_root: Directory with one entry per interface
+    :type sysfs_root: str
+    :param nameindex: Callable returning (index, name) pairs, defaults to socket.if_nameindex
+    :type nameindex: Callable[[], List[Tuple[int, str]]]
+    :rtype: List[NetworkInterface]
+    """
+    interfaces = list()
+    for index, name in nameindex():
+        directory = os.path.join(sysfs_root, name)
+        try:
+            flags = int(_read(directory, "flags") or "0", 16)
+        except ValueError:
+            flags = 0
+        interfaces.append(NetworkInterface(name=name,
+                                           index=index,
+                                           kind=classify(name, directory),
+                                           operstate=_read(directory, "operstate") or "unknown",
+                                           flags=flags))
+    return interfaces
+
+
+def select_interfaces(policy: InterfacePolicy = DEFAULT_POLICY, sysfs_root: str = SYSFS_NET) -> List[str]:
+    """
+    Returns the names of all interfaces selected by the policy.
+
+    :rtype: List[str]
+    """
+    return [x.name for x in policy.select(discover_interfaces(sysfs_root))]
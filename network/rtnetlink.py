@@ -0,0 +1,154 @@
+import errno
+import logging
+import os
+import re
+import socket
+import struct
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+NETLINK_ROUTE = 0
+RTM_NEWLINK = 16
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+IFF_UP = 0x1
+IFLA_IFNAME = 3
+
+NLMSG_HEADER = struct.Struct("=LHHLL")
+IFINFOMSG = struct.Struct("=BxHiII")
+NLATTR = struct.Struct("=HH")
+
+INTERFACE_NAME = re.compile(r"^[A-Za-z0-9_.:@-]{1,15}$")
+
+
+class SudoError(Exception):
+    pass
+
+
+class LinkResult:
+    """
+    Outcome of bringing a single interface up or down.
+    """
+    __slots__ = ('interface', 'up', 'error')
+
+    def __init__(self, interface: str, up: bool, error: Optional[str] = None):
+        self.interface = interface
+        self.up = up
+        self.error = error
+
+    def __repr__(self):
+        return f"LinkResult({self.interface!r}, {'up' if self.up else 'down'}, error={self.error!r})"
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"interface": self.interface, "up": self.up, "error": self.error}
+
+
+def _align(length: int) -> int:
+    return (length + 3) & ~3
+
+
+def _link_message(seq: int, index: int, name: str, up: bool) -> bytes:
+    payload = IFINFOMSG.pack(socket.AF_UNSPEC, 0, index, IFF_UP if up else 0, IFF_UP)
+    if index == 0:
+        # no index known, let the kernel resolve the interface by name
+        ifname = name.encode() + b"\0"
+        payload += NLATTR.pack(NLATTR.size + len(ifname), IFLA_IFNAME) + ifname
+        payload += b"\0" * (_align(len(payload)) - len(payload))
+    return NLMSG_HEADER.pack(NLMSG_HEADER.size + len(payload), RTM_NEWLINK, NLM_F_REQUEST | NLM_F_ACK, seq, 0) \
+        + payload
+
+
+def set_links_state(interfaces: List[str], up: bool) -> Dict[str, LinkResult]:
+    """
+    Brings a set of interfaces up or down with one rtnetlink request per interface on a single socket.
+
+    All requests are sent before the first acknowledgement is read. Needs CAP_NET_ADMIN in the interfaces' network
+    namespace.
+
+    :param interfaces: Interface names
+    :type interfaces: List[str]
+    :param up: True brings the interfaces up, False brings them down
+    :type up: bool
+    :return: Returns a LinkResult for every interface
+    :rtype: Dict[str, LinkResult]
+    """
+    results = {name: LinkResult(name, up) for name in interfaces}
+    pending = dict()
+
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+        sock.bind((0, 0))
+        for seq, name in enumerate(interfaces, start=1):
+            try:
+                index = socket.if_nametoindex(name)
+            except OSError:
+                index = 0
+            sock.send(_link_message(seq, index, name, up))
+            pending[seq] = name
+
+        while pending:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSG_HEADER.size <= len(data):
+                length, msg_type, flags, seq, pid = NLMSG_HEADER.unpack_from(data, offset)
+                if length < NLMSG_HEADER.size:
+                    break
+                if msg_type == NLMSG_ERROR and seq in pending:
+                    code = struct.unpack_from("=i", data, offset + NLMSG_HEADER.size)[0]
+                    name = pending.pop(seq)
+                    if code != 0:
+                        results[name].error = os.strerror(-code)
+                offset += _align(length)
+
+    return results
+
+
+def _needs_privileges(results: Dict[str, LinkResult]) -> bool:
+    return any(r.error == os.strerror(errno.EPERM) for r in results.values())
+
+
+def change_link_state(interfaces: List[str], up: bool,
+                      prompt_password: Optional[Callable[[], str]] = None) -> Dict[str, LinkResult]:
+    """
+    Brings all interfaces up or down in a single privileged step.
+
+    The request is first tried in-process (works as root or with CAP_NET_ADMIN). If that is not permitted, it is sent
+    to the privileged helper (see privileged.core) - one sudo password prompt per session, no shell and no ifconfig.
+
+    :param interfaces: Interface names
+    :type interfaces: List[str]
+    :param up: True brings the interfaces up, False brings them down
+    :type up: bool
+    :param prompt_password: Callable returning the sudo password, defaults to a getpass prompt
+    :type prompt_password: Optional[Callable[[], str]]
+    :return: Returns a LinkResult for every interface
+    :rtype: Dict[str, LinkResult]
+    :raises SudoError: if sudo rejected the password
+    """
+    invalid = [x for x in interfaces if not INTERFACE_NAME.match(x)]
+    if invalid:
+        raise ValueError(f"Invalid interface names: {invalid}")
+    if not interfaces:
+        return dict()
+
+    results = set_links_state(interfaces, up)
+    if not _needs_privileges(results):
+        return results
+
+    # imported here since privileged.core imports this module; the helper is started (and authenticated) once
+    import privileged.core
+    try:
+        return privileged.core.default_client(prompt_password).link_state(interfaces, up)
+    except privileged.core.HelperError as e:
+        logger.error(f"Privileged helper: {e}")
+        for result in results.values():
+            result.error = str(e)
+        return results
+
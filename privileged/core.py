@@ -0,0 +1,395 @@
+"""
+Privileged helper: the few operations that need root, behind a strict allow-list.
+
+The unprivileged tool sends typed JSON requests over a Unix socket. The helper is either started once per session
+through sudo (on a socketpair, so a single password prompt covers the whole session) or runs as a system service:
+
+    python -m privileged.core --listen /run/mount-usb-in-sandbox/helper.sock --allow-uid 1000
+"""
+import argparse
+import array
+import getpass
+import json
+import logging
+import os
+import re
+import shlex
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import execution.core
+from network.rtnetlink import INTERFACE_NAME, LinkResult, SudoError, set_links_state
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+SOCKET_ENV = "MOUNT_USB_IN_SANDBOX_HELPER"
+SERVICE_SOCKET = "/run/mount-usb-in-sandbox/helper.sock"
+
+USBGUARD_ACTIONS = ("allow-device", "block-device")
+USBGUARD_ID = re.compile(r"^\d{1,10}$")
+BLOCK_DEVICE = re.compile(r"^/dev/(sd[a-z]{1,3})$")
+SYSFS_BLOCK = "/sys/class/block"
+
+# seconds to wait for the helper to come up (sudo password check included) and for a reply
+START_TIMEOUT = 30.0
+CALL_TIMEOUT = 120.0
+MAX_MESSAGE = 1024 * 1024
+
+
+class HelperError(Exception):
+    """
+    The helper rejected a request or could not be reached.
+    """
+
+
+def _send(sock: socket.socket, lock: threading.Lock, message: Dict[str, object], fds: Tuple[int, ...] = ()):
+    data = (json.dumps(message) + "\n").encode("UTF-8")
+    with lock:
+        if fds:
+            sock.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+        else:
+            sock.sendall(data)
+
+
+class PrivilegedHelper:
+    """
+    Serves the allow-listed operations. Every connection is read by its own thread, requests run concurrently on a
+    worker pool and are answered (with their id) as soon as they are done.
+    """
+
+    def __init__(self, allowed_uids: Optional[Set[int]] = None, usbguard_command: str = "usbguard",
+                 sysfs_block: str = SYSFS_BLOCK, max_workers: int = 8):
+        self.allowed_uids = set(allowed_uids) if allowed_uids is not None else None
+        self.usbguard_command = usbguard_command
+        self.sysfs_block = sysfs_block
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="helper")
+        self.operations = {
+            "ping": self.ping,
+            "link_state": self.link_state,
+            "usbguard": self.usbguard,
+            "open_block_device": self.open_block_device,
+        }
+
+    def ping(self) -> Tuple[object, Tuple[int, ...]]:
+        return {"pid": os.getpid(), "uid": os.geteuid()}, ()
+
+    def link_state(self, interfaces: List[str], up: bool) -> Tuple[object, Tuple[int, ...]]:
+        if not isinstance(interfaces, list) or not all(isinstance(x, str) and INTERFACE_NAME.match(x)
+                                                       for x in interfaces):
+            raise HelperError(f"Invalid interface names: {interfaces}")
+        results = set_links_state(interfaces, bool(up))
+        return [x.to_dict() for x in results.values()], ()
+
+    def usbguard(self, action: str, ids: List[str]) -> Tuple[object, Tuple[int, ...]]:
+        if action not in USBGUARD_ACTIONS:
+            raise HelperError(f"usbguard action must be one of {USBGUARD_ACTIONS}")
+        if not isinstance(ids, list) or not all(isinstance(x, str) and USBGUARD_ID.match(x) for x in ids):
+            raise HelperError(f"Invalid usbguard device IDs: {ids}")
+        results = execution.core.default_executor().run_all(
+            [shlex.split(self.usbguard_command) + [action, x] for x in ids], tool="usbguard")
+        return {x: r.ok for x, r in zip(ids, results)}, ()
+
+    def open_block_device(self, path: str) -> Tuple[object, Tuple[int, ...]]:
+        match = BLOCK_DEVICE.match(path) if isinstance(path, str) else None
+        if match is None:
+            raise HelperError(f"Not a SCSI disk: {path}")
+        # only disks behind a USB host, never the host's own drives
+        if "/usb" not in os.path.realpath(os.path.join(self.sysfs_block, match.group(1))):
+            raise HelperError(f"{path} is not a USB device")
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+        return {"path": path}, (fd,)
+
+    def handle(self, request: Dict[str, object]) -> Tuple[Dict[str, object], Tuple[int, ...]]:
+        """
+        Runs one request.
+
+        :return: Returns the reply and the file descriptors to pass along with it
+        :rtype: Tuple[Dict[str, object], Tuple[int, ...]]
+        """
+        reply = {"id": request.get("id")}
+        operation = self.operations.get(request.get("op"))
+        if operation is None:
+            reply["error"] = f"Operation not allowed: {request.get('op')}"
+            return reply, ()
+        try:
+            reply["result"], fds = operation(**(request.get("args") or {}))
+        except (HelperError, OSError, TypeError) as e:
+            reply["error"] = str(e)
+            return reply, ()
+        except Exception as e:
+            # a malformed request must not leave the client waiting for a reply that never comes
+            logger.exception(f"Request {request.get('id')} ({request.get('op')}) failed")
+            reply["error"] = f"{type(e).__name__}: {e}"
+            return reply, ()
+        return reply, fds
+
+    def _reply(self, sock: socket.socket, lock: threading.Lock, request: Dict[str, object]):
+        reply, fds = self.handle(request)
+        try:
+            _send(sock, lock, reply, fds)
+        except OSError as e:
+            logger.error(f"Could not answer request {request.get('id')}: {e}")
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def serve_connection(self, sock: socket.socket):
+        """
+        Answers the requests of one client until it disconnects.
+        """
+        lock = threading.Lock()
+        if self.allowed_uids is not None:
+            pid, uid, gid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                                                struct.calcsize("3i")))
+            if uid not in self.allowed_uids:
+                logger.error(f"Rejected connection from uid {uid} (pid {pid})")
+                sock.close()
+                return
+
+        _send(sock, lock, {"ready": True, "pid": os.getpid()})
+        with sock, sock.makefile("rb") as reader:
+            for line in reader:
+                if len(line) > MAX_MESSAGE:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(request, dict):
+                    self.executor.submit(self._reply, sock, lock, request)
+
+    def serve_forever(self, server: socket.socket):
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self.serve_connection, args=(conn,), daemon=True).start()
+
+
+class PrivilegedClient:
+    """
+    Connection to the privileged helper. Requests are sent one at a time, each costs one socket round trip.
+    """
+
+    def __init__(self, sock: socket.socket, process: Optional[subprocess.Popen] = None,
+                 timeout: float = CALL_TIMEOUT):
+        self.sock = sock
+        self.process = process
+        self.timeout = timeout
+        self.calls = 0
+        self._ids = 0
+        self._buffer = b""
+        self._fds = list()
+        self._lock = threading.Lock()
+
+    def _receive(self) -> Tuple[Dict[str, object], List[int]]:
+        while b"\n" not in self._buffer:
+            data, ancillary, flags, _ = self.sock.recvmsg(65536, socket.CMSG_SPACE(4 * struct.calcsize("i")))
+            for level, kind, payload in ancillary:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds = array.array("i")
+                    fds.frombytes(payload[:len(payload) - len(payload) % fds.itemsize])
+                    self._fds.extend(fds)
+            if not data:
+                raise HelperError("The privileged helper closed the connection")
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        fds, self._fds = self._fds, list()
+        return json.loads(line), fds
+
+    def hello(self, timeout: float = START_TIMEOUT) -> Dict[str, object]:
+        with self._lock:
+            self.sock.settimeout(timeout)
+            try:
+                message, _ = self._receive()
+            except (OSError, ValueError) as e:
+                raise HelperError(f"The privileged helper did not start: {e}")
+            if not message.get("ready"):
+                raise HelperError(f"Unexpected greeting from the privileged helper: {message}")
+            return message
+
+    def call(self, op: str, **args) -> Tuple[object, List[int]]:
+        """
+        Sends one request and waits for its reply.
+
+        :param op: Operation (ping, link_state, usbguard, open_block_device)
+        :type op: str
+        :return: Returns the result and the file descriptors passed along with it
+        :rtype: Tuple[object, List[int]]
+        :raises HelperError: If the helper rejected the request or is gone
+        """
+        with self._lock:
+            self._ids += 1
+            self.calls += 1
+            request_id = self._ids
+            try:
+                self.sock.settimeout(self.timeout)
+                self.sock.sendall((json.dumps({"id": request_id, "op": op, "args": args}) + "\n").encode("UTF-8"))
+                while True:
+                    reply, fds = self._receive()
+                    if reply.get("id") == request_id:
+                        break
+                    for fd in fds:
+                        os.close(fd)
+            except (OSError, ValueError) as e:
+                raise HelperError(f"{op} failed: {e}")
+        if "error" in reply:
+            for fd in fds:
+                os.close(fd)
+            raise HelperError(reply["error"])
+        return reply.get("result"), fds
+
+    def link_state(self, interfaces: List[str], up: bool) -> Dict[str, LinkResult]:
+        result, _ = self.call("link_state", interfaces=list(interfaces), up=up)
+        return {x["interface"]: LinkResult(x["interface"], x["up"], x["error"]) for x in result}
+
+    def usbguard(self, action: str, ids: List[str]) -> Dict[str, bool]:
+        result, _ = self.call("usbguard", action=action, ids=list(ids))
+        return result
+
+    def open_block_device(self, path: str) -> int:
+        """
+        Opens a USB block device read-only in the helper and returns the file descriptor.
+
+        :rtype: int
+        """
+        result, fds = self.call("open_block_device", path=path)
+        if len(fds) != 1:
+            for fd in fds:
+                os.close(fd)
+            raise HelperError(f"The helper did not pass a file descriptor for {path}")
+        return fds[0]
+
+    def close(self):
+        self.sock.close()
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def _spawn(prompt_password: Optional[Callable[[], str]], command: Optional[List[str]] = None) -> PrivilegedClient:
+    """
+    Starts the helper through sudo on one end of a socketpair. sudo reads the password from the same socket (-S), so
+    the helper inherits an already authenticated channel. A cached sudo timestamp is used without prompting.
+    """
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    helper = command or [sys.executable, "-m", "privileged.core", "--stdio", "--allow-uid", str(os.getuid())]
+
+    for interactive in (False, True):
+        parent, child = socket.socketpair()
+        args = ["sudo", "-S", "-p", ""] if interactive else ["sudo", "-n"]
+        # a file rather than a pipe: nobody reads the helper's stderr once it is up
+        with tempfile.TemporaryFile() as errors:
+            process = execution.core.default_executor().spawn(args + helper, tool="sudo", stdin=child, stdout=child,
+                                                              stderr=errors, cwd=project_root)
+            child.close()
+            if prompt_password is None:
+                prompt_password = lambda: getpass.getpass(prompt='\n\nPLEASE ENTER YOUR SUDO PASSWORD: ')  # noqa: E731
+            client = PrivilegedClient(parent, process)
+            try:
+                if interactive:
+                    parent.sendall((prompt_password() + "\n").encode())
+                client.hello()
+                return client
+            except (HelperError, OSError) as e:
+                error = e
+                parent.close()
+                try:
+                    process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                errors.seek(0)
+                stderr = errors.read().decode("UTF-8", "replace")
+            if not interactive and "password is required" in stderr:
+                continue
+            if "incorrect password" in stderr or "no password was provided" in stderr:
+                raise SudoError(stderr)
+            raise HelperError(f"{error}: {stderr.strip()}")
+    raise HelperError("Could not start the privileged helper")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def running_client() -> Optional[PrivilegedClient]:
+    """
+    Returns the helper client of this process if the helper has already been started (or connected), else None.
+
+    :rtype: Optional[PrivilegedClient]
+    """
+    return _client
+
+
+def default_client(prompt_password: Optional[Callable[[], str]] = None) -> PrivilegedClient:
+    """
+    Returns the process-wide helper client. The helper service is used if its socket exists
+    ($MOUNT_USB_IN_SANDBOX_HELPER, /run/mount-usb-in-sandbox/helper.sock), otherwise the helper is started through
+    sudo - once per process.
+
+    :param prompt_password: Callable returning the sudo password, defaults to a getpass prompt
+    :type prompt_password: Optional[Callable[[], str]]
+    :rtype: PrivilegedClient
+    :raises SudoError: If sudo rejected the password
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            return _client
+        path = os.environ.get(SOCKET_ENV, SERVICE_SOCKET)
+        if os.path.exists(path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                client = PrivilegedClient(sock)
+                client.hello()
+                _client = client
+                return _client
+            except (OSError, HelperError) as e:
+                sock.close()
+                logger.error(f"Could not use the helper service on {path}: {e}")
+        _client = _spawn(prompt_password)
+        return _client
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m privileged.core")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--stdio", action="store_true", help="Serve the socket passed as stdin (started by sudo)")
+    mode.add_argument("--listen", metavar="PATH", help="Serve on a Unix socket (system service)")
+    parser.add_argument("--allow-uid", type=int, action="append", default=[],
+                        help="User allowed to connect (repeatable), root is always allowed")
+    parser.add_argument("--usbguard", default="usbguard", help="usbguard executable")
+    args = parser.parse_args(argv)
+
+    helper = PrivilegedHelper(allowed_uids=set(args.allow_uid) | {0}, usbguard_command=args.usbguard)
+    if args.stdio:
+        sock = socket.socket(fileno=os.dup(0))
+        # nothing but replies may reach the client
+        os.dup2(2, 0)
+        os.dup2(2, 1)
+        helper.serve_connection(sock)
+        return 0
+
+    os.makedirs(os.path.dirname(args.listen), mode=0o755, exist_ok=True)
+    if os.path.exists(args.listen):
+        os.remove(args.listen)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.listen)
+    os.chmod(args.listen, 0o666)
+    server.listen(16)
+    helper.serve_forever(server)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,44 +1,147 @@
 import logging
 import os
-import pickle
+from typing import List, Optional, Tuple
 
+import journal.core
 import usb.core
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
+# restore logs written by older versions into the working directory
+LEGACY_LOGS = (('interfaces.pickle', journal.core.INTERFACE), ('allowed_usbguard.pickle', journal.core.USBGUARD))
 
-def restore_changes():
+
+def _load_all_pickles(path: str) -> List[str]:
+    import pickle
+
+    keys = list()
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            keys.extend(record if isinstance(record, list) else [record])
+    return keys
+
+
+def _resolve_usbguard_ids(records: List[str], usbguard_command: str) -> Tuple[List[str], List[str]]:
+    # older versions logged usbguard's numeric device IDs (sometimes with the colon of 'list-devices'), which are only
+    # valid while the device stays plugged in; they are mapped to journal keys through the current device table
+    ids = {x: str(x).strip().rstrip(":").strip() for x in records}
+    if not any(x.isdigit() for x in ids.values()):
+        return list(records), []
+    by_id = {x.id: x for x in usb.core.USBGuardTable.load(usbguard_command).devices}
+
+    keys, unresolved = list(), list()
+    for record, device_id in ids.items():
+        if not device_id.isdigit():
+            keys.append(record)
+        elif device_id in by_id:
+            keys.append(by_id[device_id].journal_key)
+        else:
+            unresolved.append(record)
+    return keys, unresolved
+
+
+def import_legacy_logs(log: journal.core.Journal, directory: str = '.', usbguard_command: str = "usbguard") -> int:
+    """
+    Moves every record of the pickle restore logs of older versions into the journal.
+
+    usbguard device IDs are resolved against 'usbguard list-devices'. IDs usbguard does not know (any more) cannot be
+    mapped to a device: they are logged and kept in the pickle log instead of being dropped.
+
+    :param log: Journal to import into
+    :type log: journal.core.Journal
+    :param directory: Directory the pickle logs were written to
+    :type directory: str
+    :param usbguard_command: usbguard executable
+    :type usbguard_command: str
+    :return: Returns the number of records that could not be imported
+    :rtype: int
+    """
+    import pickle
+
+    remaining = 0
+    for name, kind in LEGACY_LOGS:
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            continue
+        try:
+            keys = _load_all_pickles(path)
+        except Exception as e:
+            logger.error(f"Could not read {path}: {e}")
+            continue
+        unresolved = list()
+        if kind == journal.core.USBGUARD:
+            keys, unresolved = _resolve_usbguard_ids(keys, usbguard_command)
+        log.apply(kind, keys)
+        if unresolved:
+            logger.error(f"usbguard does not know the devices {unresolved} of {path}, they are kept there and have to be "
+                         f"blocked manually (usbguard block-device)")
+            with open(path, 'wb') as f:
+                pickle.dump(unresolved, f, pickle.HIGHEST_PROTOCOL)
+            remaining += len(unresolved)
+        else:
+            os.remove(path)
+        logger.debug(f"Imported {len(keys)} entries from {path}")
+    return remaining
+
+
+def restore_changes(log: Optional[journal.core.Journal] = None, usbguard_command: str = "usbguard") -> bool:
     """
     Brings network interfaces back up (that have previously been disabled) and block usb devices
     that have been allowed with usbguard.
-    """
-    try:
-        with open('interfaces.pickle', 'rb') as f:
-            ints = pickle.load(f)
 
-        with open('allowed_usbguard.pickle', 'rb') as f:
-            allowed_usbguard = pickle.load(f)
-    except FileNotFoundError:
-        logger.error("At least one restore file is missing.")
+    Every outstanding change in the journal is undone exactly once: all interfaces in one privileged step and all usb
+    devices with one usbguard device table lookup. Changes that could not be undone stay in the journal for the next
+    run.
+
+    :param log: Journal to restore from, defaults to the journal in the state directory
+    :type log: Optional[journal.core.Journal]
+    :param usbguard_command: usbguard executable
+    :type usbguard_command: str
+    :return: Returns True if no change is outstanding any more
+    :rtype: bool
+    """
+    log = log if log is not None else journal.core.default_journal()
+    legacy = import_legacy_logs(log, usbguard_command=usbguard_command)
+    outstanding = log.outstanding()
 
-    try:
+    interfaces = outstanding.get(journal.core.INTERFACE, [])
+    if interfaces:
         # reconnect network interfaces that have previously been disconnected
-        for i in ints:
-            logger.debug(f"\n\nReconnecting to {i} interface...")
-            usb.core.USB.connect_disconnect_network_interfaces("connect", i)
+        logger.debug(f"\n\nReconnecting to {interfaces} interfaces...")
+        try:
+            results = usb.core.USB.connect_disconnect_network_interfaces("connect", interfaces)
+        except ValueError as e:
+            logger.error(f"Could not reconnect network interfaces: {e}")
+        else:
+            log.revert(journal.core.INTERFACE, [name for name, result in results.items() if result.ok])
 
-        # block usb device using usbguard
-        usbguard = usb.core.USBGuard(device_ids=allowed_usbguard)
-        if usbguard.check_if_installed():
+    keys = outstanding.get(journal.core.USBGUARD, [])
+    if keys:
+        # block usb devices using usbguard
+        devices = {key: usb.core.USBGuardDevice.from_journal_key(key) for key in keys}
+        usbguard = usb.core.USBGuard(devices=list(devices.values()), command=usbguard_command, journal=log)
+        try:
             usbguard.block_device()
-    except:
-        logger.error("Could not properly restore changes from at least one log files.")
-    else:
-        logger.debug("Restored changes from log files [interfaces.pickle] and/or [allowed_usbguard.pickle]")
+        except OSError as e:
+            logger.error(f"Could not block usb devices with usbguard: {e}")
+        else:
+            # devices that are blocked now - or have been unplugged since - are restored
+            log.revert(journal.core.USBGUARD, [key for key, device in devices.items()
+                                               if all(x.target == "block" for x in usbguard.table.match(device))])
 
-        # delete restore files
-        os.remove('interfaces.pickle')
-        os.remove('allowed_usbguard.pickle')
+    log.compact()
+    remaining = log.outstanding()
+    if legacy:
+        return False
+    if remaining:
+        logger.error(f"Could not restore all changes, still outstanding: {remaining}")
+        return False
 
+    logger.debug(f"Restored all changes from the journal [{log.path}]")
+    return True
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from sandbox.lifecycle import VMLifecycleWatcher
+from sandbox.provision import provisioner_for
+from sandbox.vboxmanage import VBoxManage, default_client
+from usb.core import USB
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+class Backend:
+    """
+    The hypervisor operations a Sandbox needs. VMs are identified by the sandbox ID (name or UUID) of the Sandbox.
+    """
+    name = None
+
+    def start(self, sandbox_id: str, *args: str) -> bool:
+        """
+        Starts the VM.
+
+        :return: Returns True if the VM was started
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    async def start_async(self, sandbox_id: str, *args: str) -> bool:
+        """
+        Starts the VM without blocking the event loop (in a worker thread unless the backend overrides it).
+
+        :return: Returns True if the VM was started
+        :rtype: bool
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self.start(sandbox_id, *args))
+
+    def power_off(self, sandbox_id: str) -> bool:
+        """
+        Powers the VM off (like pulling the plug).
+
+        :return: Returns True if the VM was powered off
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def provision_usb(self, sandbox_id: str) -> bool:
+        """
+        Makes sure the VM can take USB devices (controllers, filters).
+
+        :return: Returns True if the VM is provisioned
+        :rtype: bool
+        """
+        return True
+
+    def resolve_usb(self, devices: List[USB]) -> List[str]:
+        """
+        Maps host USB devices to the IDs attach_usb takes, devices the hypervisor does not know are left out.
+
+        :rtype: List[str]
+        """
+        raise NotImplementedError
+
+    def attach_usb(self, sandbox_id: str, device: str) -> Tuple[bool, str]:
+        """
+        Passes a host USB device through to the running VM.
+
+        :param device: ID returned by resolve_usb
+        :type device: str
+        :return: Returns (success, error message)
+        :rtype: Tuple[bool, str]
+        """
+        raise NotImplementedError
+
+    def detach_usb(self, sandbox_id: str, device: str) -> Tuple[bool, str]:
+        """
+        Takes a USB device attached with attach_usb away from the VM.
+
+        :return: Returns (success, error message)
+        :rtype: Tuple[bool, str]
+        """
+        raise NotImplementedError
+
+    def wait_for_stop(self, sandbox_id: str, on_transition: Optional[Callable[[str, str], None]] = None) -> str:
+        """
+        Blocks until the VM has stopped.
+
+        :return: Returns the final VM state
+        :rtype: str
+        """
+        raise NotImplementedError
+
+
+class VirtualBoxBackend(Backend):
+    """
+    VirtualBox, driven through vboxmanage.
+    """
+    name = "virtualbox"
+
+    def __init__(self, client: Optional[VBoxManage] = None):
+        self.client = client if client is not None else default_client()
+
+    def start(self, sandbox_id: str, *args: str) -> bool:
+        returncode, stdout, stderr = self.client.startvm(sandbox_id, *args)
+        logger.debug(f"{stdout}, {stderr}")
+        return returncode == 0
+
+    async def start_async(self, sandbox_id: str, *args: str) -> bool:
+        returncode, stdout, stderr = await self.client.startvm_async(sandbox_id, *args)
+        logger.debug(f"{stdout}, {stderr}")
+        return returncode == 0
+
+    def power_off(self, sandbox_id: str) -> bool:
+        returncode, stdout, stderr = self.client.controlvm(sandbox_id, "poweroff")
+        logger.debug(f"{stdout}, {stderr}")
+        return returncode == 0
+
+    def provision_usb(self, sandbox_id: str) -> bool:
+        provisioner = provisioner_for(self.client)
+        provisioner.provision(sandbox_id)
+        return sandbox_id in provisioner.provisioned
+
+    def resolve_usb(self, devices: List[USB]) -> List[str]:
+        index = self.client.usbhost_index()
+
+        # lookup uuids (e.g. 8087:0026 on port 1-10 -> e0c6ec26-4ad1-4d55-97c8-f0f35c538e95)
+        usb_uuids = list()
+        for obj in devices:
+            host = index.resolve(obj)
+            if host is None:
+                logger.error(f"Could not find USB device {obj.device_id} (port {obj.port_path}) in VirtualBox")
+            elif host.uuid not in usb_uuids:
+                usb_uuids.append(host.uuid)
+        return usb_uuids
+
+    def attach_usb(self, sandbox_id: str, device: str) -> Tuple[bool, str]:
+        returncode, stdout, stderr = self.client.controlvm(sandbox_id, "usbattach", device)
+        logger.debug(f"{stdout.splitlines()}, {stderr.splitlines()}")
+        return returncode == 0, stderr.strip() or (f"usbattach exited with {returncode}" if returncode else "")
+
+    def detach_usb(self, sandbox_id: str, device: str) -> Tuple[bool, str]:
+        returncode, stdout, stderr = self.client.controlvm(sandbox_id, "usbdetach", device)
+        return returncode == 0, stderr.strip()
+
+    def wait_for_stop(self, sandbox_id: str, on_transition: Optional[Callable[[str, str], None]] = None) -> str:
+        watcher = VMLifecycleWatcher(sandbox_id, client=self.client)
+        return watcher.wait_for_stop(on_transition=on_transition)
@@ -1,68 +1,371 @@
 import logging
-import subprocess
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
+import metrics.core
 import usb.core
+from sandbox.backend import VirtualBoxBackend
+from sandbox.provision import provisioner_for
+from sandbox.vboxmanage import default_client
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
+# usbattach of several devices runs concurrently, a failed usbattach (VM still booting, device not yet captured by
+# VirtualBox) is retried with exponential backoff
+ATTACH_PARALLEL = 4
+ATTACH_ATTEMPTS = 6
+ATTACH_BACKOFF = 0.25
+ATTACH_MAX_BACKOFF = 2.0
+
+# medium types of disk images that several VMs can attach while none of them can change the image
+IMAGE_MEDIUM_TYPES = ("multiattach", "immutable")
+
+
+def free_storage_slot(info: Dict[str, str]) -> Optional[Tuple[str, int]]:
+    """
+    Finds a storage controller port of the VM without a medium attached.
+
+    :param info: Output of 'showvminfo --machinereadable'
+    :type info: Dict[str, str]
+    :return: Returns (controller name, port) or None if every port is in use
+    :rtype: Optional[Tuple[str, int]]
+    """
+    index = 0
+    while f"storagecontrollername{index}" in info:
+        name = info[f"storagecontrollername{index}"]
+        try:
+            ports = int(info.get(f"storagecontrollerportcount{index}", "0"))
+        except ValueError:
+            ports = 0
+        for port in range(ports):
+            if info.get(f"{name}-{port}-0", "none") == "none":
+                return name, port
+        index += 1
+    return None
+
+
+class AttachResult:
+    """
+    Outcome of attaching one USB device to a VM.
+    """
+    __slots__ = ('uuid', 'attempts', 'returncode', 'error', 'seconds')
+
+    def __init__(self, uuid: str):
+        self.uuid = uuid
+        self.attempts = 0
+        self.returncode = None
+        self.error = None
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return f"AttachResult({self.uuid}, {self.status}, attempts={self.attempts}, seconds={self.seconds:.3f})"
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+    @property
+    def status(self) -> str:
+        """
+        attached (first attempt), retried (attached after retries) or failed.
+
+        :rtype: str
+        """
+        if not self.ok:
+            return "failed"
+        return "attached" if self.attempts == 1 else "retried"
+
 
 class Sandbox:
     def __init__(self, **kwargs):
         self.name = kwargs.get('name', None)
         self.uuid = kwargs.get('uuid', None)
         self.device_ids = kwargs.get('device_ids', None)
+        self.client = kwargs.get('client', None) or default_client()
+        self.backend = kwargs.get('backend', None) or VirtualBoxBackend(self.client)
+        self.images = dict()
 
         if self.name is not None:
             self.sandbox_id = self.name
         else:
             self.sandbox_id = self.uuid
 
-    def run_sandbox(self):
+    def run_sandbox(self, *args: str) -> bool:
         """
         Start the VBOX VM.
 
         :param self: Sandbox object
         :type self: Sandbox
+        :param args: Additional startvm arguments (e.g. --type headless)
+        :return: Returns True if the VM was started
+        :rtype: bool
         """
-        s = subprocess.Popen(["vboxmanage", "startvm", self.sandbox_id],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = s.communicate()
+        with metrics.core.span("sandbox_start", vm=self.sandbox_id, backend=self.backend.name):
+            return self.backend.start(self.sandbox_id, *args)
 
-    def mount_usb_to_sandbox(self, usb_uuid: List[str]):
+    async def run_sandbox_async(self, *args: str) -> bool:
         """
-        Checks if a the sandbox VM is still up and running.
+        Start the VM without blocking the event loop (see run_sandbox).
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :rtype: bool
+        """
+        with metrics.core.span("sandbox_start", vm=self.sandbox_id, backend=self.backend.name):
+            return await self.backend.start_async(self.sandbox_id, *args)
+
+    def provision_usb(self) -> bool:
+        """
+        Enables the USB controllers and the catch-all USB filter of the VM if they are missing. Has to be called while
+        the VM is powered off; VMs that are already provisioned are skipped without running any command.
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :return: Returns True if the VM is provisioned
+        :rtype: bool
+        """
+        with metrics.core.span("usb_provision", vm=self.sandbox_id):
+            return self.backend.provision_usb(self.sandbox_id)
+
+    def resolve_usb(self, devices: List[usb.core.USB]) -> List[str]:
+        """
+        Looks up the IDs the backend attaches the USB devices by (e.g. the VirtualBox UUIDs).
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :param devices: Host USB devices
+        :type devices: List[usb.core.USB]
+        :return: Returns the IDs to pass to mount_usb_to_sandbox
+        :rtype: List[str]
+        """
+        with metrics.core.span("uuid_resolution", devices=len(devices)):
+            return self.backend.resolve_usb(devices)
+
+    def attach_image(self, medium: str, mtype: str = "multiattach") -> bool:
+        """
+        Attaches a disk image (e.g. a snapshot of a USB stick) to a free port of the powered off VM. The medium is
+        multiattach or immutable, so the guest's writes go to a differencing image and never reach the image itself.
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :param medium: Path of the VDI medium
+        :type medium: str
+        :param mtype: multiattach (several VMs share the image) or immutable
+        :type mtype: str
+        :return: Returns True if the medium was attached
+        :rtype: bool
+        """
+        if mtype not in IMAGE_MEDIUM_TYPES:
+            raise ValueError(f"Medium type must be one of {IMAGE_MEDIUM_TYPES}, not {mtype}")
+
+        info = self.client.showvminfo(self.sandbox_id, refresh=True)
+        slot = free_storage_slot(info or {})
+        if slot is None:
+            logger.error(f"{self.sandbox_id} has no free storage controller port for {medium}")
+            return False
+
+        controller, port = slot
+        returncode, stdout, stderr = self.client.run("storageattach", self.sandbox_id, "--storagectl", controller,
+                                                     "--port", str(port), "--device", "0", "--type", "hdd",
+                                                     "--medium", medium, "--mtype", mtype)
+        self.client.invalidate("showvminfo", self.sandbox_id)
+        if returncode != 0:
+            logger.error(f"Could not attach {medium} to {self.sandbox_id}: {stderr.strip()}")
+            return False
+        self.images[medium] = slot
+        return True
+
+    def detach_image(self, medium: str) -> bool:
+        """
+        Detaches a disk image attached with attach_image.
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :param medium: Path of the VDI medium
+        :type medium: str
+        :return: Returns True if the medium was detached
+        :rtype: bool
+        """
+        slot = self.images.pop(medium, None)
+        if slot is None:
+            return False
+        controller, port = slot
+        returncode, stdout, stderr = self.client.run("storageattach", self.sandbox_id, "--storagectl", controller,
+                                                     "--port", str(port), "--device", "0", "--medium", "none")
+        self.client.invalidate("showvminfo", self.sandbox_id)
+        if returncode != 0:
+            logger.error(f"Could not detach {medium} from {self.sandbox_id}: {stderr.strip()}")
+        return returncode == 0
+
+    def power_off(self):
+        """
+        Powers the VM off (like pulling the plug).
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        """
+        self.backend.power_off(self.sandbox_id)
+
+    def restore_snapshot(self, snapshot: str) -> bool:
+        """
+        Restores a snapshot of the powered off VM. Starting the VM afterwards resumes a snapshot taken while the VM was
+        running within seconds instead of booting the guest.
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :param snapshot: Name or UUID of the snapshot
+        :type snapshot: str
+        :return: Returns True if the snapshot was restored
+        :rtype: bool
+        """
+        returncode, stdout, stderr = self.client.run("snapshot", self.sandbox_id, "restore", snapshot)
+        self.client.on_vm_event(self.sandbox_id)
+        # the snapshot brings back the USB configuration it was taken with
+        provisioner_for(self.client).forget(self.sandbox_id)
+        if returncode != 0:
+            logger.error(f"Could not restore snapshot {snapshot} of {self.sandbox_id}: {stderr.strip()}")
+        return returncode == 0
+
+    def get_guest_property(self, name: str) -> Optional[str]:
+        """
+        Reads a guest property of the running VM.
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :param name: Name of the guest property
+        :type name: str
+        :return: Returns the value or None if the property is not set
+        :rtype: Optional[str]
+        """
+        returncode, stdout, stderr = self.client.run("guestproperty", "get", self.sandbox_id, name)
+        stdout = stdout.strip()
+        if returncode != 0 or not stdout.startswith("Value: "):
+            return None
+        return stdout[len("Value: "):]
+
+    def wait_for_guest_property(self, name: str, value: str, timeout: float) -> bool:
+        """
+        Blocks until a guest property (e.g. one set by the guest additions at boot) has the expected value.
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :param name: Name of the guest property
+        :type name: str
+        :param value: Expected value
+        :type value: str
+        :param timeout: Seconds to wait
+        :type timeout: float
+        :return: Returns True once the property has the value, False on timeout
+        :rtype: bool
+        """
+        deadline = time.monotonic() + timeout
+        while self.get_guest_property(name) != value:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            # blocks until the property changes, fails right away while the VM is still being set up
+            returncode, stdout, stderr = self.client.run("guestproperty", "wait", self.sandbox_id, name,
+                                                         "--timeout", str(max(1, int(remaining * 1000))),
+                                                         timeout=remaining + 10)
+            if returncode != 0:
+                time.sleep(min(0.5, max(0.0, deadline - time.monotonic())))
+
+        return True
+
+    def wait_for_shutdown(self, on_transition=None) -> str:
+        """
+        Blocks until the VM has been powered off, saved or aborted.
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :param on_transition: Optional callback invoked with (old_state, new_state) on every state change
+        :return: Returns the final VM state
+        :rtype: str
+        """
+        with metrics.core.span("vm_wait", vm=self.sandbox_id) as span:
+            state = self.backend.wait_for_stop(self.sandbox_id, on_transition=on_transition)
+            span.set(state=state)
+        return state
+
+    def attach_usb(self, uuid: str, attempts: int = ATTACH_ATTEMPTS, backoff: float = ATTACH_BACKOFF,
+                   max_backoff: float = ATTACH_MAX_BACKOFF) -> AttachResult:
+        """
+        Attaches one USB device to the running sandbox, retrying with exponential backoff while usbattach fails.
+
+        :param self: Sandbox object
+        :type self: Sandbox
+        :param uuid: VirtualBox UUID of the usb device
+        :type uuid: str
+        :param attempts: Maximum number of usbattach calls
+        :type attempts: int
+        :param backoff: Seconds to wait after the first failure, doubled after every further failure
+        :type backoff: float
+        :param max_backoff: Upper bound of the wait between two attempts
+        :type max_backoff: float
+        :rtype: AttachResult
+        """
+        result = AttachResult(uuid)
+        start = time.monotonic()
+        delay = backoff
+        with metrics.core.span("usbattach", vm=self.sandbox_id, device=uuid) as span:
+            while result.attempts < attempts:
+                if result.attempts:
+                    time.sleep(delay)
+                    delay = min(delay * 2, max_backoff)
+                result.attempts += 1
+                ok, error = self.backend.attach_usb(self.sandbox_id, uuid)
+                result.returncode = 0 if ok else 1
+                if ok:
+                    result.error = None
+                    break
+                result.error = error
+            result.seconds = time.monotonic() - start
+            span.set(attempts=result.attempts, status=result.status)
+        metrics.core.count("usbattach", outcome=result.status)
+
+        if not result.ok:
+            logger.error(f"Could not attach USB device {uuid} to {self.sandbox_id} after {result.attempts} attempts: "
+                         f"{result.error}")
+        return result
+
+    def mount_usb_to_sandbox(self, usb_uuid: List[str], usbguard: Optional[usb.core.USBGuard] = None,
+                             max_parallel: int = ATTACH_PARALLEL, **retry) -> Dict[str, AttachResult]:
+        """
+        Attaches the USB devices to the running sandbox and allows them in usbguard.
+
+        The devices are attached concurrently (at most max_parallel usbattach calls at a time), so a batch of sticks
+        takes about as long as a single one. usbguard is skipped if no device could be attached.
 
         :param self: Sandbox object
         :type self: Sandbox
         :param usb_uuid: Provides a list of usb UUIDS
         :type usb_uuid: List[str]
+        :param usbguard: Optional USBGuard object that has already been prepared
+        :type usbguard: Optional[usb.core.USBGuard]
+        :param max_parallel: Maximum number of concurrent usbattach calls
+        :type max_parallel: int
+        :param retry: attempts, backoff and max_backoff passed to attach_usb
+        :return: Returns usb UUID -> AttachResult
+        :rtype: Dict[str, AttachResult]
         """
-        for uuid in usb_uuid:
-            p = subprocess.Popen(["vboxmanage", "controlvm", self.sandbox_id, "usbattach", uuid],
-                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = p.communicate()
-            stdout = stdout.decode('UTF-8').splitlines()
-            stderr = stderr.decode('UTF-8').splitlines()
-            logger.debug(f"{stdout}, {stderr}")
+        uuids = list(dict.fromkeys(usb_uuid))
+        if len(uuids) > 1 and max_parallel > 1:
+            with ThreadPoolExecutor(max_workers=min(max_parallel, len(uuids)),
+                                    thread_name_prefix="usbattach") as executor:
+                results = list(executor.map(lambda x: self.attach_usb(x, **retry), uuids))
+        else:
+            results = [self.attach_usb(x, **retry) for x in uuids]
+        report = {x.uuid: x for x in results}
 
-        usbguard = usb.core.USBGuard(device_ids=self.device_ids)
-        usbguard.allow_device()
+        if uuids and not any(x.ok for x in results):
+            logger.error(f"No USB device could be attached to {self.sandbox_id}, usbguard is not changed")
+            return report
 
-        modifyvm = subprocess.Popen(
-            ["vboxmanage", "modifyvm", self.sandbox_id, "--usbxhci", "on" "--usbohci", "on", "--usbehci", "on"],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout_modifyvm, stderr_modifyvm = modifyvm.communicate()
-        stdout_modifyvm = stdout_modifyvm.decode('UTF-8').splitlines()
-        stderr_modifyvm = stderr_modifyvm.decode('UTF-8').splitlines()
-        logger.debug(f"{stdout_modifyvm}, {stderr_modifyvm}")
-
-        usbfilter = subprocess.Popen(
-            ["vboxmanage", "usbfilter", "add", "--target", self.sandbox_id, "--name", "allow_all_usbs"],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout_usbfilter, stderr_usbfilter = usbfilter.communicate()
-        stdout_usbfilter = stdout_usbfilter.decode('UTF-8').splitlines()
-        stderr_usbfilter = stderr_usbfilter.decode('UTF-8').splitlines()
-        logger.debug(f"{stdout_usbfilter}, {stderr_usbfilter}")
+        if usbguard is None:
+            usbguard = usb.core.USBGuard(device_ids=self.device_ids)
+        usbguard.allow_device()
+        return report
@@ -0,0 +1,386 @@
+import logging
+import os
+import re
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import metrics.core
+from sandbox.provision import CONFIGURABLE_STATES
+from sandbox.vboxmanage import VBoxManage
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# MB of memory the host keeps for itself, VMs booting at the same time, seconds between two looks at the host
+MEMORY_RESERVE_MB = 1024
+MAX_STARTS = 2
+POLL_INTERVAL = 1.0
+# admission waits kept for the stats
+WAIT_HISTORY = 256
+
+# a launched VM counts as booting until its guest additions report a userland run level (or the grace period passed,
+# e.g. for a guest without guest additions); seconds between two queries of the run level of a VM
+BOOT_GRACE = 180.0
+READY_CHECK_INTERVAL = 5.0
+RUNLEVEL_PROPERTY = "/VirtualBox/GuestAdd/RunLevel"
+USERLAND_RUNLEVEL = 2
+
+BANDWIDTH_GROUP = "mount-usb-in-sandbox-disk"
+# storage attachments carrying a hard disk image get the bandwidth group, DVDs and floppies do not
+DISK_IMAGE_EXTENSIONS = (".vdi", ".vmdk", ".vhd", ".vhdx", ".hdd", ".qed", ".qcow")
+STORAGE_ATTACHMENT = re.compile(r"^(.+)-(\d+)-(\d+)$")
+
+
+class HostSaturated(Exception):
+    """
+    A VM could not be admitted: it can never fit on the host or the admission timed out.
+    """
+
+
+class VMLimits:
+    """
+    Resources a single VM may use. None leaves the VM's own setting alone.
+    """
+    __slots__ = ('cpus', 'memory_mb', 'cpu_cap', 'disk_mbps')
+
+    def __init__(self, cpus: Optional[int] = None, memory_mb: Optional[int] = None, cpu_cap: Optional[int] = None,
+                 disk_mbps: Optional[int] = None):
+        if cpu_cap is not None and not 1 <= cpu_cap <= 100:
+            raise ValueError("The CPU execution cap is a percentage between 1 and 100")
+        self.cpus = cpus
+        self.memory_mb = memory_mb
+        self.cpu_cap = cpu_cap
+        self.disk_mbps = disk_mbps
+
+    def __repr__(self):
+        return (f"VMLimits(cpus={self.cpus}, memory_mb={self.memory_mb}, cpu_cap={self.cpu_cap}, "
+                f"disk_mbps={self.disk_mbps})")
+
+
+class HostMonitor:
+    """
+    Reads the host's memory (/proc/meminfo) and CPU load (1 minute load average).
+    """
+
+    def __init__(self, meminfo: str = "/proc/meminfo", loadavg: Callable[[], Tuple[float, float, float]] = os.getloadavg,
+                 cpus: Optional[int] = None):
+        self.meminfo = meminfo
+        self.loadavg = loadavg
+        self.cpus = cpus or os.cpu_count() or 1
+
+    def memory(self) -> Tuple[int, int]:
+        """
+        :return: Returns (total MB, available MB)
+        :rtype: Tuple[int, int]
+        """
+        values = dict()
+        with open(self.meminfo) as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("MemTotal", "MemAvailable"):
+                    values[key] = int(value.split()[0]) // 1024
+        return values.get("MemTotal", 0), values.get("MemAvailable", 0)
+
+    def load(self) -> float:
+        return self.loadavg()[0]
+
+
+class Reservation:
+    """
+    Resources committed to one admitted VM.
+    """
+    __slots__ = ('sandbox_id', 'memory_mb', 'cpus', 'starting', 'wait', 'launched', 'checked')
+
+    def __init__(self, sandbox_id: str, memory_mb: int, cpus: int, wait: float):
+        self.sandbox_id = sandbox_id
+        self.memory_mb = memory_mb
+        self.cpus = cpus
+        self.starting = True
+        self.wait = wait
+        # monotonic time startvm returned and the run level was last queried
+        self.launched = None
+        self.checked = None
+
+    def __repr__(self):
+        return (f"Reservation({self.sandbox_id!r}, {self.memory_mb} MB, {self.cpus} CPUs, "
+                f"{'starting' if self.starting else 'running'})")
+
+
+class ResourceGovernor:
+    """
+    Admits VM starts only while the host has headroom and caps what each VM may take from it.
+
+    A VM is admitted once the memory committed to the admitted VMs plus its own stays below the host's memory minus a
+    reserve, the host currently has that much memory available (VMs still booting have not touched theirs yet, so it is
+    counted for them), the load leaves room for its CPUs and fewer than max_starts VMs are booting. Otherwise the
+    start is queued - in arrival order - until a VM is released or the host recovers.
+
+    startvm returns as soon as the VM process runs, long before the guest has booted. A VM therefore counts as booting
+    until its guest additions report a userland run level or boot_grace seconds after it was launched.
+
+    Limits are applied like the USB provisioning: CPUs, memory and the disk bandwidth group while the VM is powered
+    off, the CPU execution cap and the bandwidth limit also while it runs.
+    """
+
+    def __init__(self, client: VBoxManage, limits: Optional[VMLimits] = None, host: Optional[HostMonitor] = None,
+                 memory_reserve_mb: int = MEMORY_RESERVE_MB, max_starts: int = MAX_STARTS, max_load: float = 1.0,
+                 poll_interval: float = POLL_INTERVAL, boot_grace: float = BOOT_GRACE,
+                 ready_check_interval: float = READY_CHECK_INTERVAL):
+        self.client = client
+        self.limits = limits or VMLimits()
+        self.host = host or HostMonitor()
+        self.memory_reserve_mb = memory_reserve_mb
+        self.max_starts = max_starts
+        self.max_load = max_load
+        self.poll_interval = poll_interval
+        self.boot_grace = boot_grace
+        self.ready_check_interval = ready_check_interval
+        self.reservations = dict()
+        self.limited = set()
+        self.waiting = 0
+        self.admitted = 0
+        self.waits = list()
+        self._queue = list()
+        self._cond = threading.Condition()
+
+    def plan(self, info: Dict[str, str], running: bool = False) -> List[Tuple[str, ...]]:
+        """
+        Computes the vboxmanage commands that apply the limits to a VM.
+
+        :param info: Output of 'showvminfo --machinereadable'
+        :type info: Dict[str, str]
+        :param running: Only the commands that can be applied to a running VM
+        :type running: bool
+        :rtype: List[Tuple[str, ...]]
+        """
+        vm = info.get("UUID") or info.get("name")
+        limits = self.limits
+        commands = list()
+
+        if limits.cpu_cap is not None and info.get("cpuexecutioncap") != str(limits.cpu_cap):
+            if running:
+                commands.append(("controlvm", vm, "cpuexecutioncap", str(limits.cpu_cap)))
+        options = list()
+        if not running:
+            for option, key, value in (("--cpuexecutioncap", "cpuexecutioncap", limits.cpu_cap),
+                                       ("--memory", "memory", limits.memory_mb), ("--cpus", "cpus", limits.cpus)):
+                if value is not None and info.get(key) != str(value):
+                    options += [option, str(value)]
+        if options:
+            commands.append(("modifyvm", vm) + tuple(options))
+
+        if limits.disk_mbps is not None:
+            commands.append(("bandwidthctl", vm, "set", BANDWIDTH_GROUP, "--limit", f"{limits.disk_mbps}M"))
+            if not running:
+                for key, medium in sorted(info.items()):
+                    match = STORAGE_ATTACHMENT.match(key)
+                    if match and medium.lower().endswith(DISK_IMAGE_EXTENSIONS):
+                        controller, port, device = match.groups()
+                        commands.append(("storageattach", vm, "--storagectl", controller, "--port", port,
+                                         "--device", device, "--type", "hdd", "--medium", medium,
+                                         "--bandwidthgroup", BANDWIDTH_GROUP))
+        return commands
+
+    def apply_limits(self, sandbox) -> List[Tuple[str, ...]]:
+        """
+        Applies the limits to the VM, once per VM while it is powered off. A running VM only gets the CPU execution cap
+        and the bandwidth limit.
+
+        :return: Returns the commands that have been run
+        :rtype: List[Tuple[str, ...]]
+        """
+        info = self.client.showvminfo(sandbox.sandbox_id)
+        if info is None:
+            logger.error(f"Cannot limit unknown VM {sandbox.sandbox_id}")
+            return []
+        uuid = info.get("UUID", sandbox.sandbox_id)
+        state = info.get("VMState")
+        if uuid in self.limited:
+            return []
+        if state == "saved":
+            # neither modifyvm nor controlvm accept a saved VM, the limits follow once it has been started
+            logger.debug(f"{sandbox.sandbox_id} is saved, limits are applied once it runs")
+            return []
+        running = state not in CONFIGURABLE_STATES
+
+        applied = list()
+        for command in self.plan(info, running):
+            if command[0] == "bandwidthctl":
+                returncode, stdout, stderr = self.client.run(*command)
+                if returncode != 0:
+                    # the group does not exist yet
+                    command = command[:2] + ("add", BANDWIDTH_GROUP, "--type", "disk") + command[4:]
+                    returncode, stdout, stderr = self.client.run(*command)
+            else:
+                returncode, stdout, stderr = self.client.run(*command)
+            applied.append(command)
+            if returncode != 0:
+                logger.error(f"vboxmanage {' '.join(command)} failed: {stderr.strip()}")
+        if applied:
+            self.client.invalidate("showvminfo", sandbox.sandbox_id)
+            logger.debug(f"Limited {sandbox.sandbox_id}: {applied}")
+        if not running:
+            self.limited.add(uuid)
+        return applied
+
+    def forget(self, sandbox):
+        """
+        Forgets that the limits have been applied to the VM, e.g. because a snapshot restored its old settings. They are
+        applied again before it is started next.
+        """
+        info = self.client.showvminfo(sandbox.sandbox_id) or {}
+        self.limited.discard(info.get("UUID", sandbox.sandbox_id))
+
+    def _demand(self, sandbox) -> Tuple[int, int]:
+        info = self.client.showvminfo(sandbox.sandbox_id) or {}
+        memory = self.limits.memory_mb
+        cpus = self.limits.cpus
+        try:
+            memory = memory if memory is not None else int(info.get("memory", 0))
+            cpus = cpus if cpus is not None else int(info.get("cpus", 1))
+        except ValueError:
+            pass
+        return memory or 0, cpus or 1
+
+    def _guest_ready(self, sandbox_id: str) -> bool:
+        returncode, stdout, stderr = self.client.run("guestproperty", "get", sandbox_id, RUNLEVEL_PROPERTY)
+        # "Value: 3", or "No value set!" while the guest additions are not up
+        value = stdout.strip().rpartition("Value:")[2].strip() if returncode == 0 else ""
+        return value.isdigit() and int(value) >= USERLAND_RUNLEVEL
+
+    def _check_booting(self):
+        # marks the VMs that finished booting; the run level is only queried every ready_check_interval seconds per
+        # VM. Called with the lock held, which is released while vboxmanage runs so releases are not held up by it
+        now = time.monotonic()
+        due = list()
+        for reservation in self.reservations.values():
+            if not reservation.starting or reservation.launched is None:
+                continue
+            if now - reservation.launched >= self.boot_grace:
+                logger.debug(f"{reservation.sandbox_id} did not report its run level within {self.boot_grace}s, "
+                             f"no longer counted as booting")
+                reservation.starting = False
+            elif reservation.checked is None or now - reservation.checked >= self.ready_check_interval:
+                reservation.checked = now
+                due.append(reservation)
+        if not due:
+            return
+
+        self._cond.release()
+        try:
+            ready = [x for x in due if self._guest_ready(x.sandbox_id)]
+        finally:
+            self._cond.acquire()
+        for reservation in ready:
+            logger.debug(f"{reservation.sandbox_id} booted after {now - reservation.launched:.1f}s")
+            reservation.starting = False
+
+    def _booting(self) -> List[Reservation]:
+        # the reservations of VMs that have not finished booting
+        return [x for x in self.reservations.values() if x.starting]
+
+    def _blocked(self, memory_mb: int, cpus: int) -> Optional[str]:
+        # why the VM cannot start right now, None if it can
+        total, available = self.host.memory()
+        committed = sum(x.memory_mb for x in self.reservations.values())
+        booting = self._booting()
+        if len(booting) >= self.max_starts:
+            return f"{len(booting)} VMs are booting"
+        if committed + memory_mb > total - self.memory_reserve_mb:
+            return f"{committed} MB committed to VMs"
+        if available - sum(x.memory_mb for x in booting) < memory_mb + self.memory_reserve_mb:
+            return f"{available} MB available"
+        load = self.host.load() + sum(x.cpus for x in booting)
+        if self.reservations and load + cpus > self.host.cpus * self.max_load:
+            return f"load {load:.1f} on {self.host.cpus} CPUs"
+        return None
+
+    def admit(self, sandbox, timeout: Optional[float] = None) -> Reservation:
+        """
+        Blocks until the host has room for the VM and reserves it.
+
+        :param timeout: Seconds to wait, None waits as long as it takes
+        :type timeout: Optional[float]
+        :rtype: Reservation
+        :raises HostSaturated: If the VM can never fit on the host or the timeout passed
+        """
+        memory_mb, cpus = self._demand(sandbox)
+        total, _ = self.host.memory()
+        if memory_mb > total - self.memory_reserve_mb:
+            raise HostSaturated(f"{sandbox.sandbox_id} needs {memory_mb} MB, the host has {total} MB "
+                                f"({self.memory_reserve_mb} MB reserved)")
+
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        ticket = object()
+        with metrics.core.span("admission", vm=sandbox.sandbox_id) as span, self._cond:
+            self._queue.append(ticket)
+            self.waiting += 1
+            reason = None
+            queued = False
+            try:
+                while True:
+                    # first come, first served: a large VM is not overtaken forever by small ones
+                    if self._queue[0] is ticket:
+                        self._check_booting()
+                        reason = self._blocked(memory_mb, cpus)
+                        if reason is None:
+                            break
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise HostSaturated(f"{sandbox.sandbox_id} was not admitted within {timeout}s: {reason}")
+                    if reason is not None and not queued:
+                        logger.debug(f"Start of {sandbox.sandbox_id} queued: {reason}")
+                        queued = True
+                    self._cond.wait(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+            finally:
+                self._queue.remove(ticket)
+                self.waiting -= 1
+                self._cond.notify_all()
+
+            wait = time.monotonic() - start
+            reservation = Reservation(sandbox.sandbox_id, memory_mb, cpus, wait)
+            self.reservations[sandbox.sandbox_id] = reservation
+            self.admitted += 1
+            self.waits.append(wait)
+            del self.waits[:-WAIT_HISTORY]
+            span.set(wait=wait, queued=queued, memory_mb=memory_mb)
+        metrics.core.count("admission_wait_seconds", wait)
+        return reservation
+
+    def launched(self, sandbox):
+        """
+        Notes that startvm returned. From now on the VM's run level is watched, it counts as booting until it reached
+        userland or the boot grace period passed.
+        """
+        with self._cond:
+            reservation = self.reservations.get(sandbox.sandbox_id)
+            if reservation is not None:
+                reservation.launched = time.monotonic()
+            self._cond.notify_all()
+
+    def release(self, sandbox):
+        """
+        Gives the VM's reservation back once it has been powered off.
+        """
+        with self._cond:
+            self.reservations.pop(sandbox.sandbox_id, None)
+            self._cond.notify_all()
+
+    def stats(self) -> Dict[str, object]:
+        with self._cond:
+            waits = sorted(self.waits)
+            return {
+                "admitted": self.admitted,
+                "waiting": self.waiting,
+                "running": len(self.reservations),
+                "booting": sum(x.starting for x in self.reservations.values()),
+                "committed_mb": sum(x.memory_mb for x in self.reservations.values()),
+                "admission_wait": {
+                    "mean": sum(waits) / len(waits) if waits else None,
+                    "p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else None,
+                    "max": waits[-1] if waits else None,
+                },
+            }
@@ -0,0 +1,280 @@
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+import metrics.core
+import usb.core
+import usb.sysfs
+from sandbox.vboxmanage import VBoxManage, default_client
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# seconds until the stick has to show up in the guest, MiB read by the throughput probe and seconds it may take
+VERIFY_TIMEOUT = 60.0
+PROBE_MB = 64
+PROBE_TIMEOUT = 30
+RETRY_INTERVAL = 1.0
+
+# negotiated speed in Mb/s (sysfs 'speed') -> USB speed name
+USB_SPEEDS = {1.5: "low", 12.0: "full", 480.0: "high", 5000.0: "super", 10000.0: "super+", 20000.0: "super+"}
+
+# Runs in the guest as: sh -c GUEST_SCRIPT sh <probe MiB> <probe timeout> [<root>]
+# Prints one tab separated line per USB disk and, if probe MiB > 0, one line with the result of reading it.
+GUEST_SCRIPT = r'''
+probe_mb=$1; probe_timeout=$2; root=$3
+for path in "$root"/sys/block/sd*; do
+    [ -e "$path" ] || continue
+    dev=${path##*/}
+    real=$(readlink -f "$path/device")
+    case "$real" in */usb*) ;; *) continue ;; esac
+    d=$real
+    while [ "$d" != "$root/sys" ] && [ "$d" != / ] && [ ! -f "$d/speed" ]; do d=$(dirname "$d"); done
+    speed=$(cat "$d/speed" 2>/dev/null)
+    serial=$(cat "$d/serial" 2>/dev/null)
+    sectors=$(cat "$path/size" 2>/dev/null)
+    mount=$(awk -v dev="/dev/$dev" 'index($1, dev) == 1 {print $2; exit}' "$root/proc/mounts" 2>/dev/null)
+    printf 'device=%s\tspeed=%s\tserial=%s\tsectors=%s\tmount=%s\n' "$dev" "$speed" "$serial" "$sectors" "$mount"
+    [ "$probe_mb" -gt 0 ] || continue
+    start=$(date +%s%N)
+    if timeout "$probe_timeout" dd if="$root/dev/$dev" of=/dev/null bs=1M count="$probe_mb" iflag=direct 2>/dev/null \
+            || timeout "$probe_timeout" dd if="$root/dev/$dev" of=/dev/null bs=1M count="$probe_mb" 2>/dev/null; then
+        printf 'probe=%s\tns=%s\n' "$dev" "$(( $(date +%s%N) - start ))"
+    else
+        printf 'probe=%s\terror=%s\n' "$dev" "could not read /dev/$dev"
+    fi
+done
+'''
+
+
+class GuestReport:
+    """
+    What the guest sees of one attached USB stick.
+    """
+    __slots__ = ('device', 'serial', 'speed', 'host_speed', 'sectors', 'mount', 'read_bytes', 'read_seconds',
+                 'error')
+
+    def __init__(self, device: Optional[str] = None, serial: Optional[str] = None, speed: Optional[float] = None,
+                 sectors: int = 0, mount: Optional[str] = None):
+        self.device = device
+        self.serial = serial
+        self.speed = speed
+        self.host_speed = None
+        self.sectors = sectors
+        self.mount = mount
+        self.read_bytes = 0
+        self.read_seconds = 0.0
+        self.error = None
+
+    def __repr__(self):
+        return (f"GuestReport({self.device!r}, speed={self.usb_speed}, mount={self.mount!r}, "
+                f"mb_per_s={self.mb_per_s:.1f}, error={self.error!r})")
+
+    @property
+    def ok(self) -> bool:
+        return self.device is not None and self.error is None
+
+    @property
+    def usb_speed(self) -> str:
+        return USB_SPEEDS.get(self.speed, "unknown") if self.speed is not None else "unknown"
+
+    @property
+    def degraded(self) -> bool:
+        """
+        True if the guest negotiated a lower speed than the host (e.g. a USB 3 stick behind an emulated USB 2
+        controller because the VM has no xHCI controller).
+        """
+        return self.speed is not None and self.host_speed is not None and self.speed < self.host_speed
+
+    @property
+    def mb_per_s(self) -> float:
+        """
+        Throughput in MB/s (10^6 bytes per second), like the imager's.
+        """
+        return self.read_bytes / self.read_seconds / 1e6 if self.read_seconds else 0.0
+
+    def to_dict(self) -> Dict[str, object]:
+        return {"device": self.device, "serial": self.serial, "usb_speed": self.usb_speed, "speed": self.speed,
+                "host_speed": self.host_speed, "mount": self.mount, "read_bytes": self.read_bytes,
+                "mb_per_s": round(self.mb_per_s, 1), "error": self.error}
+
+
+def _float(value: str) -> Optional[float]:
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_guest_output(text: str, probe_mb: int = PROBE_MB) -> List[GuestReport]:
+    """
+    Parses the output of GUEST_SCRIPT.
+
+    :rtype: List[GuestReport]
+    """
+    reports = dict()
+    for line in text.splitlines():
+        fields = dict(x.partition("=")[::2] for x in line.split("\t") if "=" in x)
+        if "device" in fields:
+            try:
+                sectors = int(fields.get("sectors") or 0)
+            except ValueError:
+                sectors = 0
+            reports[fields["device"]] = GuestReport(fields["device"], fields.get("serial") or None,
+                                                    _float(fields.get("speed", "")), sectors,
+                                                    fields.get("mount") or None)
+        elif fields.get("probe") in reports:
+            report = reports[fields["probe"]]
+            if "error" in fields:
+                report.error = fields["error"]
+                continue
+            try:
+                report.read_seconds = int(fields.get("ns", "")) / 1e9
+            except ValueError:
+                continue
+            # dd stops early on a stick smaller than the probe
+            report.read_bytes = min(probe_mb * 1024 * 1024, report.sectors * 512) if report.sectors else \
+                probe_mb * 1024 * 1024
+    return list(reports.values())
+
+
+class GuestVerifier:
+    """
+    Confirms through the guest additions ('vboxmanage guestcontrol run') that attached sticks showed up as block
+    devices in the guest, optionally that they were mounted, and measures a bounded sequential read from each of them.
+
+    All USB disks of the guest are inspected by a single shell script per attempt; while the guest additions are not
+    ready or the stick has not appeared yet, the script is run again until the timeout. The sticks that showed up are
+    then read once by another run of the script.
+    """
+
+    def __init__(self, sandbox, username: str, password_file: str, client: Optional[VBoxManage] = None,
+                 probe_mb: int = PROBE_MB, probe_timeout: int = PROBE_TIMEOUT, require_mount: bool = False,
+                 shell: str = "/bin/sh", sysfs_root: str = usb.sysfs.SYSFS_USB_DEVICES):
+        self.sandbox = sandbox
+        self.username = username
+        self.password_file = password_file
+        self.client = client if client is not None else default_client()
+        self.probe_mb = probe_mb
+        self.probe_timeout = probe_timeout
+        self.require_mount = require_mount
+        self.shell = shell
+        self.sysfs_root = sysfs_root
+
+    def inspect(self, probe_mb: Optional[int] = None) -> List[GuestReport]:
+        """
+        Runs the guest script once.
+
+        :param probe_mb: MiB read from every USB disk, None reads probe_mb of the verifier, 0 reads nothing
+        :type probe_mb: Optional[int]
+        :return: Returns one report per USB disk of the guest
+        :rtype: List[GuestReport]
+        :raises OSError: If guestcontrol failed (e.g. the guest additions are not running yet)
+        """
+        probe_mb = self.probe_mb if probe_mb is None else probe_mb
+        returncode, stdout, stderr = self.client.run(
+            "guestcontrol", self.sandbox.sandbox_id, "run", "--exe", self.shell, "--username", self.username,
+            "--passwordfile", self.password_file, "--wait-stdout", "--timeout",
+            str((self.probe_timeout * 2 + 30) * 1000), "--", self.shell, "-c", GUEST_SCRIPT, "sh",
+            str(probe_mb), str(self.probe_timeout), timeout=self.probe_timeout * 2 + 60)
+        if returncode != 0:
+            raise OSError(stderr.strip() or f"guestcontrol exited with {returncode}")
+        return parse_guest_output(stdout, probe_mb)
+
+    def _probe(self, matched: Dict[str, GuestReport]):
+        # reads every matched stick once, after all of them showed up, so the page cache does not skew the result
+        try:
+            probes = {x.device: x for x in self.inspect(self.probe_mb)}
+        except OSError as e:
+            logger.error(f"Could not probe the USB devices in {self.sandbox.sandbox_id}: {e}")
+            return
+        for report in matched.values():
+            probe = probes.get(report.device)
+            if probe is None:
+                continue
+            report.read_bytes = probe.read_bytes
+            report.read_seconds = probe.read_seconds
+            report.error = probe.error
+
+    def _match(self, device: usb.core.USB, reports: List[GuestReport], taken: set) -> Optional[GuestReport]:
+        candidates = [x for x in reports if x.device not in taken]
+        if device.serial:
+            candidates = [x for x in candidates if x.serial == device.serial] or \
+                         [x for x in candidates if x.serial is None]
+        return candidates[0] if candidates else None
+
+    def _host_speed(self, device: usb.core.USB) -> Optional[float]:
+        if not device.port_path:
+            return None
+        try:
+            with open(os.path.join(self.sysfs_root, device.port_path, "speed")) as f:
+                return _float(f.read().strip())
+        except OSError:
+            return None
+
+    def verify(self, devices: List[usb.core.USB], timeout: float = VERIFY_TIMEOUT,
+               interval: float = RETRY_INTERVAL) -> Dict[str, GuestReport]:
+        """
+        Waits until every stick is visible (and mounted, with require_mount) in the guest and probes its throughput.
+        Sticks the guest does not show by then get a report with an error.
+
+        :param devices: Attached sticks
+        :type devices: List[usb.core.USB]
+        :param timeout: Seconds to wait for the sticks to show up
+        :type timeout: float
+        :return: Returns device id (with port) -> GuestReport
+        :rtype: Dict[str, GuestReport]
+        """
+        deadline = time.monotonic() + timeout
+        keys = [f"{x.device_id}@{x.port_path}" if x.port_path else x.device_id for x in devices]
+        with metrics.core.span("guest_verify", vm=self.sandbox.sandbox_id, devices=len(devices)) as span:
+            error = None
+            while True:
+                matched = dict()
+                try:
+                    # the sticks are only looked for here, they are read once all of them are there
+                    reports = self.inspect(0)
+                    taken = set()
+                    for key, device in zip(keys, devices):
+                        report = self._match(device, reports, taken)
+                        if report is not None and (report.mount or not self.require_mount):
+                            taken.add(report.device)
+                            report.host_speed = self._host_speed(device)
+                            matched[key] = report
+                    error = None
+                except OSError as e:
+                    error = str(e)
+                if len(matched) == len(devices) or time.monotonic() + interval > deadline:
+                    break
+                time.sleep(interval)
+            if matched and self.probe_mb > 0:
+                self._probe(matched)
+
+            results = dict()
+            for key in keys:
+                report = matched.get(key)
+                if report is None:
+                    report = GuestReport()
+                    report.error = error or ("not mounted in the guest" if self.require_mount else
+                                             "no block device in the guest")
+                results[key] = report
+                self._record(key, report)
+            span.set(verified=sum(x.ok for x in results.values()),
+                     reports=[x.to_dict() for x in results.values()])
+        return results
+
+    def _record(self, key: str, report: GuestReport):
+        metrics.core.count("guest_verify", outcome="ok" if report.ok else "failed")
+        if not report.ok:
+            logger.error(f"USB device {key} is not usable in {self.sandbox.sandbox_id}: {report.error}")
+            return
+        if report.read_seconds:
+            metrics.core.count("guest_read_bytes", report.read_bytes, usb_speed=report.usb_speed)
+            metrics.core.count("guest_read_seconds", report.read_seconds, usb_speed=report.usb_speed)
+        if report.degraded:
+            logger.warning(f"USB device {key} runs at {report.speed:g} Mb/s in {self.sandbox.sandbox_id} but at "
+                           f"{report.host_speed:g} Mb/s on the host, is the VM's xHCI controller enabled?")
+        logger.debug(f"USB device {key} is /dev/{report.device} in {self.sandbox.sandbox_id}: {report.usb_speed} "
+                     f"speed, {report.mb_per_s:.1f} MB/s, mounted at {report.mount}")
@@ -0,0 +1,149 @@
+import logging
+import os
+import select
+import time
+from typing import Callable, Optional
+
+from sandbox.vboxmanage import VBoxManage, default_client
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+RUNNING = "running"
+PAUSED = "paused"
+SAVED = "saved"
+POWERED_OFF = "poweroff"
+ABORTED = "aborted"
+
+# states in which the VM process is (still) alive
+ACTIVE_STATES = {"starting", RUNNING, PAUSED, "stuck", "saving", "stopping", "restoring", "livesnapshotting",
+                 "onlinesnapshotting", "teleporting", "teleportingin", "teleportingpausedvm"}
+
+VM_PROCESS_NAMES = {"VirtualBoxVM", "VBoxHeadless", "VirtualBox", "VBoxSDL"}
+
+
+class VMLifecycleWatcher:
+    """
+    Blocks on state changes of a VirtualBox VM.
+
+    While the VM is up, the watcher waits on a pidfd of the VM process, so it wakes up the moment the process exits.
+    If the process cannot be found or pidfds are not supported it falls back to polling the VM state with backoff.
+    """
+
+    def __init__(self, sandbox_id: str, client: Optional[VBoxManage] = None, proc_root: str = "/proc",
+                 poll_interval: float = 0.05, max_poll_interval: float = 1.0):
+        self.sandbox_id = sandbox_id
+        self.client = client if client is not None else default_client()
+        self.proc_root = proc_root
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.uuid = None
+        self.state = None
+
+    def query_state(self) -> Optional[str]:
+        """
+        Queries the current VM state and resolves the VM's UUID (so VM names work as well as UUIDs).
+
+        :return: Returns the VMState (e.g. running, saved, poweroff, aborted) or None if the VM is unknown
+        :rtype: Optional[str]
+        """
+        info = self.client.showvminfo(self.sandbox_id, refresh=True)
+        if info is None:
+            return None
+
+        self.uuid = info.get("UUID", self.uuid)
+        return info.get("VMState")
+
+    def find_vm_process(self) -> Optional[int]:
+        """
+        Finds the pid of the process hosting the VM (VirtualBoxVM/VBoxHeadless ... --startvm <uuid>).
+
+        :return: Returns the pid or None if no such process exists
+        :rtype: Optional[int]
+        """
+        wanted = {self.sandbox_id, self.uuid} - {None}
+        try:
+            pids = [x for x in os.listdir(self.proc_root) if x.isdigit()]
+        except OSError:
+            return None
+
+        for pid in pids:
+            try:
+                with open(os.path.join(self.proc_root, pid, "cmdline"), "rb") as f:
+                    args = f.read().decode('UTF-8', 'replace').split("\0")
+            except OSError:
+                continue
+
+            if os.path.basename(args[0]) not in VM_PROCESS_NAMES or "--startvm" not in args:
+                continue
+            idx = args.index("--startvm")
+            if idx + 1 < len(args) and args[idx + 1] in wanted:
+                return int(pid)
+
+        return None
+
+    def _transition(self, state: Optional[str], on_transition: Optional[Callable[[Optional[str], str], None]]):
+        if state is None or state == self.state:
+            return
+        logger.debug(f"VM {self.sandbox_id}: {self.state} -> {state}")
+        if self.state is not None:
+            self.client.on_vm_event(self.sandbox_id)
+        if on_transition is not None:
+            on_transition(self.state, state)
+        self.state = state
+
+    def _wait_for_process(self, pid: int, timeout: Optional[float]) -> bool:
+        """
+        Blocks until the process exits.
+
+        :return: Returns True if the process exited, False on timeout or if no pidfd could be opened
+        :rtype: bool
+        """
+        try:
+            pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            return False
+
+        try:
+            readable, _, _ = select.select([pidfd], [], [], timeout)
+            return bool(readable)
+        finally:
+            os.close(pidfd)
+
+    def wait_for_stop(self, timeout: Optional[float] = None,
+                      on_transition: Optional[Callable[[Optional[str], str], None]] = None) -> Optional[str]:
+        """
+        Blocks until the VM is no longer running and reports every observed state transition.
+
+        :param timeout: Seconds to wait, None waits forever
+        :type timeout: Optional[float]
+        :param on_transition: Callback invoked with (old_state, new_state)
+        :type on_transition: Optional[Callable[[Optional[str], str], None]]
+        :return: Returns the final state (saved, poweroff, aborted, ...), the last active state on timeout or None
+                    if the VM is unknown
+        :rtype: Optional[str]
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = self.poll_interval
+
+        while True:
+            state = self.query_state()
+            self._transition(state, on_transition)
+            if state not in ACTIVE_STATES:
+                return state
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return state
+
+            pid = self.find_vm_process()
+            if pid is not None and self._wait_for_process(pid, remaining):
+                # VBoxSVC may need a moment to record the final state after the process exited
+                interval = self.poll_interval
+                continue
+
+            sleep = interval if remaining is None else min(interval, remaining)
+            time.sleep(sleep)
+            interval = min(interval * 2, self.max_poll_interval)
+
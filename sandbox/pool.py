@@ -0,0 +1,218 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from sandbox.core import Sandbox
+from sandbox.governor import ResourceGovernor
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class VMPool:
+    """
+    Registry of sandbox VMs that are handed out to one session at a time.
+
+    With a governor, VMs are only started while the host has room for them and are started with its limits.
+    """
+
+    def __init__(self, sandboxes: List[Sandbox], governor: Optional[ResourceGovernor] = None):
+        self.sandboxes = list(sandboxes)
+        self.governor = governor
+        self.idle = list(self.sandboxes)
+        self.busy = set()
+        self.waiting = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self.sandboxes)
+
+    def acquire(self, timeout: Optional[float] = None) -> Sandbox:
+        """
+        Takes an idle VM out of the pool, waiting for one to be released if all of them are busy.
+
+        :param timeout: Seconds to wait, None waits forever
+        :type timeout: Optional[float]
+        :rtype: Sandbox
+        :raises PoolExhausted: if no VM became idle within timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while not self.idle:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise PoolExhausted(f"No idle VM within {timeout}s")
+                    self._cond.wait(remaining)
+
+                sandbox = self.idle.pop(0)
+                self.busy.add(sandbox)
+                return sandbox
+            finally:
+                self.waiting -= 1
+
+    def prepare(self, sandbox: Sandbox) -> bool:
+        """
+        Makes an acquired VM ready to receive a device (cold boot).
+
+        :param sandbox: VM previously returned by acquire
+        :type sandbox: Sandbox
+        :return: Returns True if the VM was started
+        :rtype: bool
+        """
+        sandbox.provision_usb()
+        return self._start(sandbox)
+
+    def _start(self, sandbox: Sandbox, *args: str) -> bool:
+        # admits the start, applies the limits and boots the VM; the reservation is kept until the VM is released
+        if self.governor is None:
+            return sandbox.run_sandbox(*args)
+        self.governor.admit(sandbox)
+        started = False
+        try:
+            self.governor.apply_limits(sandbox)
+            started = sandbox.run_sandbox(*args)
+        finally:
+            if started:
+                self.governor.launched(sandbox)
+                # a VM resumed from a saved snapshot only takes the limits while it runs
+                self.governor.apply_limits(sandbox)
+            else:
+                self.governor.release(sandbox)
+        return started
+
+    def release(self, sandbox: Sandbox):
+        """
+        Returns a VM to the pool.
+
+        :param sandbox: VM previously returned by acquire
+        :type sandbox: Sandbox
+        """
+        if self.governor is not None:
+            self.governor.release(sandbox)
+        with self._cond:
+            self.busy.discard(sandbox)
+            self.idle.append(sandbox)
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, object]:
+        with self._cond:
+            stats = {"size": len(self.sandboxes), "idle": len(self.idle), "busy": len(self.busy),
+                     "waiting": self.waiting}
+        if self.governor is not None:
+            stats["governor"] = self.governor.stats()
+        return stats
+
+
+class WarmPool(VMPool):
+    """
+    Pool that keeps its VMs running from a clean snapshot, so a device can be attached as soon as it is detected.
+
+    After a session the VM is restored to the snapshot and started again in the background - at most
+    max_parallel_restores at a time - so it is ready again before the next stick arrives. Only warm_size VMs are kept
+    running, the others are restored but stay powered off until they are needed.
+    """
+
+    def __init__(self, sandboxes: List[Sandbox], snapshot: str, warm_size: Optional[int] = None,
+                 max_parallel_restores: int = 1, start_args: Tuple[str, ...] = ("--type", "headless"),
+                 governor: Optional[ResourceGovernor] = None):
+        super().__init__(sandboxes, governor)
+        self.snapshot = snapshot
+        self.warm_size = len(self.sandboxes) if warm_size is None else warm_size
+        self.start_args = start_args
+        self.warm = set()
+        self.restoring = set()
+        self.timings = {x.sandbox_id: {"restore": [], "boot": []} for x in self.sandboxes}
+        self.idle = list()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_parallel_restores), thread_name_prefix="restore")
+
+    def warm_up(self):
+        """
+        Restores all VMs to the clean snapshot in the background. Each VM becomes available as soon as it is ready.
+        """
+        for sandbox in self.sandboxes:
+            self._schedule_restore(sandbox)
+
+    def _schedule_restore(self, sandbox: Sandbox):
+        with self._cond:
+            self.restoring.add(sandbox)
+        self.executor.submit(self._restore, sandbox)
+
+    def _boot(self, sandbox: Sandbox) -> bool:
+        start = time.monotonic()
+        started = self._start(sandbox, *self.start_args)
+        self.timings[sandbox.sandbox_id]["boot"].append(time.monotonic() - start)
+        return started
+
+    def _restore(self, sandbox: Sandbox):
+        try:
+            if sandbox.client.is_running(sandbox.sandbox_id, refresh=True):
+                sandbox.power_off()
+            if self.governor is not None:
+                self.governor.release(sandbox)
+
+            start = time.monotonic()
+            restored = sandbox.restore_snapshot(self.snapshot)
+            self.timings[sandbox.sandbox_id]["restore"].append(time.monotonic() - start)
+            # the snapshot reverted the VM's settings: the USB configuration is checked again and the limits are
+            # applied again on boot. A saved snapshot lacking USB controllers or filter cannot be provisioned, the
+            # provisioner only logs that
+            if self.governor is not None:
+                self.governor.forget(sandbox)
+            sandbox.provision_usb()
+
+            with self._cond:
+                keep_warm = restored and len(self.warm) < self.warm_size
+            if keep_warm and self._boot(sandbox):
+                with self._cond:
+                    self.warm.add(sandbox)
+        except Exception as e:
+            logger.error(f"Could not restore {sandbox.sandbox_id}: {e}")
+        finally:
+            with self._cond:
+                self.restoring.discard(sandbox)
+                # warm VMs are handed out first
+                if sandbox in self.warm:
+                    self.idle.insert(0, sandbox)
+                else:
+                    self.idle.append(sandbox)
+                self._cond.notify()
+
+    def prepare(self, sandbox: Sandbox) -> bool:
+        """
+        Warm VMs are already running; cold ones are booted from their restored snapshot.
+        """
+        return sandbox in self.warm or self._boot(sandbox)
+
+    def release(self, sandbox: Sandbox):
+        """
+        Takes the VM back and restores it to the clean snapshot asynchronously.
+        """
+        with self._cond:
+            self.busy.discard(sandbox)
+            self.warm.discard(sandbox)
+        self._schedule_restore(sandbox)
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait)
+
+    def stats(self) -> Dict[str, object]:
+        stats = super().stats()
+
+        def mean(values):
+            return sum(values) / len(values) if values else None
+
+        with self._cond:
+            stats.update({"warm": len(self.warm), "restoring": len(self.restoring)})
+            stats["timings"] = {vm: {"restores": len(t["restore"]), "restore_mean": mean(t["restore"]),
+                                     "boots": len(t["boot"]), "boot_mean": mean(t["boot"])}
+                                for vm, t in self.timings.items()}
+        return stats
@@ -0,0 +1,158 @@
+import logging
+import re
+import threading
+import weakref
+from typing import Dict, List, Tuple
+
+from sandbox.vboxmanage import VBoxManage
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# showvminfo key of each USB controller -> modifyvm option
+USB_CONTROLLERS = {
+    "usb": "--usbohci",
+    "ehci": "--usbehci",
+    "xhci": "--usbxhci",
+}
+DEFAULT_CONTROLLERS = ("usb", "ehci", "xhci")
+DEFAULT_FILTER = "allow_all_usbs"
+
+# VM states in which modifyvm and usbfilter may change the configuration
+CONFIGURABLE_STATES = ("poweroff", "aborted")
+
+USB_FILTER_NAME = re.compile(r"^USBFilterName(\d+)$")
+
+
+def usb_filters(info: Dict[str, str]) -> List[str]:
+    """
+    Returns the names of the VM's USB filters in index order.
+
+    :param info: Output of 'showvminfo --machinereadable'
+    :type info: Dict[str, str]
+    :rtype: List[str]
+    """
+    filters = dict()
+    for key, value in info.items():
+        match = USB_FILTER_NAME.match(key)
+        if match:
+            filters[int(match.group(1))] = value
+    return [filters[x] for x in sorted(filters)]
+
+
+class USBProvisioner:
+    """
+    Brings the USB configuration of VMs (enabled controllers, one catch-all USB filter) to the desired state.
+
+    The current configuration is read from showvminfo and only the missing settings are applied - while the VM is
+    powered off, since modifyvm fails on a running VM. Duplicate filters left behind by older versions are removed.
+    Provisioned VMs are remembered by UUID, so later sessions do not run any configuration command.
+    """
+
+    def __init__(self, client: VBoxManage, controllers: Tuple[str, ...] = DEFAULT_CONTROLLERS,
+                 filter_name: str = DEFAULT_FILTER):
+        self.client = client
+        self.controllers = controllers
+        self.filter_name = filter_name
+        self.provisioned = set()
+        self._lock = threading.Lock()
+
+    def plan(self, info: Dict[str, str]) -> List[Tuple[str, ...]]:
+        """
+        Computes the vboxmanage commands that turn the VM's configuration into the desired one.
+
+        :param info: Output of 'showvminfo --machinereadable'
+        :type info: Dict[str, str]
+        :return: Returns the vboxmanage argument lists, an empty list if the VM is provisioned
+        :rtype: List[Tuple[str, ...]]
+        """
+        vm = info.get("UUID") or info.get("name")
+        commands = list()
+
+        options = list()
+        for controller in self.controllers:
+            if info.get(controller) != "on":
+                options += [USB_CONTROLLERS[controller], "on"]
+        if options:
+            commands.append(("modifyvm", vm) + tuple(options))
+
+        filters = usb_filters(info)
+        matching = [i for i, name in enumerate(filters) if name == self.filter_name]
+        if not matching:
+            commands.append(("usbfilter", "add", str(len(filters)), "--target", vm, "--name", self.filter_name))
+        # remove duplicates from the back, so the remaining indexes stay valid
+        for index in reversed(matching[1:]):
+            commands.append(("usbfilter", "remove", str(index), "--target", vm))
+        return commands
+
+    def provision(self, sandbox_id: str) -> List[Tuple[str, ...]]:
+        """
+        Provisions the VM if it has not been provisioned yet.
+
+        :param sandbox_id: Name or UUID of the VM
+        :type sandbox_id: str
+        :return: Returns the commands that have been run
+        :rtype: List[Tuple[str, ...]]
+        """
+        with self._lock:
+            if sandbox_id in self.provisioned:
+                return []
+
+            info = self.client.showvminfo(sandbox_id)
+            if info is None:
+                logger.error(f"Cannot provision unknown VM {sandbox_id}")
+                return []
+            uuid = info.get("UUID", sandbox_id)
+            if uuid in self.provisioned:
+                self.provisioned.add(sandbox_id)
+                return []
+
+            commands = self.plan(info)
+            if commands and info.get("VMState") not in CONFIGURABLE_STATES:
+                logger.error(f"USB configuration of {sandbox_id} is incomplete, but the VM is {info.get('VMState')}. "
+                             f"Power it off once to apply: {commands}")
+                return []
+
+            applied = list()
+            for command in commands:
+                returncode, stdout, stderr = self.client.run(*command)
+                applied.append(command)
+                if returncode != 0:
+                    logger.error(f"vboxmanage {' '.join(command)} failed: {stderr.strip()}")
+                    self.client.invalidate("showvminfo", sandbox_id)
+                    return applied
+            if applied:
+                self.client.invalidate("showvminfo", sandbox_id)
+                logger.debug(f"Provisioned USB of {sandbox_id}: {applied}")
+
+            self.provisioned.update({uuid, sandbox_id})
+            return applied
+
+    def forget(self, sandbox_id: str):
+        """
+        Forgets that the VM has been provisioned, e.g. because a snapshot restored its old configuration. It is checked
+        again on the next provision.
+
+        :param sandbox_id: Name or UUID of the VM
+        :type sandbox_id: str
+        """
+        info = self.client.showvminfo(sandbox_id) or {}
+        with self._lock:
+            self.provisioned.difference_update({sandbox_id, info.get("UUID", sandbox_id)})
+
+
+_provisioners = weakref.WeakKeyDictionary()
+_provisioners_lock = threading.Lock()
+
+
+def provisioner_for(client: VBoxManage) -> USBProvisioner:
+    """
+    Returns the provisioner of a vboxmanage client, so every Sandbox sharing the client shares its provisioned VMs.
+
+    :rtype: USBProvisioner
+    """
+    with _provisioners_lock:
+        if client not in _provisioners:
+            _provisioners[client] = USBProvisioner(client)
+        return _provisioners[client]
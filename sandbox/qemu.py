@@ -0,0 +1,356 @@
+import collections
+import itertools
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sandbox.backend import Backend
+from sandbox.lifecycle import PAUSED, POWERED_OFF, RUNNING
+from usb.core import USB
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+COMMAND_TIMEOUT = 10.0
+DETACH_TIMEOUT = 5.0
+# events kept for wait_for_event, older ones are dropped
+EVENT_BACKLOG = 256
+
+# QMP event -> VM state
+EVENT_STATES = {"STOP": PAUSED, "RESUME": RUNNING, "SHUTDOWN": "shutdown"}
+
+
+class QMPError(Exception):
+    """
+    A QMP command failed or the connection to QEMU was lost.
+    """
+
+    def __init__(self, message: str, error_class: Optional[str] = None):
+        super().__init__(message)
+        self.error_class = error_class
+
+
+class QMPClient:
+    """
+    One persistent connection to the QMP socket of a QEMU process (-qmp unix:PATH,server=on,wait=off).
+
+    Commands from several threads share the connection: a reader thread hands every reply to the caller waiting for
+    its id and keeps the asynchronous events (STOP, SHUTDOWN, DEVICE_DELETED, ...) for wait_for_event. The connection
+    is opened on the first command and again after it was lost.
+    """
+
+    def __init__(self, path: str, timeout: float = COMMAND_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.greeting = None
+        self.connects = 0
+        self._sock = None
+        self._ids = itertools.count(1)
+        self._pending = dict()
+        self._events = collections.deque(maxlen=EVENT_BACKLOG)
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def connect(self):
+        """
+        Opens the connection and negotiates the capabilities unless the client is connected already.
+
+        :raises QMPError: If QEMU cannot be reached
+        """
+        with self._lock:
+            if self._sock is not None:
+                return
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.path)
+                reader = sock.makefile("rb")
+                self.greeting = json.loads(reader.readline() or b"null")
+                if not isinstance(self.greeting, dict) or "QMP" not in self.greeting:
+                    raise QMPError(f"{self.path} is not a QMP socket")
+                sock.sendall(b'{"execute": "qmp_capabilities"}\n')
+                while True:
+                    message = json.loads(reader.readline() or b"null")
+                    if message is None:
+                        raise QMPError(f"QEMU closed {self.path} during the handshake")
+                    if "return" in message:
+                        break
+                    if "error" in message:
+                        raise QMPError(message["error"].get("desc", "qmp_capabilities failed"),
+                                       message["error"].get("class"))
+            except (OSError, ValueError) as e:
+                sock.close()
+                raise QMPError(f"Could not connect to QMP socket {self.path}: {e}")
+            except QMPError:
+                sock.close()
+                raise
+
+            sock.settimeout(None)
+            self._sock = sock
+            self.connects += 1
+            threading.Thread(target=self._read, args=(sock, reader), name=f"qmp-{os.path.basename(self.path)}",
+                             daemon=True).start()
+
+    def _read(self, sock: socket.socket, reader):
+        try:
+            for line in reader:
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    logger.error(f"Invalid QMP message from {self.path}: {line!r}")
+                    continue
+                with self._condition:
+                    if "event" in message:
+                        self._sequence += 1
+                        self._events.append((self._sequence, message))
+                    elif message.get("id") in self._pending:
+                        self._pending[message["id"]] = message
+                    self._condition.notify_all()
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._condition:
+                if self._sock is sock:
+                    self._sock = None
+                # wakes up every caller waiting for a reply or an event
+                self._sequence += 1
+                self._events.append((self._sequence, {"event": "DISCONNECTED"}))
+                self._condition.notify_all()
+            sock.close()
+
+    def execute(self, command: str, arguments: Optional[Dict[str, object]] = None,
+                timeout: Optional[float] = None) -> object:
+        """
+        Runs a QMP command.
+
+        :param command: QMP command (e.g. device_add)
+        :type command: str
+        :param arguments: Arguments of the command
+        :type arguments: Optional[Dict[str, object]]
+        :param timeout: Seconds to wait for the reply
+        :type timeout: Optional[float]
+        :return: Returns the "return" value of the reply
+        :raises QMPError: If the command failed, timed out or the connection was lost
+        """
+        self.connect()
+        message = {"execute": command, "id": next(self._ids)}
+        if arguments:
+            message["arguments"] = arguments
+        data = (json.dumps(message) + "\n").encode("UTF-8")
+
+        deadline = time.monotonic() + (timeout if timeout is not None else self.timeout)
+        with self._condition:
+            sock = self._sock
+            if sock is None:
+                raise QMPError(f"QMP connection to {self.path} was lost")
+            self._pending[message["id"]] = None
+        try:
+            # not sent while holding the lock, the reader thread has to keep draining the socket meanwhile
+            with self._send_lock:
+                sock.sendall(data)
+            with self._condition:
+                while self._pending[message["id"]] is None:
+                    remaining = deadline - time.monotonic()
+                    if self._sock is not sock:
+                        raise QMPError(f"QMP connection to {self.path} was lost during {command}")
+                    if remaining <= 0:
+                        raise QMPError(f"{command} timed out")
+                    self._condition.wait(remaining)
+                reply = self._pending[message["id"]]
+        except OSError as e:
+            raise QMPError(f"Could not send {command} to {self.path}: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(message["id"], None)
+
+        if "error" in reply:
+            raise QMPError(f"{command}: {reply['error'].get('desc')}", reply["error"].get("class"))
+        return reply.get("return")
+
+    @property
+    def sequence(self) -> int:
+        """
+        Sequence number of the latest event, pass it to wait_for_event to only see events that happen afterwards.
+        """
+        with self._lock:
+            return self._sequence
+
+    def wait_for_event(self, predicate: Callable[[dict], bool], since: int = 0,
+                       timeout: Optional[float] = None) -> Optional[Tuple[int, dict]]:
+        """
+        Blocks until an event newer than since matches the predicate. Losing the connection is reported as the
+        event DISCONNECTED.
+
+        :return: Returns (sequence number, event) or None on timeout
+        :rtype: Optional[Tuple[int, dict]]
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._condition:
+            while True:
+                for sequence, event in self._events:
+                    if sequence > since and predicate(event):
+                        return sequence, event
+                if self._events:
+                    since = max(since, self._events[-1][0])
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def close(self):
+        with self._lock:
+            sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+class QEMUBackend(Backend):
+    """
+    QEMU/KVM VMs controlled through their QMP sockets, without starting any process.
+
+    The VMs are launched outside of this tool (e.g. by a systemd unit), with a QMP socket named after the VM in
+    socket_dir and, to start them later, paused with -S:
+
+        qemu-system-x86_64 -name analysis -S -qmp unix:/run/mount-usb-in-sandbox/analysis.qmp,server=on,wait=off \
+            -device qemu-xhci ...
+
+    USB devices are passed through with device_add usb-host, addressed by host bus and device number.
+    """
+    name = "qemu"
+
+    def __init__(self, socket_dir: Optional[str] = None, sockets: Optional[Dict[str, str]] = None,
+                 timeout: float = COMMAND_TIMEOUT):
+        self.socket_dir = socket_dir
+        self.sockets = dict(sockets or {})
+        self.timeout = timeout
+        self._clients = dict()
+        self._lock = threading.Lock()
+
+    def client(self, sandbox_id: str) -> QMPClient:
+        """
+        Returns the (persistent) QMP client of a VM.
+
+        :rtype: QMPClient
+        """
+        with self._lock:
+            if sandbox_id not in self._clients:
+                path = self.sockets.get(sandbox_id) or os.path.join(self.socket_dir or ".", f"{sandbox_id}.qmp")
+                self._clients[sandbox_id] = QMPClient(path, self.timeout)
+            return self._clients[sandbox_id]
+
+    def status(self, sandbox_id: str) -> Optional[str]:
+        """
+        Returns the QEMU run state (e.g. prelaunch, running, paused, shutdown), None if QEMU is not reachable.
+
+        :rtype: Optional[str]
+        """
+        try:
+            return self.client(sandbox_id).execute("query-status").get("status")
+        except QMPError as e:
+            logger.debug(f"query-status of {sandbox_id}: {e}")
+            return None
+
+    def start(self, sandbox_id: str, *args: str) -> bool:
+        status = self.status(sandbox_id)
+        if status is None:
+            logger.error(f"QEMU VM {sandbox_id} is not reachable on {self.client(sandbox_id).path}")
+            return False
+        if status == RUNNING:
+            return True
+        try:
+            if status == "shutdown":
+                self.client(sandbox_id).execute("system_reset")
+            self.client(sandbox_id).execute("cont")
+        except QMPError as e:
+            logger.error(f"Could not start QEMU VM {sandbox_id}: {e}")
+            return False
+        return True
+
+    def power_off(self, sandbox_id: str) -> bool:
+        client = self.client(sandbox_id)
+        try:
+            client.execute("quit")
+        except QMPError as e:
+            # QEMU may exit before its reply to quit is read
+            if client.connected:
+                logger.error(f"Could not power off QEMU VM {sandbox_id}: {e}")
+                return False
+        return True
+
+    def resolve_usb(self, devices: List[USB]) -> List[str]:
+        ids = list()
+        for obj in devices:
+            if obj.busnum is None or obj.devnum is None:
+                logger.error(f"USB device {obj.device_id} (port {obj.port_path}) has no bus/device number")
+                continue
+            device = f"usb-{obj.busnum}-{obj.devnum}"
+            if device not in ids:
+                ids.append(device)
+        return ids
+
+    @staticmethod
+    def host_address(device: str) -> Tuple[int, int]:
+        """
+        Returns (host bus, host address) of a device ID returned by resolve_usb.
+
+        :rtype: Tuple[int, int]
+        """
+        _, bus, address = device.split("-")
+        return int(bus), int(address)
+
+    def attach_usb(self, sandbox_id: str, device: str) -> Tuple[bool, str]:
+        bus, address = self.host_address(device)
+        try:
+            self.client(sandbox_id).execute("device_add", {"driver": "usb-host", "id": device, "hostbus": bus,
+                                                           "hostaddr": address})
+        except QMPError as e:
+            return False, str(e)
+        return True, ""
+
+    def detach_usb(self, sandbox_id: str, device: str) -> Tuple[bool, str]:
+        client = self.client(sandbox_id)
+        since = client.sequence
+        try:
+            client.execute("device_del", {"id": device})
+        except QMPError as e:
+            return False, str(e)
+
+        # device_del only requests the removal, the guest confirms it with DEVICE_DELETED
+        event = client.wait_for_event(lambda x: x["event"] == "DISCONNECTED" or (
+            x["event"] == "DEVICE_DELETED" and x.get("data", {}).get("device") == device), since, DETACH_TIMEOUT)
+        if event is None:
+            return False, f"{device} was not removed within {DETACH_TIMEOUT}s"
+        return True, ""
+
+    def wait_for_stop(self, sandbox_id: str, on_transition: Optional[Callable[[str, str], None]] = None) -> str:
+        client = self.client(sandbox_id)
+        since = client.sequence
+        state = self.status(sandbox_id)
+        if state is None:
+            return POWERED_OFF
+
+        while True:
+            since, event = client.wait_for_event(lambda x: x["event"] in EVENT_STATES or x["event"] == "DISCONNECTED",
+                                                 since)
+            new_state = EVENT_STATES.get(event["event"], POWERED_OFF)
+            if new_state != state:
+                if on_transition is not None:
+                    on_transition(state, new_state)
+                state = new_state
+            if event["event"] in ("SHUTDOWN", "DISCONNECTED"):
+                return state
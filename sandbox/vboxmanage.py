@@ -0,0 +1,417 @@
+import logging
+import shlex
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from execution.core import Executor, default_executor
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# seconds a query result stays valid if no hotplug or VM event invalidated it before
+DEFAULT_TTLS = {
+    "vms": 60.0,
+    "runningvms": 2.0,
+    "usbhost": 10.0,
+    "showvminfo": 2.0,
+}
+
+
+class VBoxManageError(Exception):
+    pass
+
+
+class VirtualMachine:
+    __slots__ = ('name', 'uuid')
+
+    def __init__(self, name: str, uuid: str):
+        self.name = name
+        self.uuid = uuid
+
+    def __repr__(self):
+        return f"VirtualMachine({self.name!r}, {self.uuid!r})"
+
+    def matches(self, sandbox_id: str) -> bool:
+        return sandbox_id in (self.name, self.uuid)
+
+
+class UsbHost:
+    """
+    A host USB device as listed by 'vboxmanage list usbhost'.
+    """
+    __slots__ = ('uuid', 'vendor_id', 'product_id', 'revision', 'manufacturer', 'product', 'serial', 'address',
+                 'port', 'current_state')
+
+    def __init__(self, **fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    def __repr__(self):
+        return f"UsbHost({self.uuid!r}, {self.device_id!r}, serial={self.serial!r}, state={self.current_state!r})"
+
+    @property
+    def device_id(self) -> str:
+        return f"{self.vendor_id}:{self.product_id}"
+
+    @property
+    def port_path(self) -> Optional[str]:
+        """
+        Physical port path (e.g. 1-2.3) taken from the sysfs part of the Address field
+        (sysfs:/sys/devices/.../usb1/1-2.3//device:/dev/vboxusb/001/005).
+        """
+        if not self.address or not self.address.startswith("sysfs:"):
+            return None
+        sysfs_path = self.address[len("sysfs:"):].split("//device:")[0].rstrip("/")
+        return sysfs_path.rsplit("/", 1)[-1] or None
+
+    @property
+    def bus_address(self) -> Optional[Tuple[int, int]]:
+        """
+        (busnum, devnum) taken from the device node at the end of the Address field.
+        """
+        if not self.address:
+            return None
+        parts = self.address.rstrip("/").split("/")
+        try:
+            return int(parts[-2]), int(parts[-1])
+        except (IndexError, ValueError):
+            return None
+
+
+class UsbHostIndex:
+    """
+    Hashed index over the host USB devices known to VirtualBox, built in a single pass.
+
+    Resolving a device is O(1) and exact as long as the device can be told apart by its port path, bus address or
+    serial number - which also holds for a hub full of identical drives.
+    """
+
+    def __init__(self, devices: List[UsbHost]):
+        self.by_key = dict()
+        self.by_port = dict()
+        self.by_bus_address = dict()
+        self.by_serial = dict()
+        self.by_device_id = dict()
+        for device in devices:
+            self.by_key[(device.vendor_id, device.product_id, device.serial, device.port_path)] = device
+            if device.port_path:
+                self.by_port[device.port_path] = device
+            if device.bus_address:
+                self.by_bus_address[device.bus_address] = device
+            if device.serial:
+                self.by_serial.setdefault((device.device_id, device.serial), []).append(device)
+            self.by_device_id.setdefault(device.device_id, []).append(device)
+
+    def resolve(self, usb) -> Optional[UsbHost]:
+        """
+        Finds the VirtualBox host USB device of a USB object.
+
+        :param usb: USB object (device_id, vendor_id, product_id, serial and optionally port_path, busnum, devnum)
+        :return: Returns the matching host device or None if it is unknown or ambiguous
+        :rtype: Optional[UsbHost]
+        """
+        port_path = getattr(usb, "port_path", None)
+        device = self.by_key.get((usb.vendor_id, usb.product_id, usb.serial, port_path))
+        if device is not None:
+            return device
+
+        candidates = [self.by_port.get(port_path)]
+        busnum, devnum = getattr(usb, "busnum", None), getattr(usb, "devnum", None)
+        if busnum is not None and devnum is not None:
+            candidates.append(self.by_bus_address.get((busnum, devnum)))
+        for device in candidates:
+            if device is not None and device.device_id == usb.device_id:
+                return device
+
+        if port_path is not None or busnum is not None:
+            # the device is known by location but VirtualBox does not list it there (anymore)
+            return None
+        matches = self.by_serial.get((usb.device_id, usb.serial)) if usb.serial \
+            else self.by_device_id.get(usb.device_id)
+        if matches and len(matches) == 1:
+            return matches[0]
+        return None
+
+
+# 'vboxmanage list usbhost' field name -> UsbHost attribute
+_USBHOST_FIELDS = {
+    "UUID": "uuid",
+    "VendorId": "vendor_id",
+    "ProductId": "product_id",
+    "Revision": "revision",
+    "Manufacturer": "manufacturer",
+    "Product": "product",
+    "SerialNumber": "serial",
+    "Address": "address",
+    "Port": "port",
+    "Current State": "current_state",
+}
+
+
+def parse_machinereadable(text: str) -> Dict[str, str]:
+    """
+    Parses the output of 'vboxmanage showvminfo --machinereadable' (key="value" lines).
+
+    :param text: Output of the command
+    :type text: str
+    :return: Returns a dict of all keys and their unquoted values
+    :rtype: Dict[str, str]
+    """
+    info = dict()
+    for line in text.splitlines():
+        key, sep, value = line.partition("=")
+        if not sep:
+            continue
+        key = key.strip().strip('"')
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1]
+        info[key] = value
+    return info
+
+
+def parse_vm_list(text: str) -> List[VirtualMachine]:
+    """
+    Parses the output of 'vboxmanage list vms' / 'vboxmanage list runningvms' ("name" {uuid} lines).
+
+    :rtype: List[VirtualMachine]
+    """
+    vms = list()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.endswith("}") or "{" not in line:
+            continue
+        name, _, uuid = line[:-1].rpartition("{")
+        vms.append(VirtualMachine(name=name.strip().strip('"'), uuid=uuid))
+    return vms
+
+
+def _parse_hex_id(value: str) -> str:
+    # "0x0781 (0781)" -> "0781"
+    value = value.split()[0] if value else value
+    try:
+        return f"{int(value, 16):04x}"
+    except ValueError:
+        return value
+
+
+def parse_usbhost(text: str) -> List[UsbHost]:
+    """
+    Parses the output of 'vboxmanage list usbhost' in a single pass. Records are separated by blank lines and every
+    record keeps all of its fields, including SerialNumber, Address and Port.
+
+    :rtype: List[UsbHost]
+    """
+    devices = list()
+    fields = dict()
+    for line in text.splitlines() + [""]:
+        key, sep, value = line.partition(":")
+        key = key.strip()
+        if sep and key in _USBHOST_FIELDS:
+            if key == "UUID" and "uuid" in fields:
+                devices.append(UsbHost(**fields))
+                fields = dict()
+            fields[_USBHOST_FIELDS[key]] = value.strip()
+        elif not line.strip() and "uuid" in fields:
+            devices.append(UsbHost(**fields))
+            fields = dict()
+
+    for device in devices:
+        device.vendor_id = _parse_hex_id(device.vendor_id)
+        device.product_id = _parse_hex_id(device.product_id)
+    return devices
+
+
+class VBoxManage:
+    """
+    Client for the vboxmanage CLI that parses its output into records and caches query results.
+
+    Every query result is cached for a per-query TTL. Hotplug events invalidate the usbhost list and VM events (start,
+    state transitions, attach) invalidate the VM related queries, so a full insert-to-attach cycle runs each query at
+    most once.
+    """
+
+    def __init__(self, command: str = "vboxmanage", ttls: Optional[Dict[str, float]] = None,
+                 clock: Callable[[], float] = time.monotonic, executor: Optional[Executor] = None):
+        self.command = shlex.split(command)
+        self.executor = executor
+        self.ttls = dict(DEFAULT_TTLS, **(ttls or {}))
+        self.clock = clock
+        self.executions = dict()
+        self._cache = dict()
+        self._lock = threading.Lock()
+
+    def run(self, *args: str, timeout: Optional[float] = None) -> Tuple[int, str, str]:
+        """
+        Runs vboxmanage with the given arguments (uncached).
+
+        :param timeout: Seconds until vboxmanage is killed, defaults to the executor's vboxmanage timeout
+        :type timeout: Optional[float]
+        :return: Returns (returncode, stdout, stderr)
+        :rtype: Tuple[int, str, str]
+        """
+        executor = self.executor if self.executor is not None else default_executor()
+        result = executor.run(self.command + list(args), tool="vboxmanage", timeout=timeout)
+        with self._lock:
+            self.executions[args[0]] = self.executions.get(args[0], 0) + 1
+        if not result.ok:
+            logger.debug(f"vboxmanage {' '.join(args)}: {result.stderr_text.strip()}")
+        return (result.returncode if result.returncode is not None else -1), result.stdout_text, result.stderr_text
+
+    async def run_async(self, *args: str, timeout: Optional[float] = None) -> Tuple[int, str, str]:
+        """
+        Runs vboxmanage with the given arguments without blocking the event loop.
+
+        :return: Returns (returncode, stdout, stderr)
+        :rtype: Tuple[int, str, str]
+        """
+        executor = self.executor if self.executor is not None else default_executor()
+        result = await executor.run_async(self.command + list(args), tool="vboxmanage", timeout=timeout)
+        with self._lock:
+            self.executions[args[0]] = self.executions.get(args[0], 0) + 1
+        if not result.ok:
+            logger.debug(f"vboxmanage {' '.join(args)}: {result.stderr_text.strip()}")
+        return (result.returncode if result.returncode is not None else -1), result.stdout_text, result.stderr_text
+
+    def _cached(self, kind: str, key: Tuple[str, ...], loader: Callable[[], object], refresh: bool = False):
+        now = self.clock()
+        with self._lock:
+            entry = self._cache.get((kind,) + key)
+            if entry is not None and entry[0] > now and not refresh:
+                return entry[1]
+
+        value = loader()
+        with self._lock:
+            self._cache[(kind,) + key] = (now + self.ttls[kind], value)
+        return value
+
+    def invalidate(self, kind: Optional[str] = None, vm: Optional[str] = None):
+        """
+        Drops cached query results.
+
+        :param kind: Query to invalidate (vms, runningvms, usbhost, showvminfo), None invalidates all queries
+        :type kind: Optional[str]
+        :param vm: Only invalidate showvminfo results of this VM (name or UUID)
+        :type vm: Optional[str]
+        """
+        with self._lock:
+            for key in list(self._cache):
+                if kind is not None and key[0] != kind:
+                    continue
+                if vm is not None and key[0] == "showvminfo" and not self._is_same_vm(key[1], vm):
+                    continue
+                del self._cache[key]
+
+    def _is_same_vm(self, cached_id: str, vm: str) -> bool:
+        if cached_id == vm:
+            return True
+        entry = self._cache.get(("showvminfo", cached_id))
+        # an unknown VM is cached as None
+        return entry is not None and entry[1] is not None and vm in (entry[1].get("name"), entry[1].get("UUID"))
+
+    def on_usb_event(self, *args):
+        """
+        Hotplug listener: a USB device was added or removed, so the usbhost list is stale.
+        """
+        self.invalidate("usbhost")
+
+    def on_vm_event(self, vm: str, *args):
+        """
+        VM listener: the state of vm changed, so the running VMs and its VM info are stale.
+        """
+        self.invalidate("runningvms")
+        self.invalidate("showvminfo", vm)
+
+    def _list(self, what: str) -> str:
+        returncode, stdout, stderr = self.run("list", what)
+        if returncode != 0:
+            raise VBoxManageError(stderr.strip())
+        return stdout
+
+    def list_vms(self, refresh: bool = False) -> List[VirtualMachine]:
+        return self._cached("vms", (), lambda: parse_vm_list(self._list("vms")), refresh)
+
+    def list_running_vms(self, refresh: bool = False) -> List[VirtualMachine]:
+        return self._cached("runningvms", (), lambda: parse_vm_list(self._list("runningvms")), refresh)
+
+    def list_usbhost(self, refresh: bool = False) -> List[UsbHost]:
+        return self._cached("usbhost", (), lambda: parse_usbhost(self._list("usbhost")), refresh)
+
+    def usbhost_index(self, refresh: bool = False) -> UsbHostIndex:
+        """
+        Returns the hashed index over the (cached) usbhost list.
+
+        :rtype: UsbHostIndex
+        """
+        return self._cached("usbhost", ("index",), lambda: UsbHostIndex(self.list_usbhost(refresh)), refresh)
+
+    def showvminfo(self, vm: str, refresh: bool = False) -> Optional[Dict[str, str]]:
+        """
+        Returns the machine readable VM info or None if the VM is unknown.
+
+        :rtype: Optional[Dict[str, str]]
+        """
+        def load():
+            returncode, stdout, stderr = self.run("showvminfo", vm, "--machinereadable")
+            return parse_machinereadable(stdout) if returncode == 0 else None
+
+        return self._cached("showvminfo", (vm,), load, refresh)
+
+    def find_vm(self, sandbox_id: str) -> Optional[VirtualMachine]:
+        """
+        Looks up a registered VM by name or UUID.
+
+        :rtype: Optional[VirtualMachine]
+        """
+        for vm in self.list_vms():
+            if vm.matches(sandbox_id):
+                return vm
+        return None
+
+    def is_running(self, sandbox_id: str, refresh: bool = False) -> bool:
+        """
+        Checks if the VM (given by name or UUID) is running.
+
+        :rtype: bool
+        """
+        return any(vm.matches(sandbox_id) for vm in self.list_running_vms(refresh))
+
+    def startvm(self, sandbox_id: str, *args: str) -> Tuple[int, str, str]:
+        result = self.run("startvm", sandbox_id, *args)
+        self.on_vm_event(sandbox_id)
+        return result
+
+    async def startvm_async(self, sandbox_id: str, *args: str) -> Tuple[int, str, str]:
+        result = await self.run_async("startvm", sandbox_id, *args)
+        self.on_vm_event(sandbox_id)
+        return result
+
+    def controlvm(self, sandbox_id: str, *args: str) -> Tuple[int, str, str]:
+        result = self.run("controlvm", sandbox_id, *args)
+        if args and args[0] in ("usbattach", "usbdetach"):
+            self.invalidate("usbhost")
+        else:
+            self.on_vm_event(sandbox_id)
+        return result
+
+    def modifyvm(self, sandbox_id: str, *args: str) -> Tuple[int, str, str]:
+        result = self.run("modifyvm", sandbox_id, *args)
+        self.invalidate("showvminfo", sandbox_id)
+        return result
+
+
+_default_client = None
+
+
+def default_client() -> VBoxManage:
+    """
+    Returns the process wide vboxmanage client, so all call sites share one cache.
+
+    :rtype: VBoxManage
+    """
+    global _default_client
+    if _default_client is None:
+        _default_client = VBoxManage()
+    return _default_client
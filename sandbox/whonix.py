@@ -1,6 +1,71 @@
+import logging
+from typing import Dict
+
 from sandbox.core import Sandbox
 
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# set by the guest additions once the guest's first network adapter is configured
+GATEWAY_READY_PROPERTY = "/VirtualBox/GuestInfo/Net/0/Status"
+GATEWAY_READY_VALUE = "Up"
+
+
+class StartupError(Exception):
+    pass
+
 
 class Whonix(Sandbox):
+    """
+    Whonix workstation together with the gateway it routes its traffic through.
+    """
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.gateway = kwargs.get('gateway', None)
+        self.ready_property = kwargs.get('ready_property', GATEWAY_READY_PROPERTY)
+        self.ready_timeout = kwargs.get('ready_timeout', 120)
+
+    def start(self) -> Dict[str, object]:
+        """
+        Starts the gateway, waits until it is ready and starts the workstation. session.mount_pipeline runs the same
+        steps as stages of a mount session.
+
+        :return: Returns a dict of step name -> return value
+        :rtype: Dict[str, object]
+        :raises StartupError: if a VM could not be started or the gateway did not become ready
+        """
+        results = dict()
+        if self.gateway is not None:
+            results["start_gateway"] = self.start_gateway()
+            results["gateway_ready"] = self.wait_for_gateway()
+        results["start_vm"] = self.start_workstation()
+        return results
+
+    def start_gateway(self) -> bool:
+        """
+        :raises StartupError: if the gateway could not be started
+        """
+        if not self.gateway.run_sandbox():
+            raise StartupError(f"Could not start Whonix gateway {self.gateway.sandbox_id}")
+        return True
+
+    def wait_for_gateway(self) -> bool:
+        """
+        Waits until the gateway reported that its network is up. The workstation is only started afterwards.
+
+        :raises StartupError: if the gateway did not become ready within ready_timeout seconds
+        """
+        if not self.gateway.wait_for_guest_property(self.ready_property, GATEWAY_READY_VALUE, self.ready_timeout):
+            raise StartupError(f"Whonix gateway {self.gateway.sandbox_id} did not report readiness within "
+                               f"{self.ready_timeout}s")
+        return True
+
+    def start_workstation(self) -> bool:
+        """
+        :raises StartupError: if the workstation could not be started
+        """
+        if not self.run_sandbox():
+            raise StartupError(f"Could not start Whonix workstation {self.sandbox_id}")
+        return True
@@ -0,0 +1,341 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+import journal.core
+import metrics.core
+import usb.core
+from sandbox.whonix import Whonix
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# seconds each stage of a mount session may take, None waits forever (e.g. for the sudo password)
+STAGE_TIMEOUTS = {
+    "disconnect_interfaces": None,
+    "check_group": 10,
+    "provision_usb": 120,
+    "start_gateway": 180,
+    "gateway_ready": 180,
+    "start_vm": 180,
+    "prepare_usbguard": 30,
+    "resolve_usb": 30,
+    "attach_usb": 180,
+}
+
+
+class PipelineError(Exception):
+    """
+    A stage of the pipeline failed or timed out. The stages that had completed have been rolled back.
+    """
+
+    def __init__(self, message: str, errors: Dict[str, BaseException]):
+        super().__init__(message)
+        self.errors = errors
+
+
+class Stage:
+    """
+    One step of a session.
+    """
+    __slots__ = ('name', 'func', 'depends', 'timeout', 'rollback', 'state', 'result', 'error', 'started', 'finished')
+
+    def __init__(self, name: str, func: Callable, depends: Iterable[str], timeout: Optional[float],
+                 rollback: Optional[Callable]):
+        self.name = name
+        self.func = func
+        self.depends = tuple(depends)
+        self.timeout = timeout
+        self.rollback = rollback
+        self.state = "pending"
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, {self.state})"
+
+
+class SessionPipeline:
+    """
+    Runs the stages of a session on an asyncio event loop, each one as soon as the stages it depends on are done.
+
+    Coroutine functions run on the loop, plain callables in worker threads. If a stage fails, times out or the
+    pipeline is cancelled, the remaining stages are cancelled and every stage that had completed is rolled back, in
+    reverse order of completion. A stage still running in a worker thread cannot be interrupted: it is rolled back as
+    soon as it finishes.
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        self.stages = dict()
+        self.results = dict()
+        self.completed = list()
+        self.rolled_back = list()
+        self._executor = None
+        self._origin = None
+
+    def add(self, name: str, func: Callable, depends: Iterable[str] = (), timeout: Optional[float] = None,
+            rollback: Optional[Callable[[object], object]] = None):
+        """
+        Adds a stage.
+
+        :param name: Unique name of the stage
+        :type name: str
+        :param func: Coroutine function or callable without arguments, its return value is stored in results[name]
+        :type func: Callable
+        :param depends: Names of the stages that have to complete before this stage may start
+        :type depends: Iterable[str]
+        :param timeout: Seconds the stage may take, None waits forever
+        :type timeout: Optional[float]
+        :param rollback: Undoes the stage, called (or awaited) with the stage's result
+        :type rollback: Optional[Callable[[object], object]]
+        """
+        self.stages[name] = Stage(name, func, depends, timeout, rollback)
+
+    def _validate(self):
+        for stage in self.stages.values():
+            unknown = [x for x in stage.depends if x not in self.stages]
+            if unknown:
+                raise PipelineError(f"Stage {stage.name} depends on unknown stages {unknown}", {})
+
+        visiting, done = set(), set()
+
+        def visit(name: str):
+            if name in done:
+                return
+            if name in visiting:
+                raise PipelineError(f"Circular dependency through stage {name}", {})
+            visiting.add(name)
+            for dependency in self.stages[name].depends:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def _completed(self, stage: Stage, result: object):
+        stage.result = result
+        stage.state = "completed"
+        stage.finished = time.monotonic() - self._origin
+        self.results[stage.name] = result
+        self.completed.append(stage)
+
+    @staticmethod
+    def _call(func: Callable) -> object:
+        try:
+            return func()
+        except SystemExit as e:
+            # SystemExit would tear down the event loop without any rollback
+            raise RuntimeError(f"exited with {e.code}") from e
+
+    def _late_rollback(self, stage: Stage, future: Future):
+        # a worker thread finished after its stage had been abandoned
+        if future.cancelled() or future.exception() is not None or stage.rollback is None:
+            return
+        logger.debug(f"Stage {stage.name} finished after it had been abandoned, rolling it back")
+        try:
+            result = stage.rollback(future.result())
+            if asyncio.iscoroutine(result):
+                asyncio.run(result)
+            stage.state = "rolled_back"
+            self.rolled_back.append(stage.name)
+        except Exception as e:
+            logger.error(f"Could not roll back stage {stage.name}: {e}")
+
+    async def _run_stage(self, stage: Stage, tasks: Dict[str, asyncio.Task]):
+        if stage.depends:
+            await asyncio.wait([tasks[x] for x in stage.depends])
+            failed = [x for x in stage.depends if self.stages[x].state != "completed"]
+            if failed:
+                stage.state = "skipped"
+                return
+
+        stage.state = "running"
+        stage.started = time.monotonic() - self._origin
+        with metrics.core.span("stage", stage=stage.name):
+            if asyncio.iscoroutinefunction(stage.func):
+                result = await asyncio.wait_for(stage.func(), stage.timeout)
+            else:
+                future = self._executor.submit(self._call, stage.func)
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), stage.timeout)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    future.add_done_callback(lambda f: self._late_rollback(stage, f))
+                    raise
+        self._completed(stage, result)
+
+    async def _rollback(self):
+        for stage in reversed(self.completed):
+            if stage.rollback is None:
+                continue
+            logger.debug(f"Rolling back stage {stage.name}")
+            try:
+                if asyncio.iscoroutinefunction(stage.rollback):
+                    await stage.rollback(stage.result)
+                else:
+                    await asyncio.get_running_loop().run_in_executor(self._executor, stage.rollback, stage.result)
+                stage.state = "rolled_back"
+                self.rolled_back.append(stage.name)
+            except Exception as e:
+                logger.error(f"Could not roll back stage {stage.name}: {e}")
+
+    async def run(self) -> Dict[str, object]:
+        """
+        Runs all stages.
+
+        :return: Returns a dict of stage name -> return value
+        :rtype: Dict[str, object]
+        :raises PipelineError: If a stage failed or timed out (after the completed stages have been rolled back)
+        :raises asyncio.CancelledError: If the pipeline was cancelled (after the rollback)
+        """
+        self._validate()
+        self._origin = time.monotonic()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="session")
+        tasks = dict()
+        for name, stage in self.stages.items():
+            tasks[name] = asyncio.ensure_future(self._run_stage(stage, tasks))
+
+        try:
+            done, pending = await asyncio.wait(tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+            errors = dict()
+            for name, task in tasks.items():
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    error = task.exception()
+                    if isinstance(error, asyncio.TimeoutError):
+                        error = TimeoutError(f"timed out after {self.stages[name].timeout}s")
+                    self.stages[name].state = "failed"
+                    self.stages[name].error = error
+                    errors[name] = error
+                    logger.error(f"Stage {name} failed: {error}")
+
+            if errors:
+                await self._cancel(pending)
+                await self._rollback()
+                raise PipelineError(", ".join(f"{k}: {v}" for k, v in errors.items()), errors)
+            return self.results
+        except asyncio.CancelledError:
+            await self._cancel([x for x in tasks.values() if not x.done()])
+            await self._rollback()
+            raise
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def _cancel(self, tasks: List[asyncio.Task]):
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for stage in self.stages.values():
+            if stage.state in ("pending", "running"):
+                stage.state = "cancelled"
+
+    def format_timings(self) -> str:
+        """
+        Returns one line per stage with its start offset and duration, ordered by start time.
+
+        :rtype: str
+        """
+        lines = list()
+        for stage in sorted((x for x in self.stages.values() if x.started is not None), key=lambda x: x.started):
+            end = stage.finished if stage.finished is not None else stage.started
+            lines.append(f"{stage.name:<24} start +{stage.started:7.3f}s  took {end - stage.started:7.3f}s  "
+                         f"{stage.state}")
+        return "\n".join(lines)
+
+
+def reconnect_network_interfaces(names: List[str]):
+    """
+    Brings the network interfaces up again and removes them from the journal.
+
+    :param names: Interfaces disconnected by the session
+    :type names: List[str]
+    """
+    if not names:
+        return
+    results = usb.core.USB.connect_disconnect_network_interfaces("connect", names)
+    journal.core.default_journal().revert(journal.core.INTERFACE, [x for x, r in results.items() if r.ok])
+
+
+def mount_pipeline(sandbox, usb_objects: List[usb.core.USB], usbguard: usb.core.USBGuard,
+                   disconnect: Callable[[], List[str]], check_group: Optional[Callable[[], bool]] = None,
+                   timeouts: Optional[Dict[str, float]] = None) -> SessionPipeline:
+    """
+    Builds the pipeline of a mount session. Host network teardown, the usbguard device table and the USB UUID lookup
+    run while the VM boots; the devices are attached once all of them are done. A Whonix workstation is started once
+    its gateway is up and ready.
+
+    :param sandbox: Sandbox (or Whonix workstation) that gets the devices
+    :param usb_objects: Detected USB devices
+    :type usb_objects: List[usb.core.USB]
+    :param usbguard: USBGuard object of the devices
+    :type usbguard: usb.core.USBGuard
+    :param disconnect: Disconnects the host's network interfaces and returns their names
+    :type disconnect: Callable[[], List[str]]
+    :param check_group: Checks that the user may pass USB devices to the VM, skipped if None
+    :type check_group: Optional[Callable[[], bool]]
+    :param timeouts: Overrides of STAGE_TIMEOUTS
+    :type timeouts: Optional[Dict[str, float]]
+    :rtype: SessionPipeline
+    """
+    timeouts = dict(STAGE_TIMEOUTS, **(timeouts or {}))
+    pipeline = SessionPipeline()
+
+    def group():
+        if not check_group():
+            raise PermissionError("Please add your user to the vboxuser group using the following command: \n\n"
+                                  "sudo usermod -a -G vboxusers $USER\n\n")
+
+    def resolve():
+        uuids = sandbox.resolve_usb(usb_objects)
+        if not uuids:
+            raise LookupError("None of the USB devices is known to the hypervisor")
+        return uuids
+
+    def attach():
+        report = sandbox.mount_usb_to_sandbox(pipeline.results["resolve_usb"], usbguard=usbguard)
+        if not any(x.ok for x in report.values()):
+            raise OSError(f"No USB device could be attached to {sandbox.sandbox_id}")
+        return report
+
+    def provision():
+        if not sandbox.provision_usb():
+            raise OSError(f"USB of {sandbox.sandbox_id} could not be provisioned")
+        return True
+
+    async def start():
+        if not await sandbox.run_sandbox_async():
+            raise OSError(f"Could not start {sandbox.sandbox_id}")
+        return True
+
+    pipeline.add("disconnect_interfaces", disconnect, timeout=timeouts["disconnect_interfaces"],
+                 rollback=reconnect_network_interfaces)
+    vm_depends = ()
+    if check_group is not None:
+        pipeline.add("check_group", group, timeout=timeouts["check_group"])
+        vm_depends = ("check_group",)
+    pipeline.add("provision_usb", provision, depends=vm_depends, timeout=timeouts["provision_usb"])
+
+    start_depends = ["provision_usb"]
+    if isinstance(sandbox, Whonix):
+        # Whonix: the workstation is only started once the gateway is up and ready
+        if sandbox.gateway is not None:
+            pipeline.add("start_gateway", sandbox.start_gateway, depends=vm_depends, timeout=timeouts["start_gateway"],
+                         rollback=lambda started: sandbox.gateway.power_off())
+            pipeline.add("gateway_ready", sandbox.wait_for_gateway, depends=["start_gateway"],
+                         timeout=timeouts["gateway_ready"])
+            start_depends.append("gateway_ready")
+        start = sandbox.start_workstation
+    pipeline.add("start_vm", start, depends=start_depends, timeout=timeouts["start_vm"],
+                 rollback=lambda started: sandbox.power_off())
+
+    pipeline.add("prepare_usbguard", usbguard.prepare, timeout=timeouts["prepare_usbguard"])
+    pipeline.add("resolve_usb", resolve, timeout=timeouts["resolve_usb"])
+    pipeline.add("attach_usb", attach,
+                 depends=["disconnect_interfaces", "start_vm", "prepare_usbguard", "resolve_usb"],
+                 timeout=timeouts["attach_usb"], rollback=lambda report: usbguard.block_device())
+    return pipeline
@@ -11,7 +11,13 @@ setup(
     author='Thomas Gruebl',
     author_email="notmyrealemail@gmail.com",
     url='https://github.com/thomasgruebl/mount-usb-in-sandbox',
-    packages=['usb', 'sandbox'],
+    packages=['usb', 'sandbox', 'network', 'journal', 'metrics', 'execution', 'privileged'],
+    py_modules=['main', 'helpers', 'restore', 'kiosk', 'session'],
+    entry_points={
+        'console_scripts': [
+            'mount-usb-in-sandbox=main:main',
+        ],
+    },
     license='MIT',
     keywords='usb mount sandbox whonix',
     python_requires='>=3.8',
@@ -0,0 +1,78 @@
+import threading
+import time
+import unittest
+
+from sandbox.core import Sandbox
+
+
+class FakeVBoxManage:
+    def __init__(self, failures, latency=0.2):
+        self.failures = dict(failures)
+        self.latency = latency
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def controlvm(self, sandbox_id, *args):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls.append(args)
+            uuid = args[1]
+            if self.failures.get(uuid, 0) != 0:
+                self.failures[uuid] -= 1
+                return 1, "", f"VBoxManage: error: Could not attach {uuid}\n"
+        return 0, "", ""
+
+
+class FakeUSBGuard:
+    def __init__(self):
+        self.allowed = 0
+
+    def allow_device(self):
+        self.allowed += 1
+        return {}
+
+
+class AttachTest(unittest.TestCase):
+    def test_devices_are_attached_concurrently(self):
+        uuids = [f"uuid-{i}" for i in range(4)]
+        client = FakeVBoxManage({}, latency=0.3)
+        usbguard = FakeUSBGuard()
+
+        start = time.monotonic()
+        report = Sandbox(name="sandbox", client=client).mount_usb_to_sandbox(uuids, usbguard=usbguard)
+        elapsed = time.monotonic() - start
+
+        self.assertEqual(list(report), uuids)
+        self.assertEqual({x.status for x in report.values()}, {"attached"})
+        self.assertEqual(usbguard.allowed, 1)
+        # four sticks take about as long as one
+        self.assertLess(elapsed, 2 * 0.3 + 0.2)
+
+    def test_failed_attach_is_retried_and_reported(self):
+        client = FakeVBoxManage({"retry": 2, "broken": -1}, latency=0)
+        usbguard = FakeUSBGuard()
+
+        with self.assertLogs("sandbox.core", level="ERROR"):
+            report = Sandbox(name="sandbox", client=client).mount_usb_to_sandbox(
+                ["ok", "retry", "broken"], usbguard=usbguard, attempts=4, backoff=0.01)
+
+        self.assertEqual({x: report[x].status for x in report}, {"ok": "attached", "retry": "retried",
+                                                                  "broken": "failed"})
+        self.assertEqual([report[x].attempts for x in ("ok", "retry", "broken")], [1, 3, 4])
+        self.assertIn("Could not attach broken", report["broken"].error)
+        self.assertGreater(report["retry"].seconds, 0.01 + 0.02)
+        self.assertEqual(usbguard.allowed, 1)
+
+    def test_usbguard_is_not_changed_if_nothing_was_attached(self):
+        client = FakeVBoxManage({"broken": -1}, latency=0)
+        usbguard = FakeUSBGuard()
+
+        with self.assertLogs("sandbox.core", level="ERROR"):
+            report = Sandbox(name="sandbox", client=client).mount_usb_to_sandbox(
+                ["broken"], usbguard=usbguard, attempts=2, backoff=0)
+        self.assertFalse(report["broken"].ok)
+        self.assertEqual(usbguard.allowed, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import tempfile
+import unittest
+
+from benchmarks import run
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_matrix_scales_one_dimension_at_a_time(self):
+        names = [x.name for x in run.matrix([1, 4], [1, 8], [1])]
+        self.assertEqual(names, ["main/devices=1/interfaces=1/vms=1", "main/devices=4/interfaces=1/vms=1",
+                                 "main/devices=1/interfaces=8/vms=1", "restore/devices=1/interfaces=1/vms=1",
+                                 "restore/devices=4/interfaces=1/vms=1", "restore/devices=1/interfaces=8/vms=1"])
+
+    def test_compare(self):
+        baseline = {"main/x": {"seconds": 1.0, "subprocesses": 10, "peak_rss_kb": 1000}}
+        ok = {"name": "main/x", "seconds": 1.2, "subprocesses": 10, "peak_rss_kb": 1100}
+        slow = dict(ok, seconds=2.0, subprocesses=11)
+        self.assertEqual(run.compare([ok], baseline), [])
+        self.assertEqual(len(run.compare([slow], baseline)), 2)
+        self.assertEqual(run.compare([dict(slow, name="main/new")], baseline), [])
+
+    def test_flows_run_against_the_fakes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            attach = run.run_once(run.Scenario("main", devices=2, interfaces=2), os.path.join(tmp, "main"))
+            restore = run.run_once(run.Scenario("restore", devices=2, interfaces=2), os.path.join(tmp, "restore"))
+
+        self.assertEqual(attach["exit"], 0)
+        self.assertGreater(attach["subprocesses"], 0)
+        self.assertGreater(attach["peak_rss_kb"], 0)
+        # one sudo for all interfaces, one usbguard table lookup and one block per device
+        self.assertEqual(restore["subprocesses"], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
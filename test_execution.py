@@ -0,0 +1,86 @@
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+from execution.core import Executor
+
+
+class ExecutionTest(unittest.TestCase):
+    def test_run_records_the_command(self):
+        executor = Executor()
+        result = executor.run([sys.executable, "-c", "import sys; print('x' * 10); sys.exit(3)"], tool="fake")
+
+        self.assertEqual(result.returncode, 3)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.stdout_text, "x" * 10 + "\n")
+        self.assertEqual(result.output_size, 11)
+        profile = executor.profile()
+        self.assertEqual(profile["forks"], 1)
+        self.assertEqual(profile["tools"]["fake"]["calls"], 1)
+        self.assertEqual(profile["tools"]["fake"]["failures"], 1)
+        self.assertEqual(profile["tools"]["fake"]["output_bytes"], 11)
+
+    def test_per_tool_timeout_kills_the_command(self):
+        executor = Executor(timeouts={"sleeper": 0.2})
+        start = time.monotonic()
+        result = executor.run([sys.executable, "-c", "import time; time.sleep(30)"], tool="sleeper")
+
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertTrue(result.timed_out)
+        self.assertFalse(result.ok)
+        self.assertEqual(executor.profile()["tools"]["sleeper"]["timeouts"], 1)
+
+    def test_missing_executable(self):
+        result = Executor().run(["/nonexistent/usbguard", "list-devices"])
+        self.assertIsNone(result.returncode)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.tool, "usbguard")
+
+    def test_run_all_runs_the_commands_concurrently(self):
+        executor = Executor()
+        start = time.monotonic()
+        results = executor.run_all([[sys.executable, "-c", f"import time; time.sleep(0.5); print({i})"]
+                                    for i in range(4)], tool="sleeper")
+
+        self.assertLess(time.monotonic() - start, 1.5)
+        self.assertEqual([x.stdout_text.strip() for x in results], ["0", "1", "2", "3"])
+        self.assertEqual(executor.profile()["forks"], 4)
+        self.assertGreater(executor.profile()["blocked_seconds"], 1.9)
+
+    def test_run_async_does_not_block_the_event_loop(self):
+        executor = Executor(timeouts={"sleeper": 0.3})
+
+        async def run():
+            return await asyncio.gather(
+                executor.run_async([sys.executable, "-c", "import time; time.sleep(0.5); print('done')"]),
+                executor.run_async([sys.executable, "-c", "import time; time.sleep(30)"], tool="sleeper"))
+
+        start = time.monotonic()
+        done, killed = asyncio.run(run())
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(done.stdout_text.strip(), "done")
+        self.assertTrue(done.ok)
+        self.assertTrue(killed.timed_out)
+        self.assertEqual(executor.profile()["forks"], 2)
+
+    def test_profile_lists_the_slowest_commands(self):
+        executor = Executor()
+        for delay in (0.0, 0.3, 0.1):
+            executor.run([sys.executable, "-c", f"import time; time.sleep({delay})"], tool=f"sleep-{delay}")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "profile.json")
+            executor.write_profile(path)
+            with open(path) as f:
+                profile = json.load(f)
+
+        self.assertEqual([x["tool"] for x in profile["slowest"]], ["sleep-0.3", "sleep-0.1", "sleep-0.0"])
+        self.assertEqual(list(profile["tools"])[0], "sleep-0.3")
+
+
+if __name__ == '__main__':
+    unittest.main()
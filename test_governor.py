@@ -0,0 +1,207 @@
+import tempfile
+import threading
+import time
+import unittest
+
+from sandbox.governor import BANDWIDTH_GROUP, HostMonitor, HostSaturated, ResourceGovernor, VMLimits
+from sandbox.pool import VMPool
+
+
+class FakeVBoxManage:
+    def __init__(self, infos):
+        self.infos = {name: dict(info, name=name) for name, info in infos.items()}
+        self.groups = set()
+        self.runlevels = dict()
+        self.calls = []
+
+    def showvminfo(self, vm, refresh=False):
+        return dict(self.infos[vm]) if vm in self.infos else None
+
+    def invalidate(self, kind=None, vm=None):
+        pass
+
+    def run(self, *args, timeout=None):
+        if args[0] == "guestproperty":
+            runlevel = self.runlevels.get(args[2])
+            return 0, f"Value: {runlevel}" if runlevel is not None else "No value set!", ""
+        self.calls.append(args)
+        if args[0] == "bandwidthctl":
+            if args[2] == "set" and args[3] not in self.groups:
+                return 1, "", f"VBoxManage: error: Could not find a bandwidth group named '{args[3]}'"
+            self.groups.add(args[3])
+        elif args[0] == "modifyvm":
+            for option, value in zip(args[2::2], args[3::2]):
+                self.infos[args[1]][option.lstrip("-")] = value
+        return 0, "", ""
+
+
+class FakeHost(HostMonitor):
+    def __init__(self, total=8192, available=8192, load=0.0, cpus=4):
+        super().__init__(cpus=cpus)
+        self.total = total
+        self.available = available
+        self.current_load = load
+
+    def memory(self):
+        return self.total, self.available
+
+    def load(self):
+        return self.current_load
+
+
+class FakeSandbox:
+    def __init__(self, sandbox_id):
+        self.sandbox_id = sandbox_id
+        self.started = 0
+
+    def provision_usb(self):
+        pass
+
+    def run_sandbox(self, *args):
+        self.started += 1
+        return True
+
+
+VM = {"VMState": "poweroff", "memory": "2048", "cpus": "2", "cpuexecutioncap": "100",
+      "SATA-0-0": "/vms/analysis/analysis.vdi", "IDE-1-0": "/iso/VBoxGuestAdditions.iso", "IDE-0-0": "none"}
+
+
+class ResourceGovernorTest(unittest.TestCase):
+    def governor(self, host=None, **kwargs):
+        client = FakeVBoxManage({f"vm{i}": VM for i in range(3)})
+        return ResourceGovernor(client, VMLimits(cpus=1, memory_mb=3072, cpu_cap=50, disk_mbps=20),
+                                host or FakeHost(), poll_interval=0.01, ready_check_interval=0, **kwargs)
+
+    def test_limits_are_applied_once_while_powered_off(self):
+        governor = self.governor()
+        self.assertEqual(governor.apply_limits(FakeSandbox("vm0")), [
+            ("modifyvm", "vm0", "--cpuexecutioncap", "50", "--memory", "3072", "--cpus", "1"),
+            ("bandwidthctl", "vm0", "add", BANDWIDTH_GROUP, "--type", "disk", "--limit", "20M"),
+            ("storageattach", "vm0", "--storagectl", "SATA", "--port", "0", "--device", "0", "--type", "hdd",
+             "--medium", "/vms/analysis/analysis.vdi", "--bandwidthgroup", BANDWIDTH_GROUP),
+        ])
+        self.assertEqual(governor.plan(governor.client.infos["vm0"])[0][0], "bandwidthctl")
+        governor.client.calls.clear()
+        self.assertEqual(governor.apply_limits(FakeSandbox("vm0")), [])
+        self.assertEqual(governor.client.calls, [])
+
+    def test_running_vm_only_gets_the_runtime_limits(self):
+        governor = self.governor()
+        governor.client.infos["vm1"]["VMState"] = "running"
+        governor.client.groups.add(BANDWIDTH_GROUP)
+        self.assertEqual(governor.apply_limits(FakeSandbox("vm1")), [
+            ("controlvm", "vm1", "cpuexecutioncap", "50"),
+            ("bandwidthctl", "vm1", "set", BANDWIDTH_GROUP, "--limit", "20M"),
+        ])
+        self.assertNotIn("vm1", governor.limited)
+
+    def test_start_is_queued_until_memory_is_released(self):
+        # room for one VM of 3072 MB besides the 1024 MB reserve
+        governor = self.governor(host=FakeHost(total=6144, available=6144))
+        first = governor.admit(FakeSandbox("vm0"))
+        governor.launched(FakeSandbox("vm0"))
+        governor.client.runlevels["vm0"] = 3
+        governor.host.available = 6144 - 3072
+        self.assertEqual(first.memory_mb, 3072)
+
+        admitted = threading.Event()
+        thread = threading.Thread(target=lambda: governor.admit(FakeSandbox("vm1")) and admitted.set())
+        thread.start()
+        self.assertFalse(admitted.wait(0.1))
+        self.assertEqual(governor.stats()["waiting"], 1)
+
+        governor.host.available = 6144
+        governor.release(FakeSandbox("vm0"))
+        thread.join(1)
+        self.assertTrue(admitted.is_set())
+        stats = governor.stats()
+        self.assertEqual((stats["admitted"], stats["waiting"], stats["running"]), (2, 0, 1))
+        self.assertGreaterEqual(stats["admission_wait"]["max"], 0.1)
+
+    def test_booting_vms_and_load_limit_starts(self):
+        governor = self.governor(host=FakeHost(total=65536, available=65536), max_starts=2)
+        governor.admit(FakeSandbox("vm0"))
+        governor.admit(FakeSandbox("vm1"))
+        with self.assertRaises(HostSaturated):
+            governor.admit(FakeSandbox("vm2"), timeout=0.05)
+        # startvm returned, but the guest is still booting
+        governor.launched(FakeSandbox("vm0"))
+        with self.assertRaises(HostSaturated):
+            governor.admit(FakeSandbox("vm2"), timeout=0.05)
+        governor.client.runlevels["vm0"] = 2
+        governor.host.current_load = 3.5
+        with self.assertRaises(HostSaturated):
+            governor.admit(FakeSandbox("vm2"), timeout=0.05)
+        governor.host.current_load = 0.5
+        governor.admit(FakeSandbox("vm2"), timeout=0.05)
+
+    def test_vm_without_guest_additions_is_booted_after_the_grace_period(self):
+        governor = self.governor(host=FakeHost(total=65536, available=65536), max_starts=1, boot_grace=0.1)
+        governor.admit(FakeSandbox("vm0"))
+        governor.launched(FakeSandbox("vm0"))
+        self.assertEqual(governor.stats()["booting"], 1)
+        start = time.monotonic()
+        governor.admit(FakeSandbox("vm1"), timeout=1)
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+        self.assertEqual(governor.stats()["booting"], 1)
+
+    def test_run_level_is_queried_without_the_lock(self):
+        governor = self.governor(host=FakeHost(total=65536, available=65536), max_starts=1)
+        governor.admit(FakeSandbox("vm0"))
+        governor.launched(FakeSandbox("vm0"))
+        querying, proceed = threading.Event(), threading.Event()
+        run = governor.client.run
+
+        def slow_run(*args, timeout=None):
+            if args[0] == "guestproperty":
+                querying.set()
+                proceed.wait(1)
+            return run(*args, timeout=timeout)
+
+        governor.client.run = slow_run
+        thread = threading.Thread(target=governor.admit, args=(FakeSandbox("vm1"),), kwargs={"timeout": 1})
+        thread.start()
+        self.assertTrue(querying.wait(1))
+        released = threading.Event()
+        threading.Thread(target=lambda: governor.release(FakeSandbox("vm0")) or released.set()).start()
+        self.assertTrue(released.wait(0.5))
+        proceed.set()
+        thread.join(1)
+        self.assertEqual(set(governor.reservations), {"vm1"})
+
+    def test_limits_are_applied_again_after_forget(self):
+        governor = self.governor()
+        governor.apply_limits(FakeSandbox("vm0"))
+        governor.client.infos["vm0"]["memory"] = "2048"
+        self.assertEqual(governor.apply_limits(FakeSandbox("vm0")), [])
+        governor.forget(FakeSandbox("vm0"))
+        self.assertEqual(governor.apply_limits(FakeSandbox("vm0"))[0], ("modifyvm", "vm0", "--memory", "3072"))
+
+    def test_vm_larger_than_the_host_is_rejected_at_once(self):
+        governor = self.governor(host=FakeHost(total=4000, available=4000))
+        start = time.monotonic()
+        with self.assertRaises(HostSaturated):
+            governor.admit(FakeSandbox("vm0"))
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_pool_releases_the_reservation(self):
+        governor = self.governor()
+        pool = VMPool([FakeSandbox("vm0")], governor=governor)
+        sandbox = pool.acquire()
+        pool.prepare(sandbox)
+        self.assertEqual(sandbox.started, 1)
+        self.assertEqual(pool.stats()["governor"]["committed_mb"], 3072)
+        pool.release(sandbox)
+        self.assertEqual(pool.stats()["governor"]["running"], 0)
+
+    def test_host_monitor_reads_meminfo(self):
+        with tempfile.NamedTemporaryFile("w", suffix="meminfo") as f:
+            f.write("MemTotal:       16303092 kB\nMemFree:         1024000 kB\nMemAvailable:    8151546 kB\n")
+            f.flush()
+            host = HostMonitor(meminfo=f.name, loadavg=lambda: (0.5, 0.4, 0.3), cpus=8)
+            self.assertEqual(host.memory(), (15920, 7960))
+            self.assertEqual(host.load(), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
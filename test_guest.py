@@ -0,0 +1,127 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+from sandbox.core import Sandbox
+from sandbox.guest import GUEST_SCRIPT, GuestVerifier, parse_guest_output
+from sandbox.vboxmanage import VBoxManage
+from usb.core import USB
+
+# guestcontrol fails until the guest additions are up (first call), then runs the guest command on this machine,
+# against the fake guest tree in $GUEST_ROOT
+FAKE_VBOXMANAGE = textwrap.dedent('''
+    import os, subprocess, sys
+    with open(sys.argv[1], "a") as log:
+        log.write(" ".join(sys.argv[2:5]) + "\\n")
+    with open(sys.argv[1]) as log:
+        calls = len(log.read().splitlines())
+    args = sys.argv[2:]
+    if args[0] == "guestcontrol":
+        if calls == 1:
+            sys.stderr.write("VBoxManage: error: The guest execution service is not ready (yet)")
+            sys.exit(1)
+        command = args[args.index("--") + 1:]
+        sys.exit(subprocess.call(command + [os.environ["GUEST_ROOT"]]))
+''')
+
+
+def build_guest(root, mounted=True):
+    """
+    Creates the guest's view of a SATA disk sda and a USB 2 stick sdb (2 MiB).
+    """
+    disks = {"sda": ("devices/pci0000:00/0000:00:0d.0/ata1/host0/target0:0:0/0:0:0:0", None),
+             "sdb": ("devices/pci0000:00/0000:00:0c.0/usb2/2-1/2-1:1.0/host3/target3:0:0/3:0:0:0", "2-1")}
+    os.makedirs(os.path.join(root, "sys", "block"))
+    os.makedirs(os.path.join(root, "dev"))
+    os.makedirs(os.path.join(root, "proc"))
+    for name, (scsi, usb_device) in disks.items():
+        block = os.path.join(root, "sys", scsi, "block", name)
+        os.makedirs(block)
+        with open(os.path.join(block, "size"), "w") as f:
+            f.write("4096\n")
+        os.symlink("../..", os.path.join(block, "device"))
+        os.symlink(block, os.path.join(root, "sys", "block", name))
+        if usb_device:
+            usb_dir = os.path.join(root, "sys", scsi.split(usb_device)[0], usb_device)
+            with open(os.path.join(usb_dir, "speed"), "w") as f:
+                f.write("480\n")
+            with open(os.path.join(usb_dir, "serial"), "w") as f:
+                f.write("4C530001\n")
+        with open(os.path.join(root, "dev", name), "wb") as f:
+            f.write(os.urandom(2 * 1024 * 1024))
+    with open(os.path.join(root, "proc", "mounts"), "w") as f:
+        f.write("/dev/sda2 / ext4 rw 0 0\n")
+        if mounted:
+            f.write("/dev/sdb1 /media/user/STICK vfat rw 0 0\n")
+
+
+@unittest.skipIf(shutil.which("sh") is None or shutil.which("timeout") is None, "no POSIX shell")
+class GuestVerifierTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = os.path.join(self.tmp.name, "guest")
+        self.log = os.path.join(self.tmp.name, "calls")
+        script = os.path.join(self.tmp.name, "vboxmanage.py")
+        with open(script, "w") as f:
+            f.write(FAKE_VBOXMANAGE)
+        self.env = mock.patch.dict(os.environ, {"GUEST_ROOT": self.root})
+        self.env.start()
+        self.client = VBoxManage(command=f"{sys.executable} {script} {self.log}")
+        self.sandbox = Sandbox(name="analysis", client=self.client)
+        self.host = os.path.join(self.tmp.name, "host")
+        os.makedirs(os.path.join(self.host, "1-2"))
+        with open(os.path.join(self.host, "1-2", "speed"), "w") as f:
+            f.write("5000\n")
+        self.stick = USB("0781:5581", "0781", "5581", "4C530001", port_path="1-2")
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def test_script_finds_only_usb_disks(self):
+        build_guest(self.root)
+        output = subprocess.run(["sh", "-c", GUEST_SCRIPT, "sh", "1", "10", self.root], capture_output=True,
+                                text=True, check=True).stdout
+        reports = parse_guest_output(output, probe_mb=1)
+        self.assertEqual([x.device for x in reports], ["sdb"])
+        self.assertEqual(reports[0].serial, "4C530001")
+        self.assertEqual(reports[0].usb_speed, "high")
+        self.assertEqual(reports[0].mount, "/media/user/STICK")
+        self.assertEqual(reports[0].read_bytes, 1024 * 1024)
+        self.assertGreater(reports[0].mb_per_s, 0)
+
+    def test_verify_retries_until_the_guest_is_ready(self):
+        build_guest(self.root)
+        verifier = GuestVerifier(self.sandbox, "user", "/dev/null", client=self.client, probe_mb=1,
+                                 require_mount=True, sysfs_root=self.host)
+        with self.assertLogs("sandbox.guest", level="WARNING") as logs:
+            report = verifier.verify([self.stick], timeout=10, interval=0.1)["0781:5581@1-2"]
+
+        self.assertTrue(report.ok)
+        self.assertEqual(report.device, "sdb")
+        # USB 3 on the host, USB 2 in the guest
+        self.assertTrue(report.degraded)
+        self.assertIn("xHCI", "\n".join(logs.output))
+        with open(self.log) as f:
+            # not ready, found without reading it, read once
+            self.assertEqual(f.read().splitlines(), ["guestcontrol analysis run"] * 3)
+        self.assertEqual(report.read_bytes, 1024 * 1024)
+        self.assertGreater(report.mb_per_s, 0)
+
+    def test_unmounted_stick_is_reported(self):
+        build_guest(self.root, mounted=False)
+        verifier = GuestVerifier(self.sandbox, "user", "/dev/null", client=self.client, probe_mb=0,
+                                 require_mount=True, sysfs_root=self.host)
+        with self.assertLogs("sandbox.guest", level="ERROR"):
+            report = verifier.verify([self.stick], timeout=0.5, interval=0.1)["0781:5581@1-2"]
+        self.assertFalse(report.ok)
+        self.assertEqual(report.error, "not mounted in the guest")
+
+
+if __name__ == '__main__':
+    unittest.main()
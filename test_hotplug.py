@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+
+import usb.hotplug
+from test_sysfs import STICK_DESCRIPTORS
+
+
+def uevent(action, devpath, **properties):
+    properties.setdefault("ACTION", action)
+    properties.setdefault("DEVPATH", devpath)
+    fields = [f"{action}@{devpath}"] + [f"{k}={v}" for k, v in properties.items()]
+    return "\0".join(fields).encode()
+
+
+class FakeUeventSource:
+    def __init__(self, events):
+        self.events = list(events)
+        self.closed = False
+
+    def receive(self, timeout=None):
+        return self.events.pop(0) if self.events else None
+
+    def close(self):
+        self.closed = True
+
+
+STICK = "/devices/pci0000:00/0000:00:14.0/usb1/1-2"
+
+
+class HotplugTest(unittest.TestCase):
+    def test_mass_storage_add(self):
+        with tempfile.TemporaryDirectory() as sysfs:
+            device = os.path.join(sysfs, STICK.lstrip("/"))
+            os.makedirs(device)
+            for attribute, value in (("idVendor", "0781"), ("idProduct", "5567"), ("serial", "4C530001")):
+                with open(os.path.join(device, attribute), "w") as f:
+                    f.write(value + "\n")
+
+            source = FakeUeventSource([
+                uevent("add", STICK, SUBSYSTEM="usb", DEVTYPE="usb_device", PRODUCT="781/5567/100"),
+                uevent("add", STICK + "/1-2:1.0", SUBSYSTEM="usb", DEVTYPE="usb_interface",
+                       PRODUCT="781/5567/100", INTERFACE="8/6/80"),
+                b"libudev\0ignored",
+            ])
+            watcher = usb.hotplug.HotplugWatcher(source=source, sysfs_root=sysfs)
+            devices = watcher.wait_for_devices(timeout=1, settle=0)
+
+        self.assertEqual(len(devices), 1)
+        self.assertEqual(devices[0].device_id, "0781:5567")
+        self.assertEqual(devices[0].serial, "4C530001")
+        self.assertEqual(devices[0].port_path, "1-2")
+
+    def test_unauthorized_stick_is_detected_from_its_descriptors(self):
+        with tempfile.TemporaryDirectory() as sysfs:
+            # usbguard blocked the stick: the kernel emits the usb_device uevent only
+            device = os.path.join(sysfs, STICK.lstrip("/"))
+            os.makedirs(device)
+            for attribute, value in (("idVendor", "0781"), ("idProduct", "5567"), ("authorized", "0")):
+                with open(os.path.join(device, attribute), "w") as f:
+                    f.write(value + "\n")
+            with open(os.path.join(device, "descriptors"), "wb") as f:
+                f.write(STICK_DESCRIPTORS)
+
+            source = FakeUeventSource([
+                uevent("add", STICK, SUBSYSTEM="usb", DEVTYPE="usb_device", PRODUCT="781/5567/100"),
+                # authorized later: the interface uevent does not report the stick a second time
+                uevent("add", STICK + "/1-2:1.0", SUBSYSTEM="usb", DEVTYPE="usb_interface",
+                       PRODUCT="781/5567/100", INTERFACE="8/6/80"),
+                uevent("remove", STICK, SUBSYSTEM="usb", DEVTYPE="usb_device", PRODUCT="781/5567/100"),
+            ])
+            watcher = usb.hotplug.HotplugWatcher(source=source, sysfs_root=sysfs)
+            events = [(action, x.port_path) for action, x in watcher.events(timeout=0)]
+
+        self.assertEqual(events, [("add", "1-2"), ("remove", "1-2")])
+
+    def test_ignores_other_interface_classes(self):
+        source = FakeUeventSource([
+            uevent("add", STICK + "/1-2:1.0", SUBSYSTEM="usb", DEVTYPE="usb_interface",
+                   PRODUCT="46d/c52b/1211", INTERFACE="3/1/1"),
+        ])
+        self.assertEqual(usb.hotplug.HotplugWatcher(source=source).wait_for_devices(timeout=0), [])
+
+    def test_wait_uses_initial_lookup(self):
+        source = FakeUeventSource([])
+        devices = usb.hotplug.wait_for_mass_storage(lambda: ["already-attached"], source=source)
+        self.assertEqual(devices, ["already-attached"])
+        self.assertTrue(source.closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
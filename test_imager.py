@@ -0,0 +1,148 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import usb.imager
+import usb.sysfs
+from sandbox.core import Sandbox, free_storage_slot
+from usb.core import USB
+
+MB = 1024 * 1024
+# device, configuration and interface descriptors of a stick with one mass storage interface (class 08)
+STICK_DESCRIPTORS = bytes([18, 1, 0x00, 0x02, 0, 0, 0, 64, 0x81, 0x07, 0x67, 0x55, 0x00, 0x01, 1, 2, 3, 1,
+                           9, 2, 25, 0, 1, 1, 0, 0x80, 50,
+                           9, 4, 0, 0, 1, 0x08, 0x06, 0x50, 0])
+# the same stick with an additional keyboard interface (class 03)
+HID_DESCRIPTORS = STICK_DESCRIPTORS + bytes([9, 4, 1, 0, 1, 0x03, 0x01, 0x01, 0])
+
+
+class FakeVBoxManage:
+    def __init__(self, info=None):
+        self.info = info or {}
+        self.calls = []
+
+    def run(self, *args, timeout=None):
+        self.calls.append(args)
+        if args[0] == "convertfromraw":
+            with open(args[1], "rb") as src, open(args[2], "wb") as dst:
+                dst.write(src.read())
+        return 0, "", ""
+
+    def showvminfo(self, vm, refresh=False):
+        return dict(self.info)
+
+    def invalidate(self, kind=None, vm=None):
+        pass
+
+
+class FakeUSBGuard:
+    def __init__(self):
+        self.calls = []
+
+    def allow_device(self):
+        self.calls.append("allow")
+
+    def block_device(self):
+        self.calls.append("block")
+
+
+class ImagerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # a loop file stands in for the stick: data, a large zero region and data again
+        self.stick = os.path.join(self.tmp.name, "stick.bin")
+        with open(self.stick, "wb") as f:
+            f.write(os.urandom(MB + 123))
+            f.write(bytes(8 * MB))
+            f.write(os.urandom(MB))
+        with open(self.stick, "rb") as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_image_is_a_sparse_copy_with_checksum(self):
+        image = os.path.join(self.tmp.name, "stick.img")
+        progress = list()
+        result = usb.imager.image_device(self.stick, image, block_size=MB,
+                                         progress=lambda done, total: progress.append(done))
+
+        with open(image, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(result.size, len(self.data))
+        self.assertEqual(result.sha256, hashlib.sha256(self.data).hexdigest())
+        self.assertGreaterEqual(result.sparse_bytes, 7 * MB)
+        self.assertEqual(progress[-1], len(self.data))
+        self.assertGreater(result.mb_per_s, 0)
+        self.assertFalse(os.path.exists(image + ".part"))
+
+    def test_image_without_checksum(self):
+        image = os.path.join(self.tmp.name, "stick.img")
+        result = usb.imager.image_device(self.stick, image, checksum=False)
+        self.assertIsNone(result.sha256)
+        with open(image, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_snapshot_blocks_the_stick_right_after_copying(self):
+        sysfs = os.path.join(self.tmp.name, "sys")
+        os.makedirs(os.path.join(sysfs, "1-2", "1-2:1.0", "host6", "target6:0:0", "6:0:0:0", "block", "sdx"))
+        self.assertEqual(usb.sysfs.block_devices("1-2", sysfs), ["/dev/sdx"])
+        with open(os.path.join(sysfs, "1-2", "descriptors"), "wb") as f:
+            f.write(STICK_DESCRIPTORS)
+
+        client = FakeVBoxManage()
+        usbguard = FakeUSBGuard()
+        stick = USB("0781:5567", "0781", "5567", "SERIAL", port_path="1-2")
+        with mock.patch("usb.sysfs.block_devices", return_value=[self.stick]):
+            images = usb.imager.snapshot_devices([stick], usbguard, os.path.join(self.tmp.name, "images"),
+                                                 client=client, root=sysfs)
+
+        self.assertEqual(usbguard.calls, ["allow", "block"])
+        self.assertEqual(len(images), 1)
+        self.assertTrue(images[0].medium.endswith(".vdi"))
+        self.assertFalse(os.path.exists(images[0].path))
+        self.assertEqual(client.calls[0][:2], ("convertfromraw", images[0].path))
+
+    def test_snapshot_refuses_devices_with_other_interfaces(self):
+        sysfs = os.path.join(self.tmp.name, "sys")
+        os.makedirs(os.path.join(sysfs, "1-3"))
+        with open(os.path.join(sysfs, "1-3", "descriptors"), "wb") as f:
+            f.write(HID_DESCRIPTORS)
+
+        usbguard = FakeUSBGuard()
+        devices = [USB("0781:5567", "0781", "5567", None, port_path="1-3"),
+                   USB("0781:5567", "0781", "5567", None, port_path="1-4")]
+        with self.assertLogs("usb.imager", level="ERROR"):
+            images = usb.imager.snapshot_devices(devices, usbguard, self.tmp.name, client=FakeVBoxManage(), root=sysfs)
+        self.assertEqual(images, [])
+        self.assertEqual(usbguard.calls, [])
+
+    def test_image_name_drops_unsafe_serial_characters(self):
+        name = usb.imager.image_name(USB("0781:5567", "0781", "5567", "../../etc/x y", port_path="1-2"))
+        self.assertRegex(name, r"^0781-5567-etcxy-[0-9]+\.img$")
+        name = usb.imager.image_name(USB("0781:5567", "0781", "5567", "/..", port_path="1-2"))
+        self.assertRegex(name, r"^0781-5567-1-2-[0-9]+\.img$")
+
+    def test_image_is_attached_to_a_free_port(self):
+        info = {"storagecontrollername0": "IDE", "storagecontrollerportcount0": "2",
+                "IDE-0-0": "/vms/disk.vdi", "IDE-1-0": "emptydrive",
+                "storagecontrollername1": "SATA", "storagecontrollerportcount1": "2", "SATA-0-0": "/vms/os.vdi"}
+        self.assertEqual(free_storage_slot(info), ("SATA", 1))
+
+        client = FakeVBoxManage(info)
+        sandbox = Sandbox(name="sandbox", client=client)
+        self.assertTrue(sandbox.attach_image("/images/stick.vdi"))
+        self.assertTrue(sandbox.detach_image("/images/stick.vdi"))
+        self.assertEqual(client.calls, [
+            ("storageattach", "sandbox", "--storagectl", "SATA", "--port", "1", "--device", "0", "--type", "hdd",
+             "--medium", "/images/stick.vdi", "--mtype", "multiattach"),
+            ("storageattach", "sandbox", "--storagectl", "SATA", "--port", "1", "--device", "0", "--medium", "none"),
+        ])
+        with self.assertRaises(ValueError):
+            sandbox.attach_image("/images/stick.vdi", mtype="normal")
+
+
+if __name__ == '__main__':
+    unittest.main()
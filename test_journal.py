@@ -0,0 +1,125 @@
+import os
+import pickle
+import sys
+import tempfile
+import textwrap
+import unittest
+
+import journal.core
+import restore
+from journal.core import INTERFACE, USBGUARD, Journal
+
+FAKE_USBGUARD = textwrap.dedent('''
+    import os, sys
+    state, args = sys.argv[1], sys.argv[2:]
+    with open(os.path.join(state, "usbguard.log"), "a") as f:
+        f.write(" ".join(args) + "\\n")
+    if args[0] == "list-devices":
+        for port in range(1, 3):
+            target = "block" if os.path.exists(os.path.join(state, "blocked-%d" % port)) else "allow"
+            print('%d: %s id 0781:5567 serial "" name "Cruzer" via-port "1-%d" with-interface 08:06:50'
+                  % (port, target, port))
+    elif args[0] == "block-device":
+        open(os.path.join(state, "blocked-" + args[1]), "w").close()
+''')
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "state", "journal")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_outstanding_changes(self):
+        log = Journal(self.path)
+        log.apply(INTERFACE, ["eth0", "wlan0"])
+        log.apply(USBGUARD, ["0781:5567@1-2"])
+        log.revert(INTERFACE, ["eth0"])
+        log.apply(USBGUARD, ["0781:5567@1-2"])
+
+        # a second process sees every record, not only the first one
+        self.assertEqual(Journal(self.path).outstanding(), {INTERFACE: ["wlan0"], USBGUARD: ["0781:5567@1-2"]})
+        self.assertEqual(len(list(Journal(self.path).records())), 4)
+
+    def test_torn_tail_is_ignored_and_overwritten(self):
+        log = Journal(self.path)
+        log.apply(INTERFACE, ["eth0"])
+        with open(self.path, "ab") as f:
+            f.write(journal.core.encode_record({"op": "apply", "kind": INTERFACE, "keys": ["wlan0"]})[:-3])
+
+        log = Journal(self.path)
+        self.assertEqual(log.outstanding(), {INTERFACE: ["eth0"]})
+        log.apply(INTERFACE, ["eth1"])
+        self.assertEqual(Journal(self.path).outstanding(), {INTERFACE: ["eth0", "eth1"]})
+
+    def test_corrupt_record_fails_its_checksum(self):
+        log = Journal(self.path)
+        log.apply(INTERFACE, ["eth0"])
+        log.apply(INTERFACE, ["eth1"])
+        with open(self.path, "r+b") as f:
+            f.seek(-2, os.SEEK_END)
+            f.write(b"XX")
+        self.assertEqual(Journal(self.path).outstanding(), {INTERFACE: ["eth0"]})
+
+    def test_compaction_keeps_the_journal_bounded(self):
+        log = Journal(self.path, compact_after=16)
+        for session in range(1000):
+            log.apply(USBGUARD, [f"0781:5567@1-{session % 4}"])
+            log.revert(USBGUARD, [f"0781:5567@1-{session % 4}"])
+        log.apply(INTERFACE, ["eth0"])
+
+        self.assertLess(len(list(log.records())), 16)
+        self.assertLess(os.path.getsize(self.path), 2048)
+        self.assertEqual(Journal(self.path).outstanding(), {INTERFACE: ["eth0"]})
+
+    def test_restore_replays_every_change_once(self):
+        state = self.tmp.name
+        with open(os.path.join(state, "usbguard.py"), "w") as f:
+            f.write(FAKE_USBGUARD)
+        command = f"{sys.executable} {state}/usbguard.py {state}"
+
+        log = Journal(self.path)
+        log.apply(USBGUARD, ["0781:5567@1-1"])
+        # devices that have been unplugged since are not in the usbguard table any more
+        log.apply(USBGUARD, ["0781:5567@1-9"])
+        # older versions appended one pickle per run
+        with open(os.path.join(state, "allowed_usbguard.pickle"), "ab") as f:
+            pickle.dump(["0781:5567"], f)
+            pickle.dump([], f)
+
+        cwd = os.getcwd()
+        os.chdir(state)
+        try:
+            self.assertTrue(restore.restore_changes(log, usbguard_command=command))
+            self.assertFalse(os.path.exists("allowed_usbguard.pickle"))
+            self.assertTrue(restore.restore_changes(log, usbguard_command=command))
+        finally:
+            os.chdir(cwd)
+
+        with open(os.path.join(state, "usbguard.log")) as f:
+            calls = f.read().splitlines()
+        self.assertEqual(sorted(x for x in calls if x.startswith("block-device")), ["block-device 1", "block-device 2"])
+        self.assertEqual(calls.count("list-devices"), 1)
+        self.assertEqual(Journal(self.path).outstanding(), {})
+
+    def test_legacy_usbguard_ids_are_resolved(self):
+        state = self.tmp.name
+        with open(os.path.join(state, "usbguard.py"), "w") as f:
+            f.write(FAKE_USBGUARD)
+        command = f"{sys.executable} {state}/usbguard.py {state}"
+        # older versions logged usbguard's device IDs, 9 is not known to usbguard any more
+        with open(os.path.join(state, "allowed_usbguard.pickle"), "wb") as f:
+            pickle.dump(["2:", "9"], f)
+
+        log = Journal(self.path)
+        with self.assertLogs("restore", level="ERROR"):
+            self.assertEqual(restore.import_legacy_logs(log, state, usbguard_command=command), 1)
+        self.assertEqual(log.outstanding(), {USBGUARD: ["0781:5567@1-2"]})
+        with open(os.path.join(state, "allowed_usbguard.pickle"), "rb") as f:
+            self.assertEqual(pickle.load(f), ["9"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import os
+import queue
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import unittest
+from unittest import mock
+
+from kiosk import KioskDaemon
+from sandbox.core import Sandbox
+from sandbox.pool import VMPool, WarmPool
+from sandbox.vboxmanage import VBoxManage
+from usb.core import USB
+
+# VMs power off SESSION seconds after startvm
+FAKE_VBOXMANAGE = textwrap.dedent('''
+    import os, sys, time
+    SESSION = 1.0
+    state, args = sys.argv[1], sys.argv[2:]
+    with open(os.path.join(state, "vboxmanage.log"), "a") as f:
+        f.write(" ".join(args) + "\\n")
+    if args[0] == "startvm":
+        with open(os.path.join(state, "vm-" + args[1]), "w") as f:
+            f.write(str(time.time()))
+    elif args[0] == "controlvm" and args[2] == "poweroff":
+        os.remove(os.path.join(state, "vm-" + args[1]))
+    elif args[0] == "showvminfo":
+        try:
+            started = float(open(os.path.join(state, "vm-" + args[1])).read())
+            running = time.time() - started < SESSION
+        except OSError:
+            running = False
+        print('name="%s"' % args[1])
+        print('UUID="%s"' % ("00000000-0000-4000-8000-00000000000" + args[1][-1]))
+        print('VMState="%s"' % ("running" if running else "poweroff"))
+        print('usb="on"')
+        print('ehci="on"')
+        print('xhci="on"')
+        print('USBFilterName1="allow_all_usbs"')
+    elif args[:2] == ["list", "runningvms"]:
+        for name in os.listdir(state):
+            if name.startswith("vm-") and time.time() - float(open(os.path.join(state, name)).read()) < SESSION:
+                print('"%s" {00000000-0000-4000-8000-00000000000%s}' % (name[3:], name[-1]))
+    elif args[:2] == ["list", "usbhost"]:
+        for port in range(1, 4):
+            print("UUID:               00000000-0000-4000-9000-00000000000%d" % port)
+            print("VendorId:           0x0781 (0781)")
+            print("ProductId:          0x5567 (5567)")
+            print("Address:            sysfs:/sys/devices/pci0000:00/0000:00:14.0/usb1/1-%d//device:/dev/vboxusb/001/00%d" % (port, port))
+            print("")
+''')
+
+FAKE_USBGUARD = textwrap.dedent('''
+    import os, sys
+    state, args = sys.argv[1], sys.argv[2:]
+    with open(os.path.join(state, "usbguard.log"), "a") as f:
+        f.write(" ".join(args) + "\\n")
+    allowed = os.path.join(state, "allowed-")
+    if args[0] == "list-devices":
+        for port in range(1, 4):
+            target = "allow" if os.path.exists(allowed + str(port + 10)) else "block"
+            print('%d: %s id 0781:5567 serial "" name "Cruzer" via-port "1-%d" with-interface 08:06:50'
+                  % (port + 10, target, port))
+    elif args[0] == "allow-device":
+        open(allowed + args[1], "w").close()
+    elif args[0] == "block-device":
+        os.remove(allowed + args[1])
+''')
+
+
+class QueueUeventSource:
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def receive(self, timeout=None):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        pass
+
+
+def stick_uevent(port):
+    devpath = f"/devices/pci0000:00/0000:00:14.0/usb1/1-{port}/1-{port}:1.0"
+    return "\0".join([f"add@{devpath}", "ACTION=add", f"DEVPATH={devpath}", "SUBSYSTEM=usb",
+                      "DEVTYPE=usb_interface", "PRODUCT=781/5567/100", "INTERFACE=8/6/80"]).encode()
+
+
+class KioskTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.state = self.tmp.name
+        for name, script in (("vboxmanage.py", FAKE_VBOXMANAGE), ("usbguard.py", FAKE_USBGUARD)):
+            with open(os.path.join(self.state, name), "w") as f:
+                f.write(script)
+        for port in range(1, 4):
+            device = os.path.join(self.state, "sys", f"devices/pci0000:00/0000:00:14.0/usb1/1-{port}")
+            os.makedirs(device)
+            for attribute, value in (("idVendor", "0781"), ("idProduct", "5567"), ("busnum", "1"),
+                                     ("devnum", str(port))):
+                with open(os.path.join(device, attribute), "w") as f:
+                    f.write(value)
+        self.cwd = os.getcwd()
+        self.env = mock.patch.dict(os.environ, {"MOUNT_USB_IN_SANDBOX_STATE_DIR": os.path.join(self.tmp.name, "state")})
+        self.env.start()
+        os.chdir(self.state)
+
+    def tearDown(self):
+        self.env.stop()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def log(self, name):
+        with open(os.path.join(self.state, name)) as f:
+            return f.read().splitlines()
+
+    def test_sticks_are_dispatched_across_the_pool(self):
+        client = VBoxManage(f"{sys.executable} {self.state}/vboxmanage.py {self.state}")
+        pool = VMPool([Sandbox(name=f"analysis-{i}", client=client) for i in range(1, 3)])
+        source = QueueUeventSource()
+        daemon = KioskDaemon(pool, max_sessions=2, source=source, client=client,
+                             usbguard_command=f"{sys.executable} {self.state}/usbguard.py {self.state}",
+                             sysfs_root=os.path.join(self.state, "sys"))
+
+        server = threading.Thread(target=daemon.serve_forever, kwargs={"poll": 0.05})
+        server.start()
+        try:
+            for port in range(1, 4):
+                source.events.put(stick_uevent(port))
+            # duplicate event for a stick that already has a session
+            source.events.put(stick_uevent(1))
+            deadline = time.monotonic() + 10
+            while len(daemon.sessions) < 3 or not source.events.empty():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            self.assertTrue(daemon.join(timeout=30))
+        finally:
+            daemon.stop()
+            server.join()
+
+        stats = daemon.stats()
+        self.assertEqual(stats["sessions"], 3)
+        self.assertEqual(stats["failed"], 0)
+        self.assertEqual(stats["queue_depth"], 0)
+        self.assertEqual(stats["pool"]["idle"], 2)
+        self.assertEqual({x["sandbox"] for x in stats["per_session"]}, {"analysis-1", "analysis-2"})
+        self.assertTrue(all(x["attach_latency"] is not None for x in stats["per_session"]))
+
+        attached = sorted(x.split()[-1] for x in self.log("vboxmanage.log") if "usbattach" in x)
+        self.assertEqual(attached, [f"00000000-0000-4000-9000-00000000000{port}" for port in range(1, 4)])
+        blocked = sorted(x for x in self.log("usbguard.log") if x.startswith("block-device"))
+        self.assertEqual(blocked, ["block-device 11", "block-device 12", "block-device 13"])
+
+    def test_vm_is_powered_off_when_the_session_fails_before_attaching(self):
+        client = VBoxManage(f"{sys.executable} {self.state}/vboxmanage.py {self.state}")
+        pool = VMPool([Sandbox(name="analysis-1", client=client)])
+        daemon = KioskDaemon(pool, source=QueueUeventSource(), client=client,
+                             usbguard_command=f"{sys.executable} {self.state}/usbguard.py {self.state}",
+                             sysfs_root=os.path.join(self.state, "sys"))
+        daemon.start()
+        try:
+            # VirtualBox does not list the stick on port 4
+            daemon.submit(USB("0781:5567", "0781", "5567", None, port_path="1-4", busnum=1, devnum=4))
+            with self.assertLogs("kiosk", level="ERROR"):
+                self.assertTrue(daemon.join(timeout=30))
+        finally:
+            daemon.stop()
+
+        self.assertEqual(daemon.stats()["failed"], 1)
+        commands = [x for x in self.log("vboxmanage.log") if x.split()[0] in ("startvm", "controlvm")]
+        self.assertEqual(commands, ["startvm analysis-1", "controlvm analysis-1 poweroff"])
+
+    def test_warm_pool_restores_the_snapshot_after_every_session(self):
+        client = VBoxManage(f"{sys.executable} {self.state}/vboxmanage.py {self.state}")
+        pool = WarmPool([Sandbox(name="analysis-1", client=client)], "clean")
+        source = QueueUeventSource()
+        daemon = KioskDaemon(pool, source=source, client=client,
+                             usbguard_command=f"{sys.executable} {self.state}/usbguard.py {self.state}",
+                             sysfs_root=os.path.join(self.state, "sys"))
+
+        pool.warm_up()
+        server = threading.Thread(target=daemon.serve_forever, kwargs={"poll": 0.05})
+        server.start()
+        try:
+            for port in range(1, 3):
+                source.events.put(stick_uevent(port))
+            deadline = time.monotonic() + 10
+            while len(daemon.sessions) < 2 or not source.events.empty():
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+            self.assertTrue(daemon.join(timeout=30))
+            while pool.stats()["restoring"]:
+                self.assertLess(time.monotonic(), deadline + 30)
+                time.sleep(0.01)
+        finally:
+            daemon.stop()
+            server.join()
+            pool.shutdown()
+
+        self.assertEqual(daemon.stats()["failed"], 0)
+        # the sessions never boot the VM themselves, it is started right after each restore
+        commands = [x for x in self.log("vboxmanage.log") if x.split()[0] in ("snapshot", "startvm")]
+        self.assertEqual(commands, ["snapshot analysis-1 restore clean", "startvm analysis-1 --type headless"] * 3)
+
+        stats = pool.stats()
+        self.assertEqual((stats["warm"], stats["idle"]), (1, 1))
+        self.assertEqual(stats["timings"]["analysis-1"]["restores"], 3)
+        self.assertEqual(stats["timings"]["analysis-1"]["boots"], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+import unittest
+
+from sandbox.lifecycle import VMLifecycleWatcher
+from sandbox.vboxmanage import VBoxManage
+
+UUID = "e0c6ec26-4ad1-4d55-97c8-f0f35c538e95"
+
+# prints the next state from the script file on every call and repeats the last one
+FAKE_VBOXMANAGE = textwrap.dedent('''
+    import sys
+    states_file = sys.argv[1]
+    with open(states_file) as f:
+        states = f.read().split()
+    if len(states) > 1:
+        with open(states_file, "w") as f:
+            f.write(" ".join(states[1:]))
+    print('name="sandbox"')
+    print('UUID="%s"')
+    print('VMState="%%s"' %% states[0])
+''' % UUID)
+
+
+class LifecycleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.script = os.path.join(self.tmp.name, "vboxmanage.py")
+        self.states = os.path.join(self.tmp.name, "states")
+        with open(self.script, "w") as f:
+            f.write(FAKE_VBOXMANAGE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def watcher(self, states, proc_root=None):
+        with open(self.states, "w") as f:
+            f.write(" ".join(states))
+        return VMLifecycleWatcher("sandbox", client=VBoxManage(f"{sys.executable} {self.script} {self.states}"),
+                                  proc_root=proc_root or os.path.join(self.tmp.name, "proc"), poll_interval=0.01)
+
+    def test_transitions_by_name(self):
+        transitions = []
+        watcher = self.watcher(["starting", "running", "running", "poweroff"])
+        state = watcher.wait_for_stop(timeout=5, on_transition=lambda old, new: transitions.append(new))
+
+        self.assertEqual(state, "poweroff")
+        self.assertEqual(transitions, ["starting", "running", "poweroff"])
+        self.assertEqual(watcher.uuid, UUID)
+
+    def test_wakes_on_process_exit(self):
+        vm = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(0.3)"])
+        proc = os.path.join(self.tmp.name, "proc", str(vm.pid))
+        os.makedirs(proc)
+        with open(os.path.join(proc, "cmdline"), "wb") as f:
+            f.write(b"\0".join([b"/usr/lib/virtualbox/VBoxHeadless", b"--startvm", UUID.encode()]))
+
+        watcher = self.watcher(["running", "aborted"])
+        start = time.monotonic()
+        self.assertEqual(watcher.wait_for_stop(timeout=5), "aborted")
+        # the state is only re-queried once the VM process has exited
+        self.assertGreaterEqual(time.monotonic() - start, 0.25)
+        vm.wait()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import json
+import os
+import tempfile
+import unittest
+
+import metrics.core
+from metrics.core import NOOP_SPAN, Recorder
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.jsonl = os.path.join(self.tmp.name, "spans.jsonl")
+        self.textfile = os.path.join(self.tmp.name, "mount_usb.prom")
+
+    def tearDown(self):
+        metrics.core.configure()
+        self.tmp.cleanup()
+
+    def test_disabled_recorder_hands_out_the_noop_span(self):
+        recorder = Recorder()
+        self.assertIs(recorder.span("usbattach"), NOOP_SPAN)
+        with recorder.span("usbattach") as span:
+            span.set(device="x")
+        recorder.count("sessions")
+        recorder.flush()
+        self.assertEqual(recorder.render(), "")
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_spans_are_written_as_json_lines(self):
+        recorder = Recorder(jsonl_path=self.jsonl, session="s1")
+        with recorder.span("usbattach", device="uuid-1") as span:
+            span.set(vm="analysis")
+        with self.assertRaises(RuntimeError):
+            with recorder.span("vm_wait"):
+                raise RuntimeError("VM vanished")
+        recorder.close()
+
+        with open(self.jsonl) as f:
+            records = [json.loads(x) for x in f]
+        self.assertEqual([(x["session"], x["phase"], x["outcome"]) for x in records],
+                         [("s1", "usbattach", "ok"), ("s1", "vm_wait", "error")])
+        self.assertEqual(records[0]["labels"], {"device": "uuid-1", "vm": "analysis"})
+        self.assertIn("VM vanished", records[1]["error"])
+
+    def test_prometheus_textfile(self):
+        recorder = Recorder(textfile_path=self.textfile)
+        for seconds in (0.003, 0.2, 7.0):
+            recorder.observe("usbattach", seconds, "ok", 0, {})
+        recorder.count("sessions", outcome="ok")
+        recorder.flush()
+
+        with open(self.textfile) as f:
+            text = f.read()
+        name = "mount_usb_in_sandbox_phase_duration_seconds"
+        self.assertIn(f'{name}_bucket{{phase="usbattach",le="0.005"}} 1', text)
+        self.assertIn(f'{name}_bucket{{phase="usbattach",le="0.25"}} 2', text)
+        self.assertIn(f'{name}_bucket{{phase="usbattach",le="+Inf"}} 3', text)
+        self.assertIn(f'{name}_count{{phase="usbattach"}} 3', text)
+        self.assertIn('mount_usb_in_sandbox_phase_total{outcome="ok",phase="usbattach"} 3', text)
+        self.assertIn('mount_usb_in_sandbox_sessions_total{outcome="ok"} 1', text)
+
+    def test_module_level_span_follows_configure(self):
+        self.assertIs(metrics.core.span("session"), NOOP_SPAN)
+        metrics.core.configure(jsonl_path=self.jsonl)
+        with metrics.core.span("session"):
+            pass
+        metrics.core.recorder().close()
+        with open(self.jsonl) as f:
+            self.assertEqual(json.loads(f.readline())["phase"], "session")
+
+
+if __name__ == '__main__':
+    unittest.main()
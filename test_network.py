@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+import network.core
+from network.core import InterfacePolicy
+
+
+def make_interface(root, name, flags, operstate="up", arphrd=1, device=False, bridge=False, tun=False,
+                   devtype=None):
+    directory = os.path.join(root, name)
+    os.makedirs(directory)
+    attributes = {"flags": hex(flags), "operstate": operstate, "type": str(arphrd),
+                  "uevent": f"INTERFACE={name}\n" + (f"DEVTYPE={devtype}\n" if devtype else "")}
+    if tun:
+        attributes["tun_flags"] = "0x1001"
+    for attribute, value in attributes.items():
+        with open(os.path.join(directory, attribute), "w") as f:
+            f.write(value + "\n")
+    if device:
+        os.makedirs(os.path.join(directory, "device"))
+    if bridge:
+        os.makedirs(os.path.join(directory, "bridge"))
+
+
+class NetworkTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        make_interface(root, "lo", 0x9, operstate="unknown", arphrd=772)
+        make_interface(root, "enp3s0", 0x1003, device=True)
+        make_interface(root, "wlp2s0", 0x1002, operstate="down", device=True, devtype="wlan")
+        make_interface(root, "docker0", 0x1003, bridge=True, devtype="bridge")
+        make_interface(root, "veth1a2b", 0x1003)
+        make_interface(root, "vboxnet0", 0x1003)
+        make_interface(root, "tun0", 0x1091, operstate="unknown", arphrd=65534, tun=True)
+        make_interface(root, "wg0", 0x91, operstate="unknown", arphrd=65534, devtype="wireguard")
+        names = ["lo", "enp3s0", "wlp2s0", "docker0", "veth1a2b", "vboxnet0", "tun0", "wg0"]
+        self.interfaces = network.core.discover_interfaces(root, lambda: list(enumerate(names, start=1)))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_classification(self):
+        kinds = {x.name: x.kind for x in self.interfaces}
+        self.assertEqual(kinds, {"lo": "loopback", "enp3s0": "physical", "wlp2s0": "physical", "docker0": "bridge",
+                                 "veth1a2b": "virtual", "vboxnet0": "virtualbox-host-only", "tun0": "tunnel",
+                                 "wg0": "tunnel"})
+
+    def test_default_policy(self):
+        self.assertEqual([x.name for x in network.core.DEFAULT_POLICY.select(self.interfaces)], ["enp3s0"])
+
+    def test_include_exclude(self):
+        policy = InterfacePolicy(include=["tun*"], exclude=["enp*"], only_up=False)
+        self.assertEqual([x.name for x in policy.select(self.interfaces)], ["wlp2s0", "tun0"])
+
+
+if __name__ == '__main__':
+    unittest.main()
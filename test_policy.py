@@ -0,0 +1,82 @@
+import json
+import os
+import tempfile
+import unittest
+
+from usb.core import parse_list_devices
+from usb.policy import Policy, PolicyError, Rule, render, write_rules_file
+
+# what usbguard reports for the devices, one line each
+DEVICES = {
+    "hub": '1: allow id 1d6b:0002 serial "" name "xHCI Host Controller" via-port "usb1" with-interface 09:00:00',
+    "kiosk_stick": '2: block id 0781:5567 serial "A1" name "Cruzer Blade" via-port "1-1" with-interface 08:06:50',
+    "kiosk_uas": '3: block id 174c:55aa serial "B2" name "ASM1153" via-port "1-2" '
+                 'with-interface { 08:06:50 08:06:62 }',
+    "desk_stick": '4: block id 0781:5567 serial "C3" name "Cruzer Blade" via-port "2-1" with-interface 08:06:50',
+    "badusb": '5: block id 0781:5567 serial "D4" name "Cruzer Blade" via-port "2-2" '
+              'with-interface { 08:06:50 03:01:01 }',
+    "kiosk_keyboard": '6: block id 413c:2113 serial "" name "Keyboard" via-port "1-1" with-interface 03:01:01',
+    "receiver": '7: block id 046d:c52b serial "" name "USB Receiver" via-port "2-3" '
+                'with-interface { 03:01:01 03:01:02 }',
+    "webcam": '8: block id 046d:0825 serial "" name "Webcam" via-port "2-4" with-interface { 0e:01:00 0e:02:00 }',
+}
+
+
+def device(name):
+    return parse_list_devices(DEVICES[name])[0]
+
+
+class PolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = Policy(kiosk_ports=["1-1", "1-2"], host_devices=["046d:c52b"])
+        self.rules = self.policy.compile()
+
+    def test_decisions_at_insertion(self):
+        # sticks stay blocked on the kiosk ports as well, the session allows them right before usbattach
+        expected = {"hub": "allow", "kiosk_stick": "block", "kiosk_uas": "block", "desk_stick": "block",
+                    "badusb": "reject", "kiosk_keyboard": "reject", "receiver": "allow", "webcam": "block"}
+        self.assertEqual({x: self.policy.evaluate(device(x), self.rules) for x in DEVICES}, expected)
+
+    def test_rule_language(self):
+        self.assertEqual(self.rules[0].format(), "allow id 046d:c52b")
+        self.assertIn('reject via-port one-of { "1-1" "1-2" } with-interface one-of { 02:*:* 03:*:* 0a:*:* e0:*:* }',
+                      [x.format() for x in self.rules])
+        self.assertFalse([x for x in self.rules if x.target == "allow" and x.ports])
+        self.assertEqual(self.rules[-1].format(), "block with-interface one-of { 08:*:* }")
+        text = render(self.rules)
+        self.assertTrue(text.startswith("# generated"))
+        self.assertEqual(len([x for x in text.splitlines() if not x.startswith("#")]), len(self.rules))
+
+    def test_operators(self):
+        stick = device("kiosk_uas")
+        self.assertTrue(Rule("allow", interfaces=["08:*:*"], operator="all-of").matches(stick))
+        self.assertFalse(Rule("allow", interfaces=["08:*:*"], operator="equals").matches(stick))
+        self.assertTrue(Rule("allow", interfaces=["08:06:50", "08:06:62"], operator="equals").matches(stick))
+        self.assertTrue(Rule("allow", interfaces=["03:*:*"], operator="none-of").matches(stick))
+        self.assertTrue(Rule("allow", device_id="174c:*").matches(stick))
+        self.assertFalse(Rule("allow", device_id="174c:*", ports=["2-1"]).matches(stick))
+
+    def test_invalid_descriptions(self):
+        for description in ({"kiosk_ports": ['1-1" allow']}, {"sandbox_classes": ["08", "03"]},
+                            {"host_devices": ["keyboard"]}, {"implicit_target": "ignore"}, {"kiosk": ["1-1"]}):
+            with self.assertRaises(PolicyError):
+                Policy.from_dict(description)
+
+    def test_load_and_write_rules_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "policy.json")
+            with open(path, "w") as f:
+                json.dump({"kiosk_ports": ["1-1"], "reject_classes": [], "allow_hubs": False}, f)
+            policy = Policy.load(path)
+            self.assertEqual([x.format() for x in policy.compile()],
+                             ["block with-interface one-of { 08:*:* }"])
+
+            rules_file = os.path.join(tmp, "rules.conf")
+            write_rules_file(policy.compile(), rules_file)
+            with open(rules_file) as f:
+                self.assertEqual(f.read(), render(policy.compile()))
+            self.assertEqual(sorted(os.listdir(tmp)), ["policy.json", "rules.conf"])
+
+
+if __name__ == '__main__':
+    unittest.main()
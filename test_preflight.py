@@ -0,0 +1,57 @@
+import grp
+import os
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+from execution.preflight import Preflight
+
+
+class PreflightTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.bin = os.path.join(self.tmp.name, "bin")
+        os.makedirs(self.bin)
+        self.env = mock.patch.dict(os.environ, {"PATH": self.bin})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.tmp.cleanup()
+
+    def install(self, tool):
+        path = os.path.join(self.bin, tool)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\n")
+        os.chmod(path, stat.S_IRWXU)
+
+    def test_tool_installed_is_checked_once_per_process(self):
+        self.assertFalse(Preflight().tool_installed("usbguard"))
+
+        self.install("usbguard")
+        preflight = Preflight()
+        self.assertTrue(preflight.tool_installed("usbguard"))
+        self.assertTrue(preflight.tool_installed("usbguard"))
+        self.assertEqual((preflight.hits, preflight.misses), (1, 1))
+        # nothing is written to disk
+        self.assertEqual(os.listdir(self.tmp.name), ["bin"])
+
+    def test_user_in_group_checks_the_process_groups(self):
+        member = grp.struct_group(("vboxusers", "x", os.getegid(), []))
+        other = grp.struct_group(("vboxusers", "x", 2 ** 31 - 7, []))
+
+        with mock.patch("grp.getgrnam", return_value=member) as getgrnam:
+            preflight = Preflight()
+            self.assertTrue(preflight.user_in_group("vboxusers"))
+            self.assertTrue(preflight.user_in_group("vboxusers"))
+            self.assertEqual(getgrnam.call_count, 1)
+
+        with mock.patch("grp.getgrnam", return_value=other):
+            self.assertFalse(Preflight().user_in_group("vboxusers"))
+        with mock.patch("grp.getgrnam", side_effect=KeyError("vboxusers")):
+            self.assertFalse(Preflight().user_in_group("vboxusers"))
+
+
+if __name__ == '__main__':
+    unittest.main()
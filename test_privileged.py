@@ -0,0 +1,131 @@
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import privileged.core
+from network.rtnetlink import LinkResult
+from privileged.core import HelperError, PrivilegedClient, PrivilegedHelper
+
+
+class PrivilegedHelperTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.helper = PrivilegedHelper(sysfs_block=os.path.join(self.tmp.name, "class", "block"))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def connect(self):
+        ours, theirs = socket.socketpair()
+        threading.Thread(target=self.helper.serve_connection, args=(theirs,), daemon=True).start()
+        client = PrivilegedClient(ours, timeout=5)
+        client.hello()
+        self.addCleanup(client.close)
+        return client
+
+    def test_only_allow_listed_operations(self):
+        client = self.connect()
+        result, fds = client.call("ping")
+        self.assertEqual(result["pid"], os.getpid())
+        self.assertEqual(fds, [])
+
+        with self.assertRaises(HelperError):
+            client.call("run", args=["sh", "-c", "reboot"])
+        with self.assertRaises(HelperError):
+            client.usbguard("allow-device", ["3; reboot"])
+        with self.assertRaises(HelperError):
+            client.usbguard("remove-device", ["3"])
+        with self.assertRaises(HelperError):
+            client.link_state(["eth0; reboot"], up=False)
+        # the connection survives rejected requests
+        self.assertEqual(client.call("ping")[0]["pid"], os.getpid())
+
+    def test_link_state(self):
+        def set_links_state(interfaces, up):
+            return {x: LinkResult(x, up, None if x == "eth0" else "No such device") for x in interfaces}
+
+        client = self.connect()
+        with mock.patch("privileged.core.set_links_state", set_links_state):
+            results = client.link_state(["eth0", "nosuchif0"], up=False)
+        self.assertTrue(results["eth0"].ok)
+        self.assertFalse(results["eth0"].up)
+        self.assertEqual(results["nosuchif0"].error, "No such device")
+        self.assertEqual(client.calls, 1)
+
+    def test_unexpected_errors_are_answered(self):
+        client = self.connect()
+        with mock.patch("privileged.core.set_links_state", side_effect=KeyError("eth0")), \
+                self.assertLogs("privileged.core", level="ERROR"):
+            start = time.monotonic()
+            with self.assertRaisesRegex(HelperError, "KeyError"):
+                client.link_state(["eth0"], up=False)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(client.call("ping")[0]["pid"], os.getpid())
+
+    def test_clients_are_served_concurrently(self):
+        def set_links_state(interfaces, up):
+            time.sleep(0.3)
+            return {x: LinkResult(x, up) for x in interfaces}
+
+        clients = [self.connect() for _ in range(4)]
+        with mock.patch("privileged.core.set_links_state", set_links_state):
+            start = time.monotonic()
+            threads = [threading.Thread(target=x.link_state, args=(["eth0"], False)) for x in clients]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertLess(time.monotonic() - start, 0.9)
+
+    def test_block_device_descriptor_is_passed(self):
+        devices = os.path.join(self.tmp.name, "devices")
+        for name, parent in (("sdb", "pci0000:00/0000:00:14.0/usb1/1-1/1-1:1.0/host6/target6:0:0/6:0:0:0/block"),
+                             ("sdc", "pci0000:00/0000:00:17.0/ata1/host0/target0:0:0/0:0:0:0/block")):
+            os.makedirs(os.path.join(devices, parent, name))
+            os.makedirs(self.helper.sysfs_block, exist_ok=True)
+            os.symlink(os.path.join(devices, parent, name), os.path.join(self.helper.sysfs_block, name))
+            with open(os.path.join(self.tmp.name, name), "wb") as f:
+                f.write(name.encode() * 1024)
+
+        client = self.connect()
+        with mock.patch("privileged.core.BLOCK_DEVICE", re.compile(r"^" + re.escape(self.tmp.name) + r"/(sd[a-z])$")):
+            fd = client.open_block_device(os.path.join(self.tmp.name, "sdb"))
+            try:
+                self.assertEqual(os.read(fd, 6), b"sdbsdb")
+            finally:
+                os.close(fd)
+            # the host's own (SATA) disk is refused
+            with self.assertRaises(HelperError):
+                client.open_block_device(os.path.join(self.tmp.name, "sdc"))
+        with self.assertRaises(HelperError):
+            client.open_block_device("/etc/shadow")
+
+    def test_service_rejects_other_users(self):
+        path = os.path.join(self.tmp.name, "helper.sock")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        self.addCleanup(server.close)
+        self.helper.allowed_uids = {os.getuid() + 1}
+        threading.Thread(target=self.helper.serve_forever, args=(server,), daemon=True).start()
+
+        with mock.patch.dict(os.environ, {privileged.core.SOCKET_ENV: path}), \
+                mock.patch("privileged.core._spawn", side_effect=HelperError("no sudo")), \
+                mock.patch("privileged.core._client", None):
+            with self.assertLogs("privileged.core", level="ERROR"), self.assertRaises(HelperError):
+                privileged.core.default_client()
+
+            self.helper.allowed_uids = {os.getuid()}
+            client = privileged.core.default_client()
+            self.addCleanup(client.close)
+            self.assertIs(privileged.core.running_client(), client)
+            self.assertEqual(client.call("ping")[0]["pid"], os.getpid())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+
+from sandbox.provision import USBProvisioner, usb_filters
+
+
+class FakeVBoxManage:
+    def __init__(self, info):
+        self.info = dict(info)
+        self.calls = []
+
+    def showvminfo(self, vm, refresh=False):
+        self.calls.append(("showvminfo", vm))
+        return dict(self.info)
+
+    def invalidate(self, kind=None, vm=None):
+        pass
+
+    def run(self, *args, timeout=None):
+        self.calls.append(args)
+        if args[0] == "modifyvm":
+            for option, value in zip(args[2::2], args[3::2]):
+                key = {"--usbohci": "usb", "--usbehci": "ehci", "--usbxhci": "xhci"}[option]
+                self.info[key] = value
+        elif args[:2] == ("usbfilter", "add"):
+            self.info[f"USBFilterName{int(args[2]) + 1}"] = args[6]
+        elif args[:2] == ("usbfilter", "remove"):
+            filters = usb_filters(self.info)
+            del filters[int(args[2])]
+            for key in [x for x in self.info if x.startswith("USBFilterName")]:
+                del self.info[key]
+            self.info.update({f"USBFilterName{i + 1}": name for i, name in enumerate(filters)})
+        return 0, "", ""
+
+
+VM = {"name": "sandbox", "UUID": "00000000-0000-4000-8000-000000000001", "VMState": "poweroff"}
+
+
+class USBProvisionerTest(unittest.TestCase):
+    def commands(self, client):
+        return [x for x in client.calls if x[0] != "showvminfo"]
+
+    def test_applies_only_the_missing_settings_once(self):
+        client = FakeVBoxManage(dict(VM, usb="on", ehci="off"))
+        provisioner = USBProvisioner(client)
+
+        self.assertEqual(provisioner.provision("sandbox"), [
+            ("modifyvm", VM["UUID"], "--usbehci", "on", "--usbxhci", "on"),
+            ("usbfilter", "add", "0", "--target", VM["UUID"], "--name", "allow_all_usbs"),
+        ])
+        self.assertEqual(provisioner.plan(client.info), [])
+
+        # later sessions neither query nor configure the VM
+        client.calls.clear()
+        self.assertEqual(provisioner.provision("sandbox"), [])
+        self.assertEqual(provisioner.provision(VM["UUID"]), [])
+        self.assertEqual(client.calls, [])
+
+    def test_restored_vm_is_provisioned_again(self):
+        client = FakeVBoxManage(dict(VM, usb="on", ehci="on", xhci="on"))
+        provisioner = USBProvisioner(client)
+        provisioner.provision(VM["UUID"])
+        # the snapshot lacks the filter
+        client.info.pop("USBFilterName1")
+        provisioner.forget("sandbox")
+        self.assertEqual(provisioner.provisioned, set())
+        self.assertEqual(provisioner.provision(VM["UUID"]),
+                         [("usbfilter", "add", "0", "--target", VM["UUID"], "--name", "allow_all_usbs")])
+
+    def test_provisioned_vm_runs_no_command(self):
+        client = FakeVBoxManage(dict(VM, usb="on", ehci="on", xhci="on", USBFilterName1="allow_all_usbs"))
+        self.assertEqual(USBProvisioner(client).provision("sandbox"), [])
+        self.assertEqual(self.commands(client), [])
+
+    def test_duplicate_filters_are_removed(self):
+        client = FakeVBoxManage(dict(VM, usb="on", ehci="on", xhci="on", USBFilterName1="allow_all_usbs",
+                                     USBFilterName2="webcam", USBFilterName3="allow_all_usbs",
+                                     USBFilterName4="allow_all_usbs"))
+        USBProvisioner(client).provision("sandbox")
+        self.assertEqual(self.commands(client), [("usbfilter", "remove", "3", "--target", VM["UUID"]),
+                                                 ("usbfilter", "remove", "2", "--target", VM["UUID"])])
+        self.assertEqual(usb_filters(client.info), ["allow_all_usbs", "webcam"])
+
+    def test_running_vm_is_not_modified(self):
+        client = FakeVBoxManage(dict(VM, VMState="running"))
+        provisioner = USBProvisioner(client)
+        with self.assertLogs("sandbox.provision", level="ERROR"):
+            self.assertEqual(provisioner.provision("sandbox"), [])
+        self.assertEqual(self.commands(client), [])
+        self.assertNotIn("sandbox", provisioner.provisioned)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from sandbox.core import Sandbox
+from sandbox.qemu import QEMUBackend, QMPClient, QMPError
+from usb.core import USB
+
+
+class FakeQMPServer:
+    """
+    Speaks enough QMP on a Unix socket to act as a QEMU process: status, cont, device_add/device_del, quit.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.status = "prelaunch"
+        self.devices = set()
+        self.accepted = 0
+        self.commands = []
+        self.conn = None
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(4)
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def send(self, message):
+        self.conn.sendall((json.dumps(message) + "\n").encode())
+
+    def event(self, name, **data):
+        self.send({"event": name, "data": data, "timestamp": {"seconds": int(time.time()), "microseconds": 0}})
+
+    def serve(self):
+        while True:
+            try:
+                self.conn, _ = self.server.accept()
+            except OSError:
+                return
+            self.accepted += 1
+            self.send({"QMP": {"version": {"qemu": {"major": 8, "minor": 2, "micro": 0}}, "capabilities": []}})
+            for line in self.conn.makefile("rb"):
+                message = json.loads(line)
+                command, arguments = message["execute"], message.get("arguments", {})
+                self.commands.append(command)
+                reply = {"return": {}}
+                if command == "query-status":
+                    reply = {"return": {"status": self.status, "running": self.status == "running"}}
+                elif command == "cont":
+                    self.status = "running"
+                    self.event("RESUME")
+                elif command == "device_add":
+                    if arguments["id"] in self.devices:
+                        reply = {"error": {"class": "GenericError", "desc": f"Duplicate ID '{arguments['id']}'"}}
+                    self.devices.add(arguments["id"])
+                elif command == "device_del":
+                    self.devices.discard(arguments["id"])
+                if "id" in message:
+                    reply["id"] = message["id"]
+                self.send(reply)
+                if command == "device_del":
+                    self.event("DEVICE_DELETED", device=arguments["id"], path=f"/machine/peripheral/{arguments['id']}")
+                elif command == "quit":
+                    self.event("SHUTDOWN", guest=False, reason="host-qmp-quit")
+                    self.conn.close()
+                    self.server.close()
+                    return
+
+    def guest_shutdown(self):
+        self.status = "shutdown"
+        self.event("STOP")
+        self.event("SHUTDOWN", guest=True, reason="guest-shutdown")
+
+
+class QEMUBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.qmp = FakeQMPServer(os.path.join(self.tmp.name, "analysis.qmp"))
+        self.backend = QEMUBackend(socket_dir=self.tmp.name)
+        self.sandbox = Sandbox(name="analysis", backend=self.backend)
+
+    def tearDown(self):
+        self.backend.client("analysis").close()
+        self.qmp.server.close()
+        self.tmp.cleanup()
+
+    def test_attach_and_detach_over_one_connection(self):
+        self.assertTrue(self.sandbox.run_sandbox())
+        self.assertEqual(self.qmp.status, "running")
+
+        devices = [USB("0781:5567", "0781", "5567", "A", busnum=1, devnum=5),
+                   USB("0951:1666", "0951", "1666", "B", busnum=2, devnum=3)]
+        ids = self.sandbox.resolve_usb(devices)
+        self.assertEqual(ids, ["usb-1-5", "usb-2-3"])
+
+        start = time.monotonic()
+        report = self.sandbox.mount_usb_to_sandbox(ids, usbguard=mock.Mock())
+        elapsed = time.monotonic() - start
+        self.assertEqual({x.status for x in report.values()}, {"attached"})
+        self.assertEqual(self.qmp.devices, {"usb-1-5", "usb-2-3"})
+        # no process is started, the attach is a round trip on the socket
+        self.assertLess(elapsed, 0.5)
+
+        self.assertEqual(self.backend.detach_usb("analysis", "usb-1-5"), (True, ""))
+        self.assertEqual(self.qmp.devices, {"usb-2-3"})
+        self.assertEqual(self.qmp.accepted, 1)
+
+    def test_attach_error_is_reported(self):
+        self.backend.attach_usb("analysis", "usb-1-5")
+        ok, error = self.backend.attach_usb("analysis", "usb-1-5")
+        self.assertFalse(ok)
+        self.assertIn("Duplicate ID", error)
+
+    def test_wait_for_shutdown_follows_the_events(self):
+        self.sandbox.run_sandbox()
+        transitions = list()
+        threading.Timer(0.2, self.qmp.guest_shutdown).start()
+        state = self.sandbox.wait_for_shutdown(on_transition=lambda old, new: transitions.append((old, new)))
+        self.assertEqual(state, "shutdown")
+        self.assertEqual(transitions, [("running", "paused"), ("paused", "shutdown")])
+
+    def test_power_off_ends_the_connection(self):
+        self.sandbox.run_sandbox()
+        self.sandbox.power_off()
+        self.assertEqual(self.backend.wait_for_stop("analysis"), "poweroff")
+        with self.assertRaises(QMPError):
+            QMPClient(self.qmp.path, timeout=1).connect()
+
+
+if __name__ == '__main__':
+    unittest.main()
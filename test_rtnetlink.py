@@ -0,0 +1,59 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+import unittest
+
+from network.rtnetlink import change_link_state
+
+# runs inside a fresh (unprivileged) network namespace in which the loopback interface starts out down
+IN_NAMESPACE = textwrap.dedent('''
+    import fcntl, json, socket, struct
+    from network.rtnetlink import set_links_state
+
+    def is_up(name):
+        with socket.socket() as s:
+            flags = fcntl.ioctl(s, 0x8913, struct.pack("16sh", name.encode(), 0))  # SIOCGIFFLAGS
+            return bool(struct.unpack("16sh", flags[:18])[1] & 1)
+
+    before = is_up("lo")
+    up = set_links_state(["lo", "nosuchif0"], up=True)
+    after_up = is_up("lo")
+    down = set_links_state(["lo"], up=False)
+    print(json.dumps({"before": before, "after_up": after_up, "after_down": is_up("lo"),
+                      "lo": up["lo"].error, "missing": up["nosuchif0"].error, "down": down["lo"].error}))
+''')
+
+
+def run_in_namespace(code):
+    return subprocess.run(["unshare", "--user", "--map-root-user", "--net", sys.executable, "-c", code],
+                          cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+
+
+@unittest.skipIf(shutil.which("unshare") is None, "unshare not available")
+class RtnetlinkTest(unittest.TestCase):
+    def test_batch_up_down(self):
+        probe = run_in_namespace("pass")
+        if probe.returncode != 0:
+            self.skipTest(f"unprivileged network namespaces not available: {probe.stderr.strip()}")
+
+        result = run_in_namespace(IN_NAMESPACE)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        state = json.loads(result.stdout)
+        self.assertFalse(state["before"])
+        self.assertTrue(state["after_up"])
+        self.assertFalse(state["after_down"])
+        self.assertIsNone(state["lo"])
+        self.assertIsNone(state["down"])
+        self.assertEqual(state["missing"], os.strerror(19))  # ENODEV
+
+    def test_rejects_invalid_names(self):
+        with self.assertRaises(ValueError):
+            change_link_state(["eth0; reboot"], up=False)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from session import PipelineError, SessionPipeline, mount_pipeline
+
+
+class SessionPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.log = []
+        self.lock = threading.Lock()
+
+    def step(self, name, seconds=0.0, fail=False):
+        def run():
+            time.sleep(seconds)
+            if fail:
+                raise OSError(f"{name} failed")
+            with self.lock:
+                self.log.append(name)
+            return name
+        return run
+
+    def undo(self, result):
+        with self.lock:
+            self.log.append(f"undo {result}")
+
+    def test_independent_stages_overlap(self):
+        pipeline = SessionPipeline()
+
+        async def boot():
+            await asyncio.sleep(0.5)
+            return "booted"
+
+        pipeline.add("boot", boot)
+        pipeline.add("teardown", self.step("teardown", 0.4))
+        pipeline.add("usbguard", self.step("usbguard", 0.3))
+        pipeline.add("attach", self.step("attach"), depends=["boot", "teardown", "usbguard"])
+
+        start = time.monotonic()
+        results = asyncio.run(pipeline.run())
+        self.assertLess(time.monotonic() - start, 0.5 + 0.35)
+        self.assertEqual(results["boot"], "booted")
+        self.assertEqual(self.log[-1], "attach")
+        self.assertIn("attach", pipeline.format_timings())
+
+    def test_failure_rolls_back_only_completed_stages(self):
+        pipeline = SessionPipeline()
+        pipeline.add("teardown", self.step("teardown"), rollback=self.undo)
+        pipeline.add("boot", self.step("boot", 0.1), depends=["teardown"], rollback=self.undo)
+        pipeline.add("resolve", self.step("resolve", 0.2, fail=True), rollback=self.undo)
+        pipeline.add("attach", self.step("attach"), depends=["boot", "resolve"], rollback=self.undo)
+
+        with self.assertLogs("session", level="ERROR"):
+            with self.assertRaises(PipelineError) as e:
+                asyncio.run(pipeline.run())
+        self.assertEqual(list(e.exception.errors), ["resolve"])
+        self.assertEqual(self.log, ["teardown", "boot", "undo boot", "undo teardown"])
+        self.assertEqual(pipeline.stages["attach"].state, "cancelled")
+        self.assertEqual(pipeline.rolled_back, ["boot", "teardown"])
+
+    def test_timeout(self):
+        pipeline = SessionPipeline()
+
+        async def hang():
+            await asyncio.sleep(30)
+
+        pipeline.add("teardown", self.step("teardown"), rollback=self.undo)
+        pipeline.add("boot", hang, timeout=0.2)
+
+        with self.assertLogs("session", level="ERROR"):
+            with self.assertRaises(PipelineError) as e:
+                asyncio.run(pipeline.run())
+        self.assertIsInstance(e.exception.errors["boot"], TimeoutError)
+        self.assertEqual(self.log, ["teardown", "undo teardown"])
+
+    def test_cancellation_rolls_back_stages_that_complete_later(self):
+        pipeline = SessionPipeline()
+        pipeline.add("teardown", self.step("teardown"), rollback=self.undo)
+        # runs in a worker thread that cannot be interrupted
+        pipeline.add("usbguard", self.step("usbguard", 0.4), rollback=self.undo)
+        pipeline.add("attach", self.step("attach"), depends=["teardown", "usbguard"], rollback=self.undo)
+
+        async def run():
+            task = asyncio.ensure_future(pipeline.run())
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await task
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(run())
+        self.assertEqual(self.log, ["teardown", "undo teardown"])
+
+        deadline = time.monotonic() + 5
+        while "undo usbguard" not in self.log and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.log, ["teardown", "undo teardown", "usbguard", "undo usbguard"])
+        self.assertNotIn("attach", self.log)
+
+    def test_dependency_cycle_is_rejected(self):
+        pipeline = SessionPipeline()
+        pipeline.add("a", self.step("a"), depends=["b"])
+        pipeline.add("b", self.step("b"), depends=["a"])
+        with self.assertRaises(PipelineError):
+            asyncio.run(pipeline.run())
+
+
+class FakeSandbox:
+    sandbox_id = "sandbox"
+
+    def __init__(self, provisioned=True, started=True):
+        self.provisioned = provisioned
+        self.started = started
+        self.powered_off = 0
+
+    def provision_usb(self):
+        return self.provisioned
+
+    async def run_sandbox_async(self):
+        return self.started
+
+    def power_off(self):
+        self.powered_off += 1
+
+    def resolve_usb(self, usb_objects):
+        return ["uuid"]
+
+
+class FakeUSBGuard:
+    def prepare(self):
+        pass
+
+
+class MountPipelineTest(unittest.TestCase):
+    def run_pipeline(self, sandbox):
+        pipeline = mount_pipeline(sandbox, [], FakeUSBGuard(), disconnect=lambda: [])
+        with self.assertLogs("session", level="ERROR"):
+            with self.assertRaises(PipelineError) as e:
+                asyncio.run(pipeline.run())
+        return e.exception.errors
+
+    def test_vm_that_does_not_start_fails_the_session(self):
+        sandbox = FakeSandbox(started=False)
+        self.assertEqual(list(self.run_pipeline(sandbox)), ["start_vm"])
+        self.assertEqual(sandbox.powered_off, 0)
+
+    def test_started_vm_is_powered_off_on_failure(self):
+        sandbox = FakeSandbox()
+        sandbox.resolve_usb = lambda usb_objects: time.sleep(0.2)
+        self.assertEqual(list(self.run_pipeline(sandbox)), ["resolve_usb"])
+        self.assertEqual(sandbox.powered_off, 1)
+
+    def test_unprovisioned_vm_is_not_started(self):
+        sandbox = FakeSandbox(provisioned=False)
+        self.assertEqual(list(self.run_pipeline(sandbox)), ["provision_usb"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+
+import usb.sysfs
+
+
+def write_attributes(directory, **attributes):
+    os.makedirs(directory)
+    for attribute, value in attributes.items():
+        with open(os.path.join(directory, attribute), "w") as f:
+            f.write(f"{value}\n")
+
+
+# device descriptor, configuration descriptor, interface descriptor (class 08, subclass 06, protocol 50) and two
+# bulk endpoints of a stick
+STICK_DESCRIPTORS = bytes([18, 1, 0x00, 0x02, 0, 0, 0, 64, 0x81, 0x07, 0x67, 0x55, 0x00, 0x01, 1, 2, 3, 1,
+                           9, 2, 32, 0, 1, 1, 0, 0x80, 50,
+                           9, 4, 0, 0, 2, 0x08, 0x06, 0x50, 0,
+                           7, 5, 0x81, 2, 0x00, 0x02, 0,
+                           7, 5, 0x02, 2, 0x00, 0x02, 0])
+
+
+class SysfsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = self.tmp.name
+        write_attributes(os.path.join(root, "usb1"), idVendor="1d6b", idProduct="0002", busnum=1, devnum=1)
+        write_attributes(os.path.join(root, "usb1:1.0"), bInterfaceClass="09")
+        write_attributes(os.path.join(root, "1-2"), idVendor="0781", idProduct="5567", serial="4C530001",
+                         busnum=1, devnum=5, speed=480)
+        write_attributes(os.path.join(root, "1-2:1.0"), bInterfaceClass="08")
+        # identical stick without iSerial on a hub port
+        write_attributes(os.path.join(root, "1-3.1"), idVendor="0781", idProduct="5567", busnum=1, devnum=7)
+        write_attributes(os.path.join(root, "1-3.1:1.0"), bInterfaceClass="08")
+        self.root = root
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_enumerate(self):
+        records = {r.port_path: r for r in usb.sysfs.enumerate_usb_devices(self.root)}
+
+        self.assertEqual(sorted(records), ["1-2", "1-3.1", "usb1"])
+        self.assertEqual(records["1-2"].device_id, "0781:5567")
+        self.assertEqual(records["1-2"].serial, "4C530001")
+        self.assertEqual((records["1-2"].busnum, records["1-2"].devnum), (1, 5))
+        self.assertIsNone(records["1-3.1"].serial)
+        self.assertTrue(records["1-3.1"].is_mass_storage())
+        self.assertFalse(records["usb1"].is_mass_storage())
+
+    def test_to_usb(self):
+        sticks = [r.to_usb() for r in usb.sysfs.enumerate_usb_devices(self.root) if r.is_mass_storage()]
+        self.assertEqual([s.port_path for s in sticks], ["1-2", "1-3.1"])
+
+    def test_unauthorized_stick_is_classified_from_its_descriptors(self):
+        # usbguard blocked the stick: authorized=0 and no interface directories
+        directory = os.path.join(self.root, "1-4")
+        write_attributes(directory, idVendor="0781", idProduct="5567", busnum=1, devnum=8, authorized=0)
+        with open(os.path.join(directory, "descriptors"), "wb") as f:
+            f.write(STICK_DESCRIPTORS)
+
+        records = {r.port_path: r for r in usb.sysfs.enumerate_usb_devices(self.root)}
+        self.assertEqual(records["1-4"].interface_classes, (0x08,))
+        self.assertTrue(records["1-4"].is_mass_storage())
+
+    def test_parse_descriptors(self):
+        self.assertEqual(usb.sysfs.parse_descriptors(STICK_DESCRIPTORS), (0x08,))
+        # a hub declares its class on the device, a truncated descriptor ends the parsing
+        hub = bytearray(STICK_DESCRIPTORS[:18])
+        hub[4] = 0x09
+        self.assertEqual(usb.sysfs.parse_descriptors(bytes(hub) + bytes([9, 4, 0])), (0x09,))
+        self.assertEqual(usb.sysfs.parse_descriptors(b""), ())
+
+    def test_missing_root(self):
+        self.assertEqual(usb.sysfs.enumerate_usb_devices(os.path.join(self.root, "missing")), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+from usb.core import USB, USBGuard, USBGuardTable, parse_list_devices
+
+LIST_DEVICES = textwrap.dedent('''\
+    1: allow id 1d6b:0002 serial "0000:00:14.0" name "xHCI Host Controller" hash "abc=" parent-hash "def=" via-port "usb1" with-interface 09:00:00 with-connect-type ""
+    5: block id 0781:5567 serial "4C530001" name "Cruzer Blade" hash "x1=" parent-hash "abc=" via-port "1-2" with-interface 08:06:50 with-connect-type "hotplug"
+    6: block id 0781:5567 serial "" name "Cruzer Blade" hash "x2=" parent-hash "abc=" via-port "1-3" with-interface 08:06:50 with-connect-type "hotplug"
+    12: block id 046d:c52b serial "" name "USB Receiver" hash "x3=" parent-hash "abc=" via-port "1-4" with-interface { 03:01:01 03:01:02 } with-connect-type "hotplug"
+''')
+
+FAKE_USBGUARD = textwrap.dedent('''
+    import sys
+    log = sys.argv[1]
+    with open(log, "a") as f:
+        f.write(" ".join(sys.argv[2:]) + "\\n")
+    if sys.argv[2] == "list-devices":
+        sys.stdout.write(open(log + ".devices").read())
+''')
+
+
+class USBGuardTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        script = os.path.join(self.tmp.name, "usbguard.py")
+        self.log = os.path.join(self.tmp.name, "calls")
+        with open(script, "w") as f:
+            f.write(FAKE_USBGUARD)
+        with open(self.log + ".devices", "w") as f:
+            f.write(LIST_DEVICES)
+        self.command = f"{sys.executable} {script} {self.log}"
+        self.cwd = os.getcwd()
+        self.env = mock.patch.dict(os.environ, {"MOUNT_USB_IN_SANDBOX_STATE_DIR": os.path.join(self.tmp.name, "state")})
+        self.env.start()
+        os.chdir(self.tmp.name)
+
+    def tearDown(self):
+        self.env.stop()
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def calls(self):
+        with open(self.log) as f:
+            return sorted(f.read().splitlines())
+
+    def test_parse(self):
+        devices = parse_list_devices(LIST_DEVICES)
+        self.assertEqual([d.id for d in devices], ["1", "5", "6", "12"])
+        self.assertEqual(devices[1].port, "1-2")
+        self.assertEqual(devices[1].serial, "4C530001")
+        self.assertIsNone(devices[2].serial)
+        self.assertEqual(devices[3].interfaces, ("03:01:01", "03:01:02"))
+
+    def test_match(self):
+        table = USBGuardTable(parse_list_devices(LIST_DEVICES))
+        by_port = USB("0781:5567", "0781", "5567", None, port_path="1-3")
+        by_serial = USB("0781:5567", "0781", "5567", "4C530001")
+        self.assertEqual([d.id for d in table.match(by_port)], ["6"])
+        self.assertEqual([d.id for d in table.match(by_serial)], ["5"])
+        self.assertEqual([d.id for d in table.match("0781:5567")], ["5", "6"])
+
+    def test_allow_only_targets(self):
+        sticks = [USB("0781:5567", "0781", "5567", "4C530001", port_path="1-2"),
+                  USB("0781:5567", "0781", "5567", None, port_path="1-3")]
+        results = USBGuard(devices=sticks, command=self.command).allow_device()
+
+        self.assertEqual(results, {"5": True, "6": True})
+        # one listing, no allow for the blocked receiver on 1-4
+        self.assertEqual(self.calls(), ["allow-device 5", "allow-device 6", "list-devices"])
+
+    def test_block_all_sticks(self):
+        with open(self.log + ".devices", "w") as f:
+            f.write(LIST_DEVICES.replace("block", "allow"))
+        results = USBGuard(device_ids=["0781:5567"], command=self.command).block_device()
+
+        self.assertEqual(results, {"5": True, "6": True})
+        self.assertEqual(self.calls(), ["block-device 5", "block-device 6", "list-devices"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import tempfile
+import textwrap
+import unittest
+
+from sandbox.vboxmanage import UsbHostIndex, VBoxManage, parse_machinereadable, parse_usbhost, parse_vm_list
+from usb.core import USB
+
+USBHOST = textwrap.dedent('''\
+    Host USB Devices:
+
+    UUID:               f5d4b2f4-1b6b-4d27-a1f0-3c0b1f0b2d11
+    VendorId:           0x0781 (0781)
+    ProductId:          0x5567 (5567)
+    Revision:           1.0 (0100)
+    Port:               1
+    USB version/speed:  2/High
+    Manufacturer:       SanDisk
+    Product:            Cruzer Blade
+    SerialNumber:       4C530001
+    Address:            sysfs:/sys/devices/pci0000:00/0000:00:14.0/usb1/1-2//device:/dev/vboxusb/001/005
+    Current State:      Busy
+
+    UUID:               0b1c4f7e-55aa-4e2b-9d3a-7e1d2c3b4a59
+    VendorId:           0x8087 (8087)
+    ProductId:          0x0026 (0026)
+    Revision:           0.2 (0002)
+    Port:               9
+    USB version/speed:  1/Full
+    Address:            sysfs:/sys/devices/pci0000:00/0000:00:14.0/usb1/1-10//device:/dev/vboxusb/001/003
+    Current State:      Busy
+
+''')
+
+FAKE_VBOXMANAGE = textwrap.dedent('''
+    import sys
+    with open(sys.argv[1], "a") as log:
+        log.write(" ".join(sys.argv[2:]) + "\\n")
+    args = sys.argv[2:]
+    if args == ["list", "runningvms"]:
+        print('"sandbox" {e0c6ec26-4ad1-4d55-97c8-f0f35c538e95}')
+    elif args == ["list", "usbhost"]:
+        sys.stdout.write(open(sys.argv[1] + ".usbhost").read())
+    elif args[0] == "showvminfo":
+        sys.stderr.write("VBoxManage: error: Could not find a registered machine named '%s'" % args[1])
+        sys.exit(1)
+''')
+
+
+class ParserTest(unittest.TestCase):
+    def test_parse_vm_list(self):
+        vms = parse_vm_list('"Whonix-Gateway-XFCE" {0b1c4f7e-55aa-4e2b-9d3a-7e1d2c3b4a59}\n"my vm" {abc}\n')
+        self.assertEqual([(vm.name, vm.uuid) for vm in vms],
+                         [("Whonix-Gateway-XFCE", "0b1c4f7e-55aa-4e2b-9d3a-7e1d2c3b4a59"), ("my vm", "abc")])
+
+    def test_parse_usbhost(self):
+        devices = parse_usbhost(USBHOST)
+        self.assertEqual([d.device_id for d in devices], ["0781:5567", "8087:0026"])
+        self.assertEqual(devices[0].serial, "4C530001")
+        self.assertIsNone(devices[1].serial)
+        self.assertTrue(devices[1].address.endswith("/dev/vboxusb/001/003"))
+
+    def test_parse_machinereadable(self):
+        info = parse_machinereadable('name="box"\nVMState="running"\n"SATA-0-0"="/vm/disk.vdi"\nmemory=2048\n')
+        self.assertEqual(info["VMState"], "running")
+        self.assertEqual(info["SATA-0-0"], "/vm/disk.vdi")
+        self.assertEqual(info["memory"], "2048")
+
+
+def identical_sticks(count):
+    records = list()
+    for i in range(count):
+        records.append(textwrap.dedent(f'''\
+            UUID:               00000000-0000-4000-8000-{i:012d}
+            VendorId:           0x0781 (0781)
+            ProductId:          0x5567 (5567)
+            Address:            sysfs:/sys/devices/pci0000:00/0000:00:14.0/usb1/1-1/1-1.{i + 1}//device:/dev/vboxusb/001/{i + 10:03d}
+            Current State:      Busy
+        '''))
+    return "\n".join(records)
+
+
+class UsbHostIndexTest(unittest.TestCase):
+    def test_identical_sticks_on_a_hub(self):
+        index = UsbHostIndex(parse_usbhost(identical_sticks(16)))
+        for i in reversed(range(16)):
+            stick = USB("0781:5567", "0781", "5567", None, port_path=f"1-1.{i + 1}")
+            self.assertEqual(index.resolve(stick).uuid, f"00000000-0000-4000-8000-{i:012d}")
+
+    def test_bus_address_and_serial(self):
+        index = UsbHostIndex(parse_usbhost(USBHOST + identical_sticks(2)))
+        self.assertEqual(index.resolve(USB("0781:5567", "0781", "5567", None, busnum=1, devnum=11)).uuid,
+                         "00000000-0000-4000-8000-000000000001")
+        self.assertEqual(index.resolve(USB("0781:5567", "0781", "5567", "4C530001")).uuid,
+                         "f5d4b2f4-1b6b-4d27-a1f0-3c0b1f0b2d11")
+        # ambiguous without serial or location
+        self.assertIsNone(index.resolve(USB("0781:5567", "0781", "5567", None)))
+        # known location, but not listed by VirtualBox
+        self.assertIsNone(index.resolve(USB("0781:5567", "0781", "5567", None, port_path="2-1")))
+
+
+class ClientTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        script = os.path.join(self.tmp.name, "vboxmanage.py")
+        self.log = os.path.join(self.tmp.name, "calls")
+        with open(script, "w") as f:
+            f.write(FAKE_VBOXMANAGE)
+        with open(self.log + ".usbhost", "w") as f:
+            f.write(USBHOST)
+        self.client = VBoxManage(f"{sys.executable} {script} {self.log}")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def calls(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_queries_are_cached(self):
+        self.assertTrue(self.client.is_running("sandbox"))
+        self.assertTrue(self.client.is_running("e0c6ec26-4ad1-4d55-97c8-f0f35c538e95"))
+        self.assertEqual(len(self.client.list_usbhost()), 2)
+        self.assertEqual(len(self.client.list_usbhost()), 2)
+        self.assertEqual(self.calls(), ["list runningvms", "list usbhost"])
+
+    def test_invalidation(self):
+        self.client.list_usbhost()
+        self.client.is_running("sandbox")
+        self.client.on_usb_event("add", None)
+        self.client.list_usbhost()
+        self.client.is_running("sandbox")
+        self.client.startvm("sandbox")
+        self.client.is_running("sandbox")
+        self.assertEqual(self.calls(), ["list usbhost", "list runningvms", "list usbhost", "startvm sandbox",
+                                        "list runningvms"])
+
+    def test_unknown_vm_does_not_break_invalidation(self):
+        self.assertIsNone(self.client.showvminfo("misnamed"))
+        self.client.on_vm_event("sandbox")
+        self.client.startvm("sandbox")
+        self.assertIsNone(self.client.showvminfo("misnamed"))
+        self.assertEqual(self.calls(), ["showvminfo misnamed --machinereadable", "startvm sandbox"])
+
+
+if __name__ == '__main__':
+    unittest.main()
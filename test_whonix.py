@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from sandbox.core import Sandbox
+from sandbox.whonix import StartupError, Whonix
+from session import PipelineError, mount_pipeline
+
+
+class FakeVBoxManage:
+    def __init__(self, boot_time=0.2):
+        self.boot_time = boot_time
+        self.calls = []
+        self.started = dict()
+        self.lock = threading.Lock()
+
+    def startvm(self, sandbox_id, *args):
+        with self.lock:
+            self.calls.append(("startvm", sandbox_id))
+        time.sleep(self.boot_time)
+        self.started[sandbox_id] = time.monotonic()
+        return 0, "", ""
+
+    def run(self, *args, timeout=None):
+        if args[:2] == ("guestproperty", "get"):
+            booted = args[2] in self.started and time.monotonic() - self.started[args[2]] > self.boot_time
+            return 0, "Value: Up\n" if booted else "No value set!\n", ""
+        if args[:2] == ("guestproperty", "wait"):
+            time.sleep(self.boot_time)
+            return 0, f"Name: {args[3]}, value: Up, flags:\n", ""
+        return 1, "", "unexpected"
+
+
+class FakeUSBGuard:
+    def prepare(self):
+        pass
+
+    def block_device(self):
+        pass
+
+
+class WhonixTest(unittest.TestCase):
+    def test_start(self):
+        client = FakeVBoxManage()
+        gateway = Sandbox(name="Whonix-Gateway", client=client)
+        workstation = Whonix(name="Whonix-Workstation", gateway=gateway, client=client, ready_timeout=5)
+
+        self.assertEqual(workstation.start(), {"start_gateway": True, "gateway_ready": True, "start_vm": True})
+        self.assertEqual([c[1] for c in client.calls], ["Whonix-Gateway", "Whonix-Workstation"])
+
+    def test_mount_pipeline_starts_the_workstation_once_the_gateway_is_ready(self):
+        client = FakeVBoxManage()
+        gateway = Sandbox(name="Whonix-Gateway", client=client)
+        workstation = Whonix(name="Whonix-Workstation", gateway=gateway, client=client, ready_timeout=5)
+        workstation.provision_usb = lambda: True
+        pipeline = mount_pipeline(workstation, [], FakeUSBGuard(), disconnect=lambda: [])
+        # the devices are not attached in this test
+        del pipeline.stages["attach_usb"]
+        pipeline.stages["resolve_usb"].func = lambda: []
+
+        asyncio.run(pipeline.run())
+        self.assertEqual([c[1] for c in client.calls], ["Whonix-Gateway", "Whonix-Workstation"])
+        self.assertGreaterEqual(pipeline.stages["start_vm"].started, pipeline.stages["gateway_ready"].finished)
+
+    def test_failed_start_fails_the_startup(self):
+        client = FakeVBoxManage(boot_time=0)
+        client.startvm = lambda sandbox_id, *args: client.calls.append(("startvm", sandbox_id)) or (1, "", "error")
+        gateway = Sandbox(name="Whonix-Gateway", client=client)
+        workstation = Whonix(name="Whonix-Workstation", gateway=gateway, client=client, ready_timeout=5)
+
+        with self.assertRaises(StartupError):
+            workstation.start()
+        self.assertEqual(client.calls, [("startvm", "Whonix-Gateway")])
+
+        client.calls.clear()
+        workstation.provision_usb = lambda: True
+        pipeline = mount_pipeline(workstation, [], FakeUSBGuard(), disconnect=lambda: [])
+        with self.assertLogs("session", level="ERROR"):
+            with self.assertRaises(PipelineError) as e:
+                asyncio.run(pipeline.run())
+        self.assertIn("start_gateway", e.exception.errors)
+        self.assertNotEqual(pipeline.stages["start_vm"].state, "completed")
+        self.assertEqual(client.calls, [("startvm", "Whonix-Gateway")])
+
+
+if __name__ == '__main__':
+    unittest.main()
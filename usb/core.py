@@ -1,27 +1,32 @@
-import subprocess
 import getpass
 import logging
-import pickle
+import shlex
 import sys
 
-from typing import List, Any
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import execution.core
+import execution.preflight
+import journal.core
+import metrics.core
+import privileged.core
+from network.rtnetlink import LinkResult, SudoError, change_link_state
 
 logger = logging.getLogger(__name__)
 logging.basicConfig()
 logger.setLevel(logging.DEBUG)
 
 
-class SudoError(Exception):
-    pass
-
-
 class USB:
 
-    def __init__(self, device_id, vendor_id, product_id, serial):
+    def __init__(self, device_id, vendor_id, product_id, serial, port_path=None, busnum=None, devnum=None):
         self.device_id = device_id
         self.vendor_id = vendor_id
         self.product_id = product_id
         self.serial = serial
+        self.port_path = port_path
+        self.busnum = busnum
+        self.devnum = devnum
 
     @staticmethod
     def __prompt_sudo() -> Any:
@@ -34,45 +39,189 @@ class USB:
         return getpass.getpass(prompt='\n\nPLEASE ENTER YOUR SUDO PASSWORD: ')
 
     @staticmethod
-    def connect_disconnect_network_interfaces(action: str, interface: str):
+    def connect_disconnect_network_interfaces(action: str, interfaces: Union[str, List[str]]) -> Dict[str, LinkResult]:
         """
-        Connects or disconnects network interface.
+        Connects or disconnects network interfaces.
+
+        All interfaces are changed in one privileged step (rtnetlink, at most one sudo password prompt).
 
         :param action: Connect or disconnect
         :type action: str
-        :param interface: Network interface name
-        :type interface: str
+        :param interfaces: Network interface name(s)
+        :type interfaces: Union[str, List[str]]
+        :return: Returns the result for every interface
+        :rtype: Dict[str, LinkResult]
         """
-        __sudo_pw = USB.__prompt_sudo()
+        if isinstance(interfaces, str):
+            interfaces = [interfaces]
+
         if action == "connect":
-            command = "sudo -S ifconfig " + interface + " up"
+            up = True
         elif action == "disconnect":
-            command = "sudo -S ifconfig " + interface + " down"
+            up = False
         else:
             logger.error("Cannot connect or disconnect network interface")
-            return
+            return dict()
 
-        p = subprocess.Popen(command,
-                             shell=True,
-                             stderr=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stdin=subprocess.PIPE)
         try:
-            stdout, stderr = p.communicate(input=(__sudo_pw + '\n').encode(), timeout=5)
-            logger.debug(f"{stdout}, {stderr}")
-            stderr = stderr.decode('UTF-8')
-
-            if (stderr.find("no password was provided") != -1) or (stderr.find("incorrect password") != -1):
-                raise SudoError(stderr)
-        except SudoError:
-            logger.error(SudoError)
+            results = change_link_state(interfaces, up, prompt_password=USB.__prompt_sudo)
+        except SudoError as e:
+            logger.error(e)
             sys.exit(1)
 
+        for result in results.values():
+            if not result.ok:
+                logger.error(f"Could not {action} {result.interface}: {result.error}")
+        return results
+
+
+class USBGuardDevice:
+    """
+    A device as listed by 'usbguard list-devices'.
+    """
+    __slots__ = ('id', 'target', 'device_id', 'serial', 'name', 'port', 'interfaces')
+
+    def __init__(self, id: str, target: str, device_id: Optional[str] = None, serial: Optional[str] = None,
+                 name: Optional[str] = None, port: Optional[str] = None, interfaces: Tuple[str, ...] = ()):
+        self.id = id
+        self.target = target
+        self.device_id = device_id
+        self.serial = serial
+        self.name = name
+        self.port = port
+        self.interfaces = interfaces
+
+    def __repr__(self):
+        return f"USBGuardDevice({self.id!r}, {self.target}, {self.device_id!r}, port={self.port!r})"
+
+    @property
+    def journal_key(self) -> str:
+        """
+        Key of the device in the restore journal: <device id>@<port>, or only the device id if the port is unknown.
+        """
+        return f"{self.device_id}@{self.port}" if self.port else self.device_id
+
+    @staticmethod
+    def from_journal_key(key: str) -> USB:
+        """
+        Returns a USB object that matches the device a journal key was written for.
+
+        :rtype: USB
+        """
+        device_id, _, port = key.partition("@")
+        vendor_id, _, product_id = device_id.partition(":")
+        return USB(device_id, vendor_id, product_id, None, port_path=port or None)
+
+
+def parse_list_devices(text: str) -> List[USBGuardDevice]:
+    """
+    Parses the output of 'usbguard list-devices', e.g.
+    12: block id 0781:5567 serial "4C53" name "Cruzer" hash "..." via-port "1-2" with-interface 08:06:50
+
+    :rtype: List[USBGuardDevice]
+    """
+    devices = list()
+    for line in text.splitlines():
+        rule_id, sep, rule = line.partition(":")
+        if not sep or not rule_id.strip().isdigit():
+            continue
+        try:
+            tokens = shlex.split(rule)
+        except ValueError:
+            continue
+        if not tokens:
+            continue
+
+        device = USBGuardDevice(id=rule_id.strip(), target=tokens[0])
+        i = 1
+        while i < len(tokens):
+            key = tokens[i]
+            if i + 1 >= len(tokens):
+                break
+            if tokens[i + 1] == "{":
+                end = tokens.index("}", i + 2) if "}" in tokens[i + 2:] else len(tokens)
+                values = tokens[i + 2:end]
+                i = end + 1
+            else:
+                values = [tokens[i + 1]]
+                i += 2
+
+            if key == "id":
+                device.device_id = values[0]
+            elif key == "serial":
+                device.serial = values[0] or None
+            elif key == "name":
+                device.name = values[0]
+            elif key == "via-port":
+                device.port = values[0]
+            elif key == "with-interface":
+                device.interfaces = tuple(values)
+        devices.append(device)
+
+    return devices
+
+
+class USBGuardTable:
+    """
+    All devices known to usbguard, indexed by vendor:product, (vendor:product, serial) and port.
+    """
+
+    def __init__(self, devices: List[USBGuardDevice]):
+        self.devices = devices
+        self.by_device_id = dict()
+        self.by_serial = dict()
+        self.by_port = dict()
+        for device in devices:
+            self.by_device_id.setdefault(device.device_id, []).append(device)
+            if device.serial:
+                self.by_serial.setdefault((device.device_id, device.serial), []).append(device)
+            if device.port:
+                self.by_port[device.port] = device
+
+    @classmethod
+    def load(cls, command: str = "usbguard") -> 'USBGuardTable':
+        """
+        Runs 'usbguard list-devices' once and indexes its output.
+
+        :rtype: USBGuardTable
+        """
+        p = execution.core.run(shlex.split(command) + ["list-devices"], tool="usbguard")
+        if not p.ok:
+            logger.error(f"usbguard list-devices failed: {p.stderr_text.strip()}")
+        return cls(parse_list_devices(p.stdout_text))
+
+    def match(self, device: Union[USB, str]) -> List[USBGuardDevice]:
+        """
+        Finds the usbguard entries of a device. A port path identifies a device exactly, otherwise the serial number
+        narrows down the vendor:product match.
+
+        :param device: USB object or a vendor:product device ID
+        :type device: Union[USB, str]
+        :rtype: List[USBGuardDevice]
+        """
+        if isinstance(device, str):
+            return list(self.by_device_id.get(device, []))
+
+        port_match = self.by_port.get(device.port_path) if device.port_path else None
+        if port_match is not None and port_match.device_id == device.device_id:
+            return [port_match]
+        if device.serial:
+            return list(self.by_serial.get((device.device_id, device.serial), []))
+        return list(self.by_device_id.get(device.device_id, []))
+
 
 class USBGuard:
 
-    def __init__(self, device_ids: List[str]):
-        self.device_ids = device_ids
+    def __init__(self, device_ids: Optional[List[str]] = None, devices: Optional[List[USB]] = None,
+                 command: str = "usbguard", journal: Optional[journal.core.Journal] = None):
+        self.devices = devices or []
+        self.device_ids = device_ids if device_ids is not None else [x.device_id for x in self.devices]
+        self.command = command
+        self.journal = journal
+        self.table = None
+
+    def _journal(self) -> journal.core.Journal:
+        return self.journal if self.journal is not None else journal.core.default_journal()
 
     @staticmethod
     def check_if_installed() -> bool:
@@ -82,95 +231,92 @@ class USBGuard:
         :return: Returns true if installed, else false
         :rtype: bool
         """
-        p = subprocess.Popen(["which", "usbguard"],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, stderr = p.communicate()
-        stdout = stdout.decode('UTF-8').splitlines()
-        stderr = stderr.decode('UTF-8').splitlines()
-        logger.debug(f"{stdout}, {stderr}")
+        return execution.preflight.default_preflight().tool_installed("usbguard")
 
-        if len(stdout) <= 0:
-            return False
-        return True
+    def prepare(self):
+        """
+        Reads the usbguard device table ahead of time, so allow_device does not have to query usbguard again.
+        """
+        with metrics.core.span("usbguard_table"):
+            self.table = USBGuardTable.load(self.command)
 
-    @staticmethod
-    def allow_device():
+    def targets(self) -> List[USBGuardDevice]:
+        """
+        Returns the usbguard entries of exactly the devices this object was created for.
+
+        :rtype: List[USBGuardDevice]
         """
-        Allows usb devices that have been blocked by usbguard
+        if self.table is None:
+            self.prepare()
+
+        targets = dict()
+        for device in (self.devices or self.device_ids):
+            for entry in self.table.match(device):
+                targets[entry.id] = entry
+        return list(targets.values())
+
+    def _apply(self, action: str, entries: List[USBGuardDevice]) -> Dict[str, bool]:
         """
-        def __list_devices() -> List[str]:
-            """
-            Private inner function that lists all usb devices.
+        Runs the usbguard action for all entries concurrently and waits for all of them.
 
-            :return: Returns a list of blocked usb device IDs
-            :rtype: List[str]
-            """
+        :return: Returns usbguard device ID -> success
+        :rtype: Dict[str, bool]
+        """
+        helper = privileged.core.running_client()
+        if helper is not None and entries and self.command == "usbguard":
+            # the helper of this session runs usbguard itself, one round trip for all entries
             try:
-                list_devices = subprocess.Popen(["usbguard", "list-devices"],
-                                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-                blocked_usbs = subprocess.check_output(["grep",
-                                                        "-E",
-                                                        "[0-9]{1,2}: block id"],
-                                                       stdin=list_devices.stdout)
-            except subprocess.CalledProcessError:
-                blocked_usbs = []
-
-            if len(blocked_usbs) > 0:
-                blocked_usbs = blocked_usbs.decode('UTF-8').splitlines()
-                blocked_usbs = [x[:2] for x in blocked_usbs]
-                return blocked_usbs
+                results = helper.usbguard(action, [entry.id for entry in entries])
+            except privileged.core.HelperError as e:
+                logger.error(f"Privileged helper: {e}")
             else:
-                return []
+                for entry in entries:
+                    if results.get(entry.id):
+                        entry.target = "allow" if action == "allow-device" else "block"
+                return results
+
+        processes = execution.core.default_executor().run_all(
+            [shlex.split(self.command) + [action, entry.id] for entry in entries], tool="usbguard")
+
+        results = dict()
+        for entry, p in zip(entries, processes):
+            logger.debug(f"{p.stdout}, {p.stderr}")
+            results[entry.id] = p.ok
+            if p.ok:
+                entry.target = "allow" if action == "allow-device" else "block"
+        return results
+
+    def allow_device(self) -> Dict[str, bool]:
+        """
+        Allows the target usb devices if they have been blocked by usbguard.
 
-        usbs = __list_devices()
-        logger.debug(f"USBGUARD IDs of blocked usb devices: {usbs}")
-        for usb in usbs:
-            allow_device = subprocess.Popen(["usbguard", "allow-device", usb],
-                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = allow_device.communicate()
-            logger.debug(f"{stdout}, {stderr}")
+        :return: Returns usbguard device ID -> success
+        :rtype: Dict[str, bool]
+        """
+        blocked = [x for x in self.targets() if x.target != "allow"]
+        logger.debug(f"USBGUARD IDs of blocked usb devices: {[x.id for x in blocked]}")
 
-        # make changes persistent and note them in the pickle logfile (to be able to --restore)
-        with open('allowed_usbguard.pickle', 'ab') as f:
-            pickle.dump(usbs, f, pickle.HIGHEST_PROTOCOL)
+        with metrics.core.span("usbguard_allow", devices=len(blocked)):
+            # note the change in the journal before making it (to be able to --restore)
+            self._journal().apply(journal.core.USBGUARD, [x.journal_key for x in blocked])
+            return self._apply("allow-device", blocked)
 
-    def block_device(self):
+    def block_device(self) -> Dict[str, bool]:
         """
-        Blocks a usb device using the 'usbguard block-device' command.
+        Blocks the target usb devices using the 'usbguard block-device' command.
 
-        :param self: the sandbox_id is either the name or the uuid of the box, depending on the user's input
+        The device table is read again, since usbguard assigns new IDs when a device is re-plugged.
+
+        :param self: USBGuard object
         :type self: USBGuard
+        :return: Returns usbguard device ID -> success
+        :rtype: Dict[str, bool]
         """
-        def __find_device_id() -> List[str]:
-            """
-            Lookup usbguard device ID.
-
-            :return: Returns list of device IDs
-            :rtype: List[str]
-            """
-            d = list()
-            try:
-                list_devices = subprocess.Popen(["usbguard", "list-devices"],
-                                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-                for device_id in self.device_ids:
-                    matched_usbs = subprocess.check_output(["grep",
-                                                            "-E",
-                                                            device_id],
-                                                           stdin=list_devices.stdout)
-                    matched_usbs = matched_usbs.decode('UTF-8').splitlines()
-                    d.append(matched_usbs[0].split(":")[0])
-            except subprocess.CalledProcessError:
-                d = []
-
-            return d
-
-        devices = __find_device_id()
-        for device in devices:
-            block_device = subprocess.Popen(["usbguard", "block-device", device],
-                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            stdout, stderr = block_device.communicate()
-            logger.debug(f"{stdout}, {stderr}")
-
-
+        with metrics.core.span("usbguard_block") as span:
+            self.prepare()
+            targets = self.targets()
+            allowed = [x for x in targets if x.target != "block"]
+            span.set(devices=len(allowed))
+            results = self._apply("block-device", allowed)
+            self._journal().revert(journal.core.USBGUARD, [x.journal_key for x in targets if x.target == "block"])
+        return results
@@ -0,0 +1,311 @@
+import logging
+import os
+import select
+import socket
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import usb.sysfs
+from usb.core import USB
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+MASS_STORAGE_CLASS = 0x08
+
+
+class Uevent:
+    """
+    A single kernel uevent as broadcast on the NETLINK_KOBJECT_UEVENT socket.
+    """
+
+    def __init__(self, action: str, devpath: str, properties: Dict[str, str]):
+        self.action = action
+        self.devpath = devpath
+        self.properties = properties
+
+    @classmethod
+    def parse(cls, data: bytes) -> Optional['Uevent']:
+        """
+        Parses a raw kernel uevent ("action@devpath\\0KEY=VALUE\\0...").
+
+        :param data: Raw datagram read from the uevent socket
+        :type data: bytes
+        :return: Returns the parsed uevent or None if the datagram is not a kernel uevent (e.g. a udev broadcast)
+        :rtype: Optional[Uevent]
+        """
+        fields = data.split(b"\0")
+        header = fields[0].decode('UTF-8', 'replace')
+        if "@" not in header:
+            return None
+
+        action, devpath = header.split("@", 1)
+        properties = dict()
+        for field in fields[1:]:
+            key, sep, value = field.decode('UTF-8', 'replace').partition("=")
+            if sep:
+                properties[key] = value
+
+        return cls(properties.get("ACTION", action), properties.get("DEVPATH", devpath), properties)
+
+    def is_mass_storage_interface(self) -> bool:
+        """
+        Checks if the uevent belongs to a USB interface of class 08 (mass storage).
+
+        :return: Returns True if the event describes a mass storage interface, else False
+        :rtype: bool
+        """
+        if self.properties.get("SUBSYSTEM") != "usb" or self.properties.get("DEVTYPE") != "usb_interface":
+            return False
+
+        interface = self.properties.get("INTERFACE", "")
+        try:
+            return int(interface.split("/")[0]) == MASS_STORAGE_CLASS
+        except ValueError:
+            return False
+
+    def is_usb_device(self) -> bool:
+        return self.properties.get("SUBSYSTEM") == "usb" and self.properties.get("DEVTYPE") == "usb_device"
+
+    def device_path(self) -> str:
+        """
+        Returns the devpath of the USB device, for an interface the device it belongs to (e.g. .../usb1/1-2 for
+        .../usb1/1-2/1-2:1.0).
+
+        :rtype: str
+        """
+        if self.is_usb_device():
+            return self.devpath
+        return self.devpath.rsplit("/", 1)[0]
+
+    def to_usb(self, sysfs_root: str = "/sys") -> USB:
+        """
+        Builds a USB object from the device's sysfs attributes, or from the PRODUCT property (e.g. 781/5567/100) if
+        the device is already gone (remove event).
+
+        :param sysfs_root: Mount point of sysfs
+        :type sysfs_root: str
+        :rtype: USB
+        """
+        record = usb.sysfs.read_device(os.path.join(sysfs_root, self.device_path().lstrip("/")))
+        if record is not None:
+            return record.to_usb()
+
+        vendor, product = (self.properties.get("PRODUCT", "0/0").split("/") + ["0"])[:2]
+        vendor_id = f"{int(vendor, 16):04x}"
+        product_id = f"{int(product, 16):04x}"
+
+        return USB(device_id=f"{vendor_id}:{product_id}", vendor_id=vendor_id, product_id=product_id, serial=None,
+                   port_path=os.path.basename(self.device_path()))
+
+
+class NetlinkUeventSource:
+    """
+    Receives raw uevents from the kernel via a NETLINK_KOBJECT_UEVENT socket.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            self.sock.bind((0, UEVENT_KERNEL_GROUP))
+        except OSError:
+            self.sock.close()
+            raise
+
+    def receive(self, timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Waits for the next uevent.
+
+        :param timeout: Seconds to wait, None blocks until an event arrives
+        :type timeout: Optional[float]
+        :return: Returns the raw datagram or None on timeout
+        :rtype: Optional[bytes]
+        """
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        if not readable:
+            return None
+        return self.sock.recv(65536)
+
+    def close(self):
+        self.sock.close()
+
+
+class HotplugWatcher:
+    """
+    Event-driven USB mass storage detection.
+
+    Devices are classified from their descriptors when the usb_device uevent arrives: a device usbguard did not
+    authorize gets no interfaces and therefore emits no usb_interface uevents. Interface uevents of class 08 are only
+    used if the descriptors of the device could not be read.
+
+    The uevent source is injectable: any object with a receive(timeout) -> Optional[bytes] and a close() method works,
+    which allows the watcher to be driven by recorded uevents instead of real hardware.
+    """
+
+    def __init__(self, source=None, sysfs_root: str = "/sys", on_event: Optional[Callable[[str, USB], None]] = None):
+        self.source = source if source is not None else NetlinkUeventSource()
+        self.sysfs_root = sysfs_root
+        self.on_event = on_event
+        # devpaths of the mass storage devices reported as added
+        self.present = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.source.close()
+
+    def events(self, timeout: Optional[float] = None) -> Iterator[Tuple[str, USB]]:
+        """
+        Yields (action, USB) tuples for every mass storage device that is added or removed.
+
+        :param timeout: Stop iterating if no matching uevent arrived within timeout seconds, None waits forever
+        :type timeout: Optional[float]
+        """
+        while True:
+            event = self.next_event(timeout)
+            if event is None:
+                return
+            yield event
+
+    def next_event(self, timeout: Optional[float] = None) -> Optional[Tuple[str, USB]]:
+        """
+        Waits for the next mass storage device that is added or removed.
+
+        :param timeout: Seconds to wait for a matching uevent, None waits forever
+        :type timeout: Optional[float]
+        :return: Returns (action, USB) or None on timeout
+        :rtype: Optional[Tuple[str, USB]]
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            data = self.source.receive(remaining)
+            if data is None:
+                return None
+
+            event = Uevent.parse(data)
+            if event is None or event.action not in ("add", "remove") or not self._matches(event):
+                continue
+
+            device = event.to_usb(self.sysfs_root)
+            if self.on_event is not None:
+                self.on_event(event.action, device)
+            return event.action, device
+
+    def _matches(self, event: Uevent) -> bool:
+        # tracks the reported devices, so that a device seen through both its device and interface uevents is only
+        # reported once and the removal of an unauthorized device (usb_device uevent only) is recognized
+        path = event.device_path()
+        if event.action == "remove":
+            if (event.is_usb_device() or event.is_mass_storage_interface()) and path in self.present:
+                self.present.discard(path)
+                return True
+            return False
+
+        if path in self.present:
+            return False
+        if event.is_usb_device():
+            classes = usb.sysfs.read_interface_classes(os.path.join(self.sysfs_root, path.lstrip("/")))
+            matched = classes is not None and MASS_STORAGE_CLASS in classes
+        else:
+            matched = event.is_mass_storage_interface()
+        if matched:
+            self.present.add(path)
+        return matched
+
+    def wait_for_devices(self, timeout: Optional[float] = None, settle: float = 0.25) -> List[USB]:
+        """
+        Blocks until at least one mass storage device has been added.
+
+        Sticks that are plugged in together (or expose several mass storage interfaces) are collected for another
+        settle seconds, so that they are handed to the mount flow as one batch.
+
+        :param timeout: Seconds to wait for the first device, None waits forever
+        :type timeout: Optional[float]
+        :param settle: Seconds to wait for further devices after the first one was detected
+        :type settle: float
+        :return: Returns the list of added USB devices (empty on timeout)
+        :rtype: List[USB]
+        """
+        devices = dict()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        settle_deadline = None
+
+        while True:
+            if devices:
+                remaining = settle_deadline - time.monotonic()
+            elif deadline is not None:
+                remaining = deadline - time.monotonic()
+            else:
+                remaining = None
+            if remaining is not None and remaining <= 0:
+                break
+
+            event = self.next_event(remaining)
+            if event is None:
+                break
+
+            action, device = event
+            key = device.port_path or (device.device_id, device.serial)
+            if action == "add":
+                if not devices:
+                    settle_deadline = time.monotonic() + settle
+                devices[key] = device
+            else:
+                devices.pop(key, None)
+
+        return list(devices.values())
+
+
+def wait_for_mass_storage(lookup: Callable[[], List[USB]], source=None, poll_interval: float = 5,
+                          timeout: Optional[float] = None,
+                          on_event: Optional[Callable[[str, USB], None]] = None) -> List[USB]:
+    """
+    Returns the attached USB mass storage devices, waiting for one to be plugged in if there is none yet.
+
+    Uses the uevent socket if available and falls back to calling lookup every poll_interval seconds otherwise.
+
+    :param lookup: Callable that enumerates the currently attached mass storage devices
+    :type lookup: Callable[[], List[USB]]
+    :param source: Optional uevent source (see HotplugWatcher)
+    :param poll_interval: Seconds between two lookups in polling mode
+    :type poll_interval: float
+    :param timeout: Seconds to wait for a device, None waits forever
+    :type timeout: Optional[float]
+    :param on_event: Optional listener invoked with (action, USB) for every hotplug event
+    :type on_event: Optional[Callable[[str, USB], None]]
+    :rtype: List[USB]
+    """
+    try:
+        # subscribe before the initial lookup so that no insertion can slip through in between
+        watcher = HotplugWatcher(source=source, on_event=on_event)
+    except OSError as e:
+        logger.debug(f"uevent socket unavailable ({e}), falling back to polling")
+        watcher = None
+
+    try:
+        usb_objects = lookup()
+        if usb_objects:
+            return usb_objects
+
+        print("\n\nWaiting for usb mass storage device to connect...\n\n")
+        if watcher is not None:
+            return watcher.wait_for_devices(timeout=timeout)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not usb_objects:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            time.sleep(poll_interval)
+            usb_objects = lookup()
+        return usb_objects
+    finally:
+        if watcher is not None:
+            watcher.close()
@@ -0,0 +1,310 @@
+import errno
+import hashlib
+import logging
+import mmap
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+import metrics.core
+import privileged.core
+import usb.core
+import usb.sysfs
+from sandbox.vboxmanage import VBoxManage, default_client
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+# bytes per read, a multiple of the page size so reads into the buffer are aligned
+BLOCK_SIZE = 4 * 1024 * 1024
+# seconds to wait for the kernel to create the block device once usbguard authorized the stick
+BLOCK_DEVICE_TIMEOUT = 10.0
+# lower bound of the convertfromraw throughput, used to derive its timeout
+CONVERT_BYTES_PER_SECOND = 20 * 1024 * 1024
+# characters of a serial number that are kept in the image file name
+UNSAFE_NAME_CHARACTERS = re.compile(r"[^A-Za-z0-9._-]")
+
+
+class ImageResult:
+    """
+    A block device copied into a raw image file.
+    """
+    __slots__ = ('source', 'path', 'size', 'sha256', 'sparse_bytes', 'seconds', 'medium')
+
+    def __init__(self, source: str, path: str):
+        self.source = source
+        self.path = path
+        self.size = 0
+        self.sha256 = None
+        self.sparse_bytes = 0
+        self.seconds = 0.0
+        self.medium = None
+
+    def __repr__(self):
+        return f"ImageResult({self.source!r} -> {self.path!r}, {self.size} bytes, {self.mb_per_s:.1f} MB/s, " \
+               f"sha256={self.sha256})"
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.size / self.seconds / 1e6 if self.seconds > 0 else 0.0
+
+
+def _write_all(fd: int, data: memoryview):
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def _copy_kernel(src: int, dst: int, size: int, block_size: int) -> bool:
+    """
+    Copies with copy_file_range (no copy through user space). Returns False if the kernel cannot copy between the two
+    files, the caller then falls back to reading and writing.
+    """
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is None:
+        return False
+    offset = 0
+    while offset < size:
+        try:
+            copied = copy_file_range(src, dst, min(block_size, size - offset))
+        except OSError as e:
+            if offset == 0 and e.errno in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                return False
+            raise
+        if copied == 0:
+            break
+        offset += copied
+    return True
+
+
+def image_device(source: str, destination: str, block_size: int = BLOCK_SIZE, checksum: bool = True,
+                 progress: Optional[Callable[[int, int], None]] = None) -> ImageResult:
+    """
+    Streams a block device (or any file, e.g. a loop file) into a sparse raw image.
+
+    The data is read into one reusable page-aligned buffer, hashed on the fly and all-zero blocks are skipped instead of
+    written, so memory use does not depend on the size of the stick. Without checksum the data is copied by the kernel
+    with copy_file_range where the files allow it. The image is written to destination.part and renamed once complete.
+    A block device the user may not read is opened by the privileged helper.
+
+    :param source: Block device or file to read
+    :type source: str
+    :param destination: Path of the raw image
+    :type destination: str
+    :param block_size: Bytes per read, rounded up to a multiple of the page size
+    :type block_size: int
+    :param checksum: Compute the SHA-256 of the data
+    :type checksum: bool
+    :param progress: Optional callback invoked with (bytes copied, total bytes)
+    :rtype: ImageResult
+    """
+    block_size = -(-block_size // mmap.PAGESIZE) * mmap.PAGESIZE
+    result = ImageResult(source, destination)
+    partial = destination + ".part"
+    start = time.monotonic()
+
+    try:
+        src = os.open(source, os.O_RDONLY)
+    except PermissionError:
+        if not source.startswith("/dev/"):
+            raise
+        # the privileged helper opens the stick and passes the descriptor, the copy still runs in this process
+        src = privileged.core.default_client().open_block_device(source)
+    try:
+        size = os.lseek(src, 0, os.SEEK_END)
+        os.lseek(src, 0, os.SEEK_SET)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(src, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        dst = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            if checksum or not _copy_kernel(src, dst, size, block_size):
+                sha256 = hashlib.sha256() if checksum else None
+                buffer = mmap.mmap(-1, block_size)
+                view = memoryview(buffer)
+                zeros = memoryview(bytes(block_size))
+                offset = 0
+                try:
+                    while True:
+                        n = os.readv(src, [view])
+                        if n == 0:
+                            break
+                        chunk = view[:n]
+                        if sha256 is not None:
+                            sha256.update(chunk)
+                        if chunk == zeros[:n]:
+                            os.lseek(dst, n, os.SEEK_CUR)
+                            result.sparse_bytes += n
+                        else:
+                            _write_all(dst, chunk)
+                        if hasattr(os, "posix_fadvise"):
+                            # the image is read once, do not let it push everything else out of the page cache
+                            os.posix_fadvise(src, offset, n, os.POSIX_FADV_DONTNEED)
+                        offset += n
+                        if progress is not None:
+                            progress(offset, size)
+                    # a trailing hole is only created by setting the file size
+                    os.ftruncate(dst, offset)
+                    size = offset
+                finally:
+                    chunk = None
+                    view.release()
+                    buffer.close()
+                result.sha256 = sha256.hexdigest() if sha256 is not None else None
+            os.fsync(dst)
+        finally:
+            os.close(dst)
+    finally:
+        os.close(src)
+
+    os.replace(partial, destination)
+    result.size = size
+    result.seconds = time.monotonic() - start
+    metrics.core.count("image_bytes", size)
+    return result
+
+
+def convert_image(result: ImageResult, client: Optional[VBoxManage] = None, remove_raw: bool = True) -> str:
+    """
+    Converts the raw image into a VDI medium that can be attached to VMs.
+
+    :param result: Image created by image_device
+    :type result: ImageResult
+    :param client: vboxmanage client
+    :type client: Optional[VBoxManage]
+    :param remove_raw: Delete the raw image once converted
+    :type remove_raw: bool
+    :return: Returns the path of the VDI medium
+    :rtype: str
+    """
+    client = client or default_client()
+    medium = os.path.splitext(result.path)[0] + ".vdi"
+    with metrics.core.span("image_convert"):
+        returncode, stdout, stderr = client.run("convertfromraw", result.path, medium, "--format", "VDI",
+                                                timeout=max(120.0, result.size / CONVERT_BYTES_PER_SECOND))
+    if returncode != 0:
+        raise OSError(f"Could not convert {result.path}: {stderr.strip()}")
+    if remove_raw:
+        os.remove(result.path)
+    result.medium = medium
+    return medium
+
+
+def wait_for_block_device(device: usb.core.USB, timeout: float = BLOCK_DEVICE_TIMEOUT,
+                          root: str = usb.sysfs.SYSFS_USB_DEVICES) -> Optional[str]:
+    """
+    Waits until the kernel created the block device of an authorized stick.
+
+    :rtype: Optional[str]
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        nodes = usb.sysfs.block_devices(device.port_path, root)
+        if nodes:
+            return nodes[0]
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.1)
+
+
+def image_name(device: usb.core.USB) -> str:
+    """
+    Returns the file name of the image of a stick. The serial number is reported by the device itself, characters
+    that are not safe in a file name are dropped and the port path is used if nothing is left.
+
+    :rtype: str
+    """
+    serial = UNSAFE_NAME_CHARACTERS.sub("", device.serial or "").strip(".")
+    return f"{device.device_id.replace(':', '-')}-{serial or device.port_path}-{int(time.time())}.img"
+
+
+def is_plain_mass_storage(device: usb.core.USB, root: str = usb.sysfs.SYSFS_USB_DEVICES) -> bool:
+    """
+    Checks with the descriptors of the (still blocked) device that all of its interfaces are mass storage, so that
+    authorizing it on the host does not also bind e.g. a keyboard interface.
+
+    :rtype: bool
+    """
+    if not device.port_path:
+        return False
+    classes = usb.sysfs.read_interface_classes(os.path.join(root, device.port_path))
+    return bool(classes) and set(classes) == {usb.sysfs.MASS_STORAGE_CLASS}
+
+
+def snapshot_devices(devices: List[usb.core.USB], usbguard: usb.core.USBGuard, directory: str,
+                     client: Optional[VBoxManage] = None, root: str = usb.sysfs.SYSFS_USB_DEVICES,
+                     ) -> List[ImageResult]:
+    """
+    Images every stick into directory and converts the images into VDI media.
+
+    The sticks are authorized in usbguard only while they are read and blocked again right after, then the operator
+    is told that they can be removed. All sticks are read concurrently.
+
+    While a stick is authorized it is exposed to the host: the kernel binds its drivers and e.g. udisks may probe (or
+    automount) its file systems. Only devices whose interfaces are all mass storage (class 08) are authorized, any
+    other device is refused and stays blocked.
+
+    :param devices: Sticks to image
+    :type devices: List[usb.core.USB]
+    :param usbguard: USBGuard object of the sticks
+    :type usbguard: usb.core.USBGuard
+    :param directory: Directory the images are written to
+    :type directory: str
+    :param client: vboxmanage client
+    :type client: Optional[VBoxManage]
+    :param root: sysfs USB device directory
+    :type root: str
+    :return: Returns the images that have been created and converted
+    :rtype: List[ImageResult]
+    """
+    accepted = [x for x in devices if is_plain_mass_storage(x, root)]
+    for device in devices:
+        if device not in accepted:
+            logger.error(f"Refusing to image {device.device_id} on port {device.port_path}: not a plain mass storage "
+                         f"device")
+    if not accepted:
+        return []
+    if len(accepted) < len(devices):
+        usbguard = usb.core.USBGuard(devices=accepted, command=usbguard.command, journal=usbguard.journal)
+        devices = accepted
+
+    os.makedirs(directory, exist_ok=True)
+
+    def image(device: usb.core.USB) -> Optional[ImageResult]:
+        node = wait_for_block_device(device, root=root)
+        if node is None:
+            logger.error(f"No block device appeared for {device.device_id} on port {device.port_path}")
+            return None
+        try:
+            with metrics.core.span("image", device=device.device_id):
+                result = image_device(node, os.path.join(directory, image_name(device)))
+        except OSError as e:
+            logger.error(f"Could not image {node} ({device.device_id}): {e}")
+            return None
+        logger.debug(f"Imaged {node} at {result.mb_per_s:.1f} MB/s: {result}")
+        return result
+
+    usbguard.allow_device()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, len(devices)), thread_name_prefix="imager") as executor:
+            results = [x for x in executor.map(image, devices) if x is not None]
+    finally:
+        usbguard.block_device()
+
+    for result in results:
+        print(f"Imaged {result.source}: {result.size / 1e6:.1f} MB at {result.mb_per_s:.1f} MB/s, "
+              f"sha256 {result.sha256}")
+    print("\n\nThe USB device(s) can be removed now.")
+
+    converted = list()
+    for result in results:
+        try:
+            convert_image(result, client)
+        except OSError as e:
+            logger.error(e)
+            continue
+        converted.append(result)
+    return converted
@@ -0,0 +1,308 @@
+"""
+Compiles a declarative description of which USB devices go to sandboxes into a USBGuard rule set.
+
+The rule set is installed once (rules file or IPC), so usbguard already takes the right decision when a device is
+inserted. Sandbox devices stay blocked on the host - the host's drivers and automounter never see them - until a
+session authorizes the stick with allow-device right before it is attached to the VM. A description is a JSON object:
+
+    {
+        "sandbox_classes": ["08"],              interface classes that are routed to sandboxes (mass storage)
+        "kiosk_ports": ["1-1", "1-2"],          ports reserved for the kiosk, only sandbox classes are accepted there
+        "host_devices": ["046d:c52b"],          vendor:product IDs the host keeps using (keyboard, mouse, ...)
+        "reject_classes": ["02", "03", ...],    classes never accepted on kiosk ports or next to a sandbox class
+        "allow_hubs": true,
+        "implicit_target": "block"              decision for everything else (usbguard's ImplicitPolicyTarget)
+    }
+
+usage: python -m usb.policy DESCRIPTION [--output RULES_FILE] [--apply] [--check]
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import shlex
+import sys
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import execution.core
+from usb.core import USBGuardDevice, USBGuardTable
+
+logger = logging.getLogger(__name__)
+logging.basicConfig()
+logger.setLevel(logging.DEBUG)
+
+TARGETS = ("allow", "block", "reject")
+OPERATORS = ("one-of", "all-of", "equals", "none-of")
+RULES_FILE = "/etc/usbguard/rules.conf"
+
+MASS_STORAGE = "08"
+HUB = "09"
+# CDC, HID, CDC data and wireless controllers: a stick that also offers one of these is a BadUSB device
+REJECT_CLASSES = ("02", "03", "0a", "e0")
+
+DEVICE_ID = re.compile(r"^([0-9a-f]{4}|\*):([0-9a-f]{4}|\*)$")
+PORT = re.compile(r"^(usb)?\d+(-\d+(\.\d+)*)?$")
+CLASS = re.compile(r"^[0-9a-f]{2}$")
+
+
+class PolicyError(ValueError):
+    """
+    The description is invalid.
+    """
+
+
+def _matches(pattern: str, value: Optional[str]) -> bool:
+    # usbguard patterns are colon separated fields, each one either literal or *
+    if value is None:
+        return False
+    fields, values = pattern.split(":"), value.lower().split(":")
+    return len(fields) == len(values) and all(f == "*" or f == v for f, v in zip(fields, values))
+
+
+class Rule:
+    """
+    One USBGuard rule, e.g. allow via-port one-of { "1-1" "1-2" } with-interface one-of { 08:*:* }
+    """
+    __slots__ = ('target', 'device_id', 'ports', 'interfaces', 'operator', 'comment')
+
+    def __init__(self, target: str, device_id: Optional[str] = None, ports: Iterable[str] = (),
+                 interfaces: Iterable[str] = (), operator: str = "one-of", comment: Optional[str] = None):
+        if target not in TARGETS:
+            raise PolicyError(f"Rule target must be one of {TARGETS}")
+        if operator not in OPERATORS:
+            raise PolicyError(f"with-interface operator must be one of {OPERATORS}")
+        self.target = target
+        self.device_id = device_id
+        self.ports = tuple(ports)
+        self.interfaces = tuple(interfaces)
+        self.operator = operator
+        self.comment = comment
+
+    def __repr__(self):
+        return f"Rule({self.format()!r})"
+
+    @staticmethod
+    def _set(values: Tuple[str, ...], operator: str, quote: bool = False) -> str:
+        values = [f'"{x}"' if quote else x for x in values]
+        # without an operator usbguard compares with equals
+        if len(values) == 1 and operator == "equals":
+            return values[0]
+        return f"{operator} {{ {' '.join(values)} }}"
+
+    def format(self) -> str:
+        """
+        Returns the rule in the usbguard rule language.
+
+        :rtype: str
+        """
+        parts = [self.target]
+        if self.device_id is not None:
+            parts.append(f"id {self.device_id}")
+        if self.ports:
+            parts.append(f"via-port {self._set(self.ports, 'equals' if len(self.ports) == 1 else 'one-of', True)}")
+        if self.interfaces:
+            parts.append(f"with-interface {self._set(self.interfaces, self.operator)}")
+        return " ".join(parts)
+
+    def matches(self, device: USBGuardDevice) -> bool:
+        """
+        Evaluates the rule against a device the way usbguard does.
+
+        :param device: Device descriptor, e.g. parsed from 'usbguard list-devices'
+        :type device: USBGuardDevice
+        :rtype: bool
+        """
+        if self.device_id is not None and not _matches(self.device_id, device.device_id):
+            return False
+        if self.ports and device.port not in self.ports:
+            return False
+        if self.interfaces:
+            found = [any(_matches(p, x) for p in self.interfaces) for x in device.interfaces]
+            if self.operator == "one-of" and not any(found):
+                return False
+            if self.operator == "none-of" and any(found):
+                return False
+            if self.operator == "all-of" and not all(any(_matches(p, x) for x in device.interfaces)
+                                                     for p in self.interfaces):
+                return False
+            if self.operator == "equals" and (len(device.interfaces) != len(self.interfaces) or not all(found)):
+                return False
+        return True
+
+
+class Policy:
+    """
+    Declarative description of the host's USB policy, see the module docstring.
+    """
+
+    def __init__(self, sandbox_classes: Iterable[str] = (MASS_STORAGE,), kiosk_ports: Iterable[str] = (),
+                 host_devices: Iterable[str] = (), reject_classes: Iterable[str] = REJECT_CLASSES,
+                 allow_hubs: bool = True, implicit_target: str = "block"):
+        self.sandbox_classes = tuple(self._check(CLASS, x.lower(), "interface class") for x in sandbox_classes)
+        self.kiosk_ports = tuple(self._check(PORT, x, "port") for x in kiosk_ports)
+        self.host_devices = tuple(self._check(DEVICE_ID, x.lower(), "device ID") for x in host_devices)
+        self.reject_classes = tuple(self._check(CLASS, x.lower(), "interface class") for x in reject_classes)
+        self.allow_hubs = allow_hubs
+        if implicit_target not in TARGETS:
+            raise PolicyError(f"implicit_target must be one of {TARGETS}")
+        self.implicit_target = implicit_target
+        if not self.sandbox_classes:
+            raise PolicyError("At least one sandbox class is required")
+        overlap = set(self.sandbox_classes) & set(self.reject_classes)
+        if overlap:
+            raise PolicyError(f"Classes {sorted(overlap)} are both routed to sandboxes and rejected")
+
+    @staticmethod
+    def _check(pattern, value: str, kind: str) -> str:
+        if not isinstance(value, str) or not pattern.match(value):
+            raise PolicyError(f"Invalid {kind}: {value!r}")
+        return value
+
+    @classmethod
+    def from_dict(cls, description: Dict[str, object]) -> 'Policy':
+        """
+        :raises PolicyError: If the description has unknown keys or invalid values
+        :rtype: Policy
+        """
+        unknown = set(description) - {"sandbox_classes", "kiosk_ports", "host_devices", "reject_classes",
+                                      "allow_hubs", "implicit_target"}
+        if unknown:
+            raise PolicyError(f"Unknown keys in the policy description: {sorted(unknown)}")
+        return cls(**description)
+
+    @classmethod
+    def load(cls, path: str) -> 'Policy':
+        """
+        Reads a description from a JSON file.
+
+        :rtype: Policy
+        :raises PolicyError: If the file is not a valid description
+        """
+        try:
+            with open(path) as f:
+                description = json.load(f)
+        except ValueError as e:
+            raise PolicyError(f"{path}: {e}")
+        if not isinstance(description, dict):
+            raise PolicyError(f"{path} does not contain a JSON object")
+        return cls.from_dict(description)
+
+    def compile(self) -> List[Rule]:
+        """
+        Compiles the description into rules. usbguard applies the first rule that matches, so the order is:
+        trusted host devices, BadUSB combinations, hubs, sandbox classes. Sandbox devices are blocked on every port,
+        including the kiosk ports, so the host never authorizes them before the session does.
+
+        :rtype: List[Rule]
+        """
+        sandbox = tuple(f"{x}:*:*" for x in self.sandbox_classes)
+        rules = [Rule("allow", device_id=x, comment="host device") for x in self.host_devices]
+
+        if self.kiosk_ports and self.reject_classes:
+            rules.append(Rule("reject", ports=self.kiosk_ports, interfaces=[f"{x}:*:*" for x in self.reject_classes],
+                              comment="only sandbox classes on kiosk ports"))
+        for routed in self.sandbox_classes:
+            for rejected in self.reject_classes:
+                rules.append(Rule("reject", interfaces=[f"{routed}:*:*", f"{rejected}:*:*"], operator="all-of",
+                                  comment="composite device"))
+        if self.allow_hubs:
+            rules.append(Rule("allow", interfaces=[f"{HUB}:*:*"], comment="hubs"))
+        rules.append(Rule("block", interfaces=sandbox, comment="sandbox devices, allowed per session"))
+        return rules
+
+    def evaluate(self, device: USBGuardDevice, rules: Optional[List[Rule]] = None) -> str:
+        """
+        Returns the decision usbguard takes when the device is inserted: the target of the first matching rule, else
+        the implicit target.
+
+        :rtype: str
+        """
+        for rule in (rules if rules is not None else self.compile()):
+            if rule.matches(device):
+                return rule.target
+        return self.implicit_target
+
+
+def render(rules: List[Rule]) -> str:
+    """
+    Returns the rules as the content of a usbguard rules file.
+
+    :rtype: str
+    """
+    lines = ["# generated by mount-usb-in-sandbox (python -m usb.policy), do not edit"]
+    for rule in rules:
+        if rule.comment:
+            lines.append(f"# {rule.comment}")
+        lines.append(rule.format())
+    return "\n".join(lines) + "\n"
+
+
+def write_rules_file(rules: List[Rule], path: str = RULES_FILE):
+    """
+    Writes the rules file atomically (usbguard reads it when the daemon starts). Must run as root for the default
+    path.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, partial = tempfile.mkstemp(dir=directory, prefix=".rules.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(render(rules))
+        os.chmod(partial, 0o600)
+        os.replace(partial, path)
+    except BaseException:
+        os.remove(partial)
+        raise
+
+
+def apply_rules(rules: List[Rule], command: str = "usbguard") -> bool:
+    """
+    Appends the rules to the running usbguard daemon over its IPC interface, one after the other since their order
+    matters. Done once when the host is set up, not per device.
+
+    :return: Returns true if all rules were appended
+    :rtype: bool
+    """
+    executor = execution.core.default_executor()
+    for rule in rules:
+        p = executor.run(shlex.split(command) + ["append-rule", rule.format()], tool="usbguard")
+        if not p.ok:
+            logger.error(f"usbguard append-rule {rule.format()!r} failed: {p.stderr_text.strip()}")
+            return False
+    return True
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m usb.policy")
+    parser.add_argument("description", help="JSON policy description")
+    parser.add_argument("--output", "-o", help="Write the rules file (e.g. /etc/usbguard/rules.conf) instead of "
+                                               "printing it")
+    parser.add_argument("--apply", action="store_true", help="Append the rules to the running usbguard daemon")
+    parser.add_argument("--check", action="store_true",
+                        help="Print the decision for every device currently known to usbguard")
+    parser.add_argument("--usbguard", default="usbguard", help="usbguard executable")
+    args = parser.parse_args(argv)
+
+    try:
+        policy = Policy.load(args.description)
+    except (OSError, PolicyError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    rules = policy.compile()
+
+    if args.output:
+        write_rules_file(rules, args.output)
+    elif not args.apply and not args.check:
+        sys.stdout.write(render(rules))
+    if args.apply and not apply_rules(rules, args.usbguard):
+        return 1
+    if args.check:
+        for device in USBGuardTable.load(args.usbguard).devices:
+            print(f"{policy.evaluate(device, rules):<7} {device.device_id} port {device.port} "
+                  f"{' '.join(device.interfaces)} {device.name or ''}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
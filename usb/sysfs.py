@@ -0,0 +1,192 @@
+import glob
+import os
+from typing import List, Optional, Tuple
+
+from usb.core import USB
+
+SYSFS_USB_DEVICES = "/sys/bus/usb/devices"
+MASS_STORAGE_CLASS = 0x08
+# bDescriptorType of device and interface descriptors
+DEVICE_DESCRIPTOR = 0x01
+INTERFACE_DESCRIPTOR = 0x04
+
+
+class UsbDeviceRecord:
+    """
+    A USB device as described by its sysfs attributes.
+    """
+    __slots__ = ('name', 'busnum', 'devnum', 'vendor_id', 'product_id', 'serial', 'speed', 'interface_classes')
+
+    def __init__(self, name: str, busnum: Optional[int], devnum: Optional[int], vendor_id: str, product_id: str,
+                 serial: Optional[str], speed: Optional[str], interface_classes: Tuple[int, ...] = ()):
+        self.name = name
+        self.busnum = busnum
+        self.devnum = devnum
+        self.vendor_id = vendor_id
+        self.product_id = product_id
+        self.serial = serial
+        self.speed = speed
+        self.interface_classes = interface_classes
+
+    def __repr__(self):
+        return f"UsbDeviceRecord({self.name!r}, {self.device_id!r}, serial={self.serial!r}, " \
+               f"interfaces={self.interface_classes!r})"
+
+    @property
+    def device_id(self) -> str:
+        return f"{self.vendor_id}:{self.product_id}"
+
+    @property
+    def port_path(self) -> str:
+        """
+        The physical port path (e.g. 1-2.3), which is also the name of the device directory in sysfs.
+        """
+        return self.name
+
+    def is_mass_storage(self) -> bool:
+        return MASS_STORAGE_CLASS in self.interface_classes
+
+    def to_usb(self) -> USB:
+        return USB(device_id=self.device_id,
+                   vendor_id=self.vendor_id,
+                   product_id=self.product_id,
+                   serial=self.serial,
+                   port_path=self.port_path,
+                   busnum=self.busnum,
+                   devnum=self.devnum)
+
+
+def _read(directory: str, attribute: str) -> Optional[str]:
+    try:
+        with open(os.path.join(directory, attribute)) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _read_int(directory: str, attribute: str, base: int = 10) -> Optional[int]:
+    value = _read(directory, attribute)
+    try:
+        return int(value, base) if value is not None else None
+    except ValueError:
+        return None
+
+
+def parse_descriptors(data: bytes) -> Tuple[int, ...]:
+    """
+    Extracts the interface classes from raw USB descriptors (the device descriptor followed by the configuration
+    descriptors, as in the sysfs 'descriptors' file). A class set on the device itself counts as an interface class.
+
+    :param data: Raw descriptors
+    :type data: bytes
+    :return: Returns the bInterfaceClass values in descriptor order, without duplicates
+    :rtype: Tuple[int, ...]
+    """
+    classes = list()
+    offset = 0
+    while offset + 2 <= len(data):
+        length, descriptor_type = data[offset], data[offset + 1]
+        if length < 2:
+            break
+        if descriptor_type == DEVICE_DESCRIPTOR and length >= 18 and data[offset + 4] not in (0x00, 0xef, 0xff):
+            classes.append(data[offset + 4])
+        elif descriptor_type == INTERFACE_DESCRIPTOR and length >= 9 and offset + 5 < len(data):
+            classes.append(data[offset + 5])
+        offset += length
+    return tuple(dict.fromkeys(classes))
+
+
+def read_interface_classes(directory: str) -> Optional[Tuple[int, ...]]:
+    """
+    Reads the interface classes of a device from its 'descriptors' file. Unlike the interface directories, the
+    descriptors are there while the device is not authorized (e.g. blocked by usbguard).
+
+    :param directory: sysfs directory of the device
+    :type directory: str
+    :return: Returns the interface classes or None if the descriptors cannot be read
+    :rtype: Optional[Tuple[int, ...]]
+    """
+    try:
+        with open(os.path.join(directory, "descriptors"), "rb") as f:
+            return parse_descriptors(f.read())
+    except OSError:
+        return None
+
+
+def read_device(directory: str, interface_classes: Tuple[int, ...] = ()) -> Optional[UsbDeviceRecord]:
+    """
+    Reads a single USB device directory (e.g. /sys/bus/usb/devices/1-2).
+
+    :param directory: sysfs directory of the device
+    :type directory: str
+    :param interface_classes: bInterfaceClass values of the device's interfaces, used if the descriptors cannot be read
+    :type interface_classes: Tuple[int, ...]
+    :return: Returns the device record or None if the directory is not (or no longer) a USB device
+    :rtype: Optional[UsbDeviceRecord]
+    """
+    vendor_id = _read(directory, "idVendor")
+    product_id = _read(directory, "idProduct")
+    if vendor_id is None or product_id is None:
+        return None
+    descriptor_classes = read_interface_classes(directory)
+
+    return UsbDeviceRecord(name=os.path.basename(directory.rstrip("/")),
+                           busnum=_read_int(directory, "busnum"),
+                           devnum=_read_int(directory, "devnum"),
+                           vendor_id=vendor_id,
+                           product_id=product_id,
+                           serial=_read(directory, "serial"),
+                           speed=_read(directory, "speed"),
+                           interface_classes=descriptor_classes or interface_classes)
+
+
+def enumerate_usb_devices(root: str = SYSFS_USB_DEVICES) -> List[UsbDeviceRecord]:
+    """
+    Enumerates all USB devices and their interface classes by reading sysfs, without starting any subprocess.
+
+    The interface classes come from the devices' descriptors, so devices usbguard has not authorized (the kernel
+    creates no interface directories for them) are classified as well.
+
+    :param root: Directory that holds one entry per USB device and interface (e.g. 1-2 and 1-2:1.0)
+    :type root: str
+    :return: Returns one record per USB device (root hubs included), sorted by port path
+    :rtype: List[UsbDeviceRecord]
+    """
+    try:
+        entries = sorted(os.listdir(root))
+    except FileNotFoundError:
+        return []
+
+    interfaces = dict()
+    devices = list()
+    for entry in entries:
+        device, sep, _ = entry.partition(":")
+        if sep:
+            interface_class = _read_int(os.path.join(root, entry), "bInterfaceClass", 16)
+            if interface_class is not None:
+                interfaces.setdefault(device, []).append(interface_class)
+        else:
+            devices.append(entry)
+
+    records = list()
+    for device in devices:
+        record = read_device(os.path.join(root, device), tuple(interfaces.get(device, ())))
+        if record is not None:
+            records.append(record)
+
+    return records
+
+
+def block_devices(port_path: str, root: str = SYSFS_USB_DEVICES) -> List[str]:
+    """
+    Returns the block device nodes (e.g. /dev/sdb) the kernel created for the mass storage interfaces of a device.
+
+    :param port_path: Port path of the USB device (e.g. 1-2.3)
+    :type port_path: str
+    :param root: Directory that holds one entry per USB device and interface
+    :type root: str
+    :return: Returns the device nodes, an empty list while the device is not authorized or not yet probed
+    :rtype: List[str]
+    """
+    pattern = os.path.join(root, port_path, f"{port_path}:*", "host*", "target*", "*", "block", "*")
+    return sorted("/dev/" + os.path.basename(x) for x in glob.glob(pattern))